@@ -110,8 +110,10 @@ resource "aws_lb_target_group" "tg_3000" {
   vpc_id      = var.vpc_id
   target_type = "ip"
 
+  # Readiness fails while the event loop is overloaded, so the ALB stops
+  # routing new requests to the task until it recovers
   health_check {
-    path                = "/bedrock/health/liveliness"
+    path                = "/bedrock/health/readiness"
     port                = "3000"
     protocol            = "HTTP"
     healthy_threshold   = 2
@@ -417,6 +419,29 @@ resource "aws_lb_listener_rule" "user_new" {
   }
 }
 
+# Middleware batch and admin endpoints
+resource "aws_lb_listener_rule" "middleware" {
+  listener_arn = aws_lb_listener.https.arn
+  priority     = 17
+
+  action {
+    type             = "forward"
+    target_group_arn = aws_lb_target_group.tg_3000.arn
+  }
+
+  condition {
+    path_pattern {
+      values = ["/middleware/*"]
+    }
+  }
+
+  condition {
+    http_request_method {
+      values = ["POST", "GET", "PUT"]
+    }
+  }
+}
+
 # HTTP Listener Rules for CloudFront to ALB communication
 # ---------------------------------------------------------------------------
 
@@ -734,6 +759,38 @@ resource "aws_lb_listener_rule" "user_new_http" {
   }
 }
 
+# Middleware batch and admin endpoints for HTTP
+resource "aws_lb_listener_rule" "middleware_http" {
+  count        = var.use_cloudfront ? 1 : 0
+  listener_arn = aws_lb_listener.http.arn
+  priority     = 17
+
+  action {
+    type             = "forward"
+    target_group_arn = aws_lb_target_group.tg_3000.arn
+  }
+
+  condition {
+    path_pattern {
+      values = ["/middleware/*"]
+    }
+  }
+
+  condition {
+    http_request_method {
+      values = ["POST", "GET", "PUT"]
+    }
+  }
+
+  # Add CloudFront Secret header validation
+  condition {
+    http_header {
+      http_header_name = "X-CloudFront-Secret"
+      values           = ["litellm-cf-${random_password.cloudfront_secret[0].result}"]
+    }
+  }
+}
+
 # DEFAULT CATCH-ALL with CloudFront header for HTTP
 resource "aws_lb_listener_rule" "catch_all_http" {
   count        = var.use_cloudfront ? 1 : 0
@@ -187,7 +187,11 @@ resource "aws_ecs_task_definition" "litellm" {
     },
     "environment": [
       { "name": "OKTA_ISSUER", "value": "${var.okta_issuer}" },
-      { "name": "OKTA_AUDIENCE", "value": "${var.okta_audience}" }
+      { "name": "OKTA_AUDIENCE", "value": "${var.okta_audience}" },
+      { "name": "REDIS_HOST", "value": "${var.redis_host}" },
+      { "name": "REDIS_PORT", "value": "${var.redis_port}" },
+      { "name": "REDIS_PASSWORD", "value": "${var.redis_password}" },
+      { "name": "REDIS_SSL", "value": "True" }
     ],
     "secrets": [
       {
@@ -234,6 +234,26 @@ resource "kubernetes_deployment" "litellm" {
             value = var.okta_audience
           }
 
+          env {
+            name  = "REDIS_HOST"
+            value = var.redis_host
+          }
+
+          env {
+            name  = "REDIS_PORT"
+            value = var.redis_port
+          }
+
+          env {
+            name  = "REDIS_PASSWORD"
+            value = var.redis_password
+          }
+
+          env {
+            name  = "REDIS_SSL"
+            value = "True"
+          }
+
           env {
             name  = "AWS_REGION"
             value = data.aws_region.current.name
@@ -250,9 +270,11 @@ resource "kubernetes_deployment" "litellm" {
             }
           }
 
+          # Not ready while the event loop is overloaded; liveness stays on
+          # liveliness so a busy pod is taken out of rotation, not restarted
           readiness_probe {
             http_get {
-              path = "/bedrock/health/liveliness"
+              path = "/bedrock/health/readiness"
               port = 3000
             }
             initial_delay_seconds = 20
@@ -411,6 +433,19 @@ resource "kubernetes_ingress_v1" "litellm" {
           }
         }
 
+        path {
+          path      = "/middleware"
+          path_type = "Prefix"
+          backend {
+            service {
+              name = kubernetes_service.litellm.metadata[0].name
+              port {
+                name = "port3000"
+              }
+            }
+          }
+        }
+
         path {
           path      = "/"
           path_type = "Prefix"
@@ -1,15 +1,15 @@
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse, StreamingResponse, Response
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse, Response
 import httpx
 import json
-from typing import Dict, Any, AsyncGenerator, List, Optional
-from openai import AsyncOpenAI
+from typing import Dict, Any, AsyncGenerator, Callable, List, Optional
 import struct
 import zlib
-import boto3
+import importlib
 import re
 import os
 import uuid
+import time
 from sqlalchemy import (
     create_engine,
     MetaData,
@@ -23,14 +23,304 @@ from sqlalchemy import (
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.sql import select, insert, update
 import hashlib
-from okta_jwt_verifier import AccessTokenVerifier
-from okta_jwt_verifier.jwt_utils import JWTUtils
+import atexit
+import logging
+import sys
+import traceback
+from datetime import datetime, timezone
 from fastapi.middleware.cors import CORSMiddleware
 import aiohttp
-from contextlib import asynccontextmanager
+import asyncio
+import collections
+import heapq
+import itertools
+import random
+import threading
+import anyio
+from contextlib import asynccontextmanager, contextmanager, nullcontext, suppress
+from contextvars import ContextVar
+from functools import lru_cache, partial, wraps
+from urllib.parse import urljoin
 from anyio import to_thread
 
-app = FastAPI()
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# Structured logging. log_event() only appends a tuple to an in-memory queue;
+# a writer thread formats, redacts and writes the records to stdout as JSON
+# lines every LOG_FLUSH_INTERVAL_SECONDS, so the event loop never blocks on
+# stdout. Below WARNING, LOG_SAMPLE_RATES (JSON of route -> rate, "*" for the
+# default) keeps a fraction of each route's records. Keys in LOG_REDACT_FIELDS
+# and bearer tokens, sk- keys and JWTs inside strings are redacted. When
+# LOG_QUEUE_SIZE records are waiting, new ones are dropped and counted.
+LOG_LEVEL = logging.getLevelName(os.environ.get("LOG_LEVEL", "INFO").upper())
+if not isinstance(LOG_LEVEL, int):
+    LOG_LEVEL = logging.INFO
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+LOG_FLUSH_INTERVAL_SECONDS = float(os.environ.get("LOG_FLUSH_INTERVAL_SECONDS", "0.05"))
+LOG_SAMPLE_RATES = json.loads(os.environ.get("LOG_SAMPLE_RATES", "{}"))
+LOG_REDACT_FIELDS = {
+    name.strip().lower()
+    for name in os.environ.get(
+        "LOG_REDACT_FIELDS",
+        "authorization,proxy-authorization,cookie,set-cookie,x-api-key,api_key,"
+        "master_key,password,token,access_token,refresh_token,client_secret",
+    ).split(",")
+    if name.strip()
+}
+
+SECRET_PATTERN = re.compile(
+    r"(?P<bearer>Bearer\s+)\S+|sk-[\w-]{4,}|eyJ[\w-]*\.[\w-]+\.[\w-]+"
+)
+REDACTED = "[REDACTED]"
+
+
+def redact_text(text: str) -> str:
+    if "Bearer" not in text and "sk-" not in text and "eyJ" not in text:
+        return text
+    return SECRET_PATTERN.sub(
+        lambda match: (match.group("bearer") or "") + REDACTED, text
+    )
+
+
+def redact(value):
+    """Returns a copy of `value` with secret fields and tokens redacted."""
+    if isinstance(value, str):
+        return redact_text(value)
+    if isinstance(value, dict):
+        return {
+            key: (
+                REDACTED
+                if isinstance(key, str) and key.lower() in LOG_REDACT_FIELDS
+                else redact(item)
+            )
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    if isinstance(value, (bytes, bytearray)):
+        # Request bodies are usually JSON; redact them field by field
+        try:
+            return redact(orjson.loads(value) if orjson else json.loads(value))
+        except ValueError:
+            return redact_text(bytes(value).decode("utf-8", errors="replace"))
+    return value
+
+
+class StructuredLogWriter:
+    """
+    Writes queued log records from a daemon thread. Appending to the deque is
+    thread safe and takes no lock on the caller's side.
+    """
+
+    def __init__(self, stream, max_records: int, flush_interval: float):
+        self.stream = stream
+        self.max_records = max_records
+        self.flush_interval = flush_interval
+        self.records = collections.deque()
+        self.dropped = 0
+        self.written = 0
+        self._second = None
+        self._timestamp = None
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(
+            target=self._run, name="log-writer", daemon=True
+        )
+
+    def start(self):
+        self._thread.start()
+        # Writes whatever is still queued on interpreter exit
+        atexit.register(self.flush)
+
+    def submit(self, record: tuple):
+        if len(self.records) >= self.max_records:
+            self.dropped += 1
+            return
+        self.records.append(record)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            lines = []
+            while self.records:
+                lines.append(self.format(self.records.popleft()))
+            if lines:
+                try:
+                    self.stream.write("\n".join(lines) + "\n")
+                    self.stream.flush()
+                except (OSError, ValueError):
+                    self.dropped += len(lines)
+                    return
+                self.written += len(lines)
+
+    def format(self, record: tuple) -> str:
+        created, level, message, route, fields, exc_text = record
+        second = int(created)
+        if second != self._second:
+            self._second = second
+            self._timestamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(second))
+        entry = {
+            "time": f"{self._timestamp}.{int(created % 1 * 1000):03d}Z",
+            "level": logging.getLevelName(level),
+            "message": redact_text(message),
+        }
+        if route:
+            entry["route"] = route
+        if fields:
+            entry.update(redact(fields))
+        if exc_text:
+            entry["exception"] = redact_text(exc_text)
+        if orjson is not None:
+            return orjson.dumps(entry, default=str).decode("utf-8")
+        return json.dumps(entry, default=str)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "level": logging.getLevelName(LOG_LEVEL),
+            "queued": len(self.records),
+            "written": self.written,
+            "dropped": self.dropped,
+        }
+
+
+log_writer = StructuredLogWriter(sys.stdout, LOG_QUEUE_SIZE, LOG_FLUSH_INTERVAL_SECONDS)
+log_writer.start()
+
+
+def log_event(level: int, message: str, route: Optional[str] = None, **fields):
+    """
+    Logs `message` at a `logging` level with structured `fields`. `route`
+    selects the sample rate. Pass exc_info=True to attach the current exception.
+    """
+    if level < LOG_LEVEL:
+        return
+    if level < logging.WARNING:
+        rate = LOG_SAMPLE_RATES.get(route, LOG_SAMPLE_RATES.get("*", 1))
+        if rate < 1 and random.random() >= rate:
+            return
+    exc_text = None
+    if fields.pop("exc_info", False):
+        exc_text = traceback.format_exc()
+    log_writer.submit((time.time(), level, message, route, fields, exc_text))
+
+
+@lru_cache(maxsize=None)
+def import_optional(module_name: str):
+    """
+    Imports a module on first use and returns it, or None when it isn't
+    installed. Keeps optional integrations out of the import-time path.
+    """
+    try:
+        return importlib.import_module(module_name)
+    except ImportError:
+        return None
+
+
+class JsonCodec:
+    """
+    Stdlib json codec. Always available and used as the fallback when no faster
+    backend is installed. dumps() returns UTF-8 bytes for every backend.
+    """
+
+    name = "json"
+
+    def loads(self, data):
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data).decode("utf-8")
+        return json.loads(data)
+
+    def dumps(self, obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode(
+            "utf-8"
+        )
+
+    def dumps_sorted(self, obj) -> bytes:
+        """Canonical encoding (sorted keys), used for cache and dedup keys."""
+        return json.dumps(
+            obj, ensure_ascii=False, separators=(",", ":"), sort_keys=True
+        ).encode("utf-8")
+
+
+class OrjsonCodec(JsonCodec):
+    name = "orjson"
+
+    def loads(self, data):
+        # orjson.JSONDecodeError subclasses json.JSONDecodeError
+        return orjson.loads(data)
+
+    def dumps(self, obj) -> bytes:
+        return orjson.dumps(obj)
+
+    def dumps_sorted(self, obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+
+
+class MsgspecCodec(JsonCodec):
+    name = "msgspec"
+
+    def __init__(self):
+        self._encoder = msgspec.json.Encoder()
+        self._decoder = msgspec.json.Decoder()
+
+    def loads(self, data):
+        try:
+            return self._decoder.decode(data)
+        except msgspec.DecodeError as e:
+            # Keep the stdlib exception contract so callers only catch one type
+            raise json.JSONDecodeError(str(e), "", 0) from e
+
+    def dumps(self, obj) -> bytes:
+        return self._encoder.encode(obj)
+
+    def dumps_sorted(self, obj) -> bytes:
+        return msgspec.json.encode(obj, order="sorted")
+
+
+def select_json_codec(preferred: Optional[str] = None) -> JsonCodec:
+    """
+    Picks the JSON backend. JSON_CODEC may be "orjson", "msgspec" or "json";
+    by default the fastest installed backend wins.
+    """
+    preferred = (preferred or os.environ.get("JSON_CODEC", "auto")).lower()
+    available = {"json": JsonCodec}
+    if orjson is not None:
+        available["orjson"] = OrjsonCodec
+    if msgspec is not None:
+        available["msgspec"] = MsgspecCodec
+
+    if preferred in available:
+        return available[preferred]()
+    if preferred != "auto":
+        log_event(
+            logging.WARNING,
+            f"JSON_CODEC={preferred} is not installed, falling back to auto",
+        )
+    for name in ("orjson", "msgspec", "json"):
+        if name in available:
+            return available[name]()
+
+
+json_codec = select_json_codec()
+log_event(logging.INFO, f"JSON codec: {json_codec.name}")
+
+
+class CodecJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return json_codec.dumps(content)
+
+
+app = FastAPI(default_response_class=CodecJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -38,15 +328,36 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allows all methods
     allow_headers=["*"],  # Allows all headers
-    expose_headers=["X-Session-Id"],  # Expose the X-Session-Id header
+    # Expose custom response headers
+    expose_headers=["X-Session-Id", "X-Cache", "Server-Timing"],
 )
 
 LITELLM_ENDPOINT = "http://localhost:4000"
 LITELLM_CHAT = f"{LITELLM_ENDPOINT}/v1/chat/completions"
 
-print(f"AWS_REGION: {os.getenv('AWS_REGION')}")
-print(f"AWS_DEFAULT_REGION: {os.getenv('AWS_DEFAULT_REGION')}")
-bedrock_client = boto3.client("bedrock-agent")
+log_event(
+    logging.INFO,
+    "AWS region",
+    aws_region=os.getenv("AWS_REGION"),
+    aws_default_region=os.getenv("AWS_DEFAULT_REGION"),
+)
+
+bedrock_client = None
+bedrock_client_lock = threading.Lock()
+
+
+def get_bedrock_client():
+    """
+    Creates the bedrock-agent client on first use. Called from worker threads,
+    so creation is serialized: boto3's default session isn't thread safe.
+    """
+    global bedrock_client
+    with bedrock_client_lock:
+        if bedrock_client is None:
+            boto3 = importlib.import_module("boto3")
+            bedrock_client = boto3.client("bedrock-agent")
+        return bedrock_client
+
 
 db_engine = None
 metadata = MetaData()
@@ -56,123 +367,2543 @@ OKTA_ISSUER = os.environ.get("OKTA_ISSUER")
 OKTA_AUDIENCE = os.environ.get("OKTA_AUDIENCE")
 MASTER_KEY = os.environ.get("MASTER_KEY")
 
-# Create a verifier instance for Access Tokens
-access_token_verifier = None
-if OKTA_AUDIENCE and OKTA_ISSUER:
-    access_token_verifier = AccessTokenVerifier(
-        issuer=OKTA_ISSUER, audience=OKTA_AUDIENCE
+# When enabled, /chat/completions only decodes the top-level control fields and
+# forwards the original request bytes whenever messages don't need rewriting.
+# Small bodies are cheaper to decode fully, so the scan only kicks in above a size.
+LAZY_BODY_PARSING = os.environ.get("LAZY_BODY_PARSING", "false").lower() == "true"
+LAZY_BODY_PARSING_MIN_BYTES = int(
+    os.environ.get("LAZY_BODY_PARSING_MIN_BYTES", "16384")
+)
+
+# End-to-end deadline (seconds) for a call to LiteLLM, including the whole
+# streamed body. MODEL_REQUEST_DEADLINES is a JSON object of model id -> seconds.
+REQUEST_DEADLINE_SECONDS = float(os.environ.get("REQUEST_DEADLINE_SECONDS", "600"))
+MODEL_REQUEST_DEADLINES = json_codec.loads(
+    os.environ.get("MODEL_REQUEST_DEADLINES") or "{}"
+)
+
+# What to store in chat history when a stream ends early (client disconnect or
+# deadline): "discard" drops the whole turn, "save" keeps the partial answer.
+PARTIAL_RESPONSE_POLICY = os.environ.get("PARTIAL_RESPONSE_POLICY", "discard").lower()
+
+# Bytes a single stream may hold between the upstream read and the client write,
+# and the budget across all streams in this process. 0 disables the buffering.
+STREAM_BUFFER_MAX_BYTES = int(os.environ.get("STREAM_BUFFER_MAX_BYTES", "65536"))
+STREAM_BUFFER_TOTAL_MAX_BYTES = int(
+    os.environ.get("STREAM_BUFFER_TOTAL_MAX_BYTES", str(256 * 1024 * 1024))
+)
+
+# Share one upstream call between byte-identical deterministic (temperature 0)
+# requests from the same API key that are in flight at the same time.
+REQUEST_COALESCING = os.environ.get("REQUEST_COALESCING", "false").lower() == "true"
+COALESCE_MAX_WAITERS = int(os.environ.get("COALESCE_MAX_WAITERS", "64"))
+
+# Exact-match cache for non-streaming responses: an in-process LRU in front of
+# the shared Redis used by LiteLLM. Only temperature 0 requests are cached unless
+# RESPONSE_CACHE_DETERMINISTIC_ONLY=false. Entries found in Redis are kept
+# locally for at most RESPONSE_CACHE_LOCAL_TTL_SECONDS, which bounds how long
+# other tasks can serve an entry after a purge.
+RESPONSE_CACHE = os.environ.get("RESPONSE_CACHE", "false").lower() == "true"
+RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", "300"))
+RESPONSE_CACHE_LOCAL_TTL_SECONDS = float(
+    os.environ.get("RESPONSE_CACHE_LOCAL_TTL_SECONDS", "30")
+)
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "2048"))
+RESPONSE_CACHE_MAX_BYTES = int(
+    os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024))
+)
+RESPONSE_CACHE_DETERMINISTIC_ONLY = (
+    os.environ.get("RESPONSE_CACHE_DETERMINISTIC_ONLY", "true").lower() == "true"
+)
+RESPONSE_CACHE_REDIS = os.environ.get("RESPONSE_CACHE_REDIS", "true").lower() == "true"
+REDIS_HOST = os.environ.get("REDIS_HOST")
+REDIS_PORT = int(os.environ.get("REDIS_PORT") or "6379")
+REDIS_PASSWORD = os.environ.get("REDIS_PASSWORD") or None
+REDIS_SSL = os.environ.get("REDIS_SSL", "false").lower() == "true"
+
+# Local admission control. Concurrency and queue-depth limits apply per API key
+# hash and per model (0 = unlimited); requests beyond the queue are rejected at
+# once with 429 + Retry-After. Limits can be changed at runtime through
+# /middleware/admission.
+ADMISSION_KEY_CONCURRENCY = int(os.environ.get("ADMISSION_KEY_CONCURRENCY", "0"))
+ADMISSION_KEY_QUEUE_DEPTH = int(os.environ.get("ADMISSION_KEY_QUEUE_DEPTH", "0"))
+ADMISSION_MODEL_CONCURRENCY = int(os.environ.get("ADMISSION_MODEL_CONCURRENCY", "0"))
+ADMISSION_MODEL_QUEUE_DEPTH = int(os.environ.get("ADMISSION_MODEL_QUEUE_DEPTH", "0"))
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(
+    os.environ.get("ADMISSION_QUEUE_TIMEOUT_SECONDS", "30")
+)
+ADMISSION_RETRY_AFTER_SECONDS = int(
+    os.environ.get("ADMISSION_RETRY_AFTER_SECONDS", "1")
+)
+
+# Weighted fair queuing across tenants. With SCHEDULER_CONCURRENCY > 0, admitted
+# requests wait for one of that many slots; priority classes are served in
+# order and tenants within a class share slots by weight. SCHEDULER_TENANTS maps
+# an api_key_hash to {"tenant": team, "weight": w, "priority": class}; a request
+# can pick its class with the PRIORITY_HEADER header.
+PRIORITY_CLASSES = ("interactive", "default", "batch")
+SCHEDULER_CONCURRENCY = int(os.environ.get("SCHEDULER_CONCURRENCY", "0"))
+SCHEDULER_TENANTS = json_codec.loads(os.environ.get("SCHEDULER_TENANTS") or "{}")
+PRIORITY_HEADER = os.environ.get("PRIORITY_HEADER", "X-Priority")
+
+# Event-loop lag monitoring. While the loop lags by more than the shed threshold
+# new non-streaming requests are rejected with 503 so in-flight streams keep
+# flowing; above the readiness threshold /bedrock/health/readiness reports 503.
+# A threshold of 0 disables that behaviour.
+LOOP_LAG_SAMPLE_INTERVAL_SECONDS = float(
+    os.environ.get("LOOP_LAG_SAMPLE_INTERVAL_SECONDS", "0.1")
+)
+LOOP_LAG_WINDOW_SAMPLES = int(os.environ.get("LOOP_LAG_WINDOW_SAMPLES", "600"))
+LOOP_LAG_SHED_THRESHOLD_MS = float(os.environ.get("LOOP_LAG_SHED_THRESHOLD_MS", "250"))
+LOOP_LAG_READINESS_THRESHOLD_MS = float(
+    os.environ.get("LOOP_LAG_READINESS_THRESHOLD_MS", "1000")
+)
+LOOP_LAG_RETRY_AFTER_SECONDS = int(os.environ.get("LOOP_LAG_RETRY_AFTER_SECONDS", "2"))
+
+# /middleware/batch fans a list of chat or converse requests out concurrently
+BATCH_MAX_REQUESTS = int(os.environ.get("BATCH_MAX_REQUESTS", "1000"))
+BATCH_MAX_PARALLELISM = int(os.environ.get("BATCH_MAX_PARALLELISM", "8"))
+
+# Nagle-style coalescing of streamed content deltas. Consecutive deltas are held
+# for up to DELTA_COALESCE_MAX_DELAY_MS or DELTA_COALESCE_MAX_CHARS and sent as
+# one frame; the first delta is never held. Enabled per route ("openai",
+# "bedrock") or per request with the X-Delta-Coalescing header ("on", "off" or
+# a delay in milliseconds).
+DELTA_COALESCING_ROUTES = {
+    route.strip()
+    for route in os.environ.get("DELTA_COALESCING_ROUTES", "").split(",")
+    if route.strip()
+}
+DELTA_COALESCE_MAX_DELAY_MS = float(os.environ.get("DELTA_COALESCE_MAX_DELAY_MS", "20"))
+DELTA_COALESCE_MAX_CHARS = int(os.environ.get("DELTA_COALESCE_MAX_CHARS", "1024"))
+
+# Bedrock managed prompts are cached: numbered versions forever, DRAFT for
+# PROMPT_CACHE_DRAFT_TTL_SECONDS. PROMPT_CACHE_PRELOAD_ARNS (comma-separated)
+# are fetched at startup.
+PROMPT_CACHE_DRAFT_TTL_SECONDS = float(
+    os.environ.get("PROMPT_CACHE_DRAFT_TTL_SECONDS", "60")
+)
+PROMPT_CACHE_PRELOAD_ARNS = [
+    arn.strip()
+    for arn in os.environ.get("PROMPT_CACHE_PRELOAD_ARNS", "").split(",")
+    if arn.strip()
+]
+
+# Variant selection for managed prompts with several variants. Latency and
+# error EWMAs are tracked per variant from live traffic, in separate series for
+# streams (time to first token) and non-streaming requests (full response
+# time); each request is routed on its own kind's series. PROMPT_VARIANT_POLICY is one of "first" (always variants[0]),
+# "fastest", "cheapest_under_slo" (cheapest variant, by PROMPT_VARIANT_COSTS,
+# whose latency is within PROMPT_VARIANT_SLO_MS and error rate within
+# PROMPT_VARIANT_MAX_ERROR_RATE) or "weighted" (random, weighted by inverse
+# latency). Each variant is tried PROMPT_VARIANT_MIN_SAMPLES times before the
+# policy applies, and PROMPT_VARIANT_EXPLORE_RATE of requests go to a random
+# variant so stats stay current.
+PROMPT_VARIANT_POLICY = os.environ.get("PROMPT_VARIANT_POLICY", "first").lower()
+PROMPT_VARIANT_EWMA_ALPHA = float(os.environ.get("PROMPT_VARIANT_EWMA_ALPHA", "0.2"))
+PROMPT_VARIANT_MIN_SAMPLES = int(os.environ.get("PROMPT_VARIANT_MIN_SAMPLES", "5"))
+PROMPT_VARIANT_EXPLORE_RATE = float(
+    os.environ.get("PROMPT_VARIANT_EXPLORE_RATE", "0.05")
+)
+PROMPT_VARIANT_SLO_MS = float(os.environ.get("PROMPT_VARIANT_SLO_MS", "2000"))
+PROMPT_VARIANT_MAX_ERROR_RATE = float(
+    os.environ.get("PROMPT_VARIANT_MAX_ERROR_RATE", "0.1")
+)
+# JSON object of model id -> relative cost, e.g. {"gpt-4o": 10, "gpt-4o-mini": 1}
+PROMPT_VARIANT_COSTS = json_codec.loads(os.environ.get("PROMPT_VARIANT_COSTS", "{}"))
+
+# Optional clients (the Okta verifier, the Redis module) are created on first
+# use. With LAZY_INIT_PREWARM they are also warmed in a worker thread right
+# after startup, off the readiness path.
+LAZY_INIT_PREWARM = os.environ.get("LAZY_INIT_PREWARM", "true").lower() == "true"
+
+# Optional API key validation against LiteLLM's /key/info before any database
+# or upstream work. Valid keys are cached for API_KEY_VALIDATION_TTL_SECONDS
+# (never past the key's own expiry), rejected keys for
+# API_KEY_VALIDATION_NEGATIVE_TTL_SECONDS. If LiteLLM can't answer, the request
+# proceeds and LiteLLM enforces the key as before.
+API_KEY_VALIDATION = os.environ.get("API_KEY_VALIDATION", "false").lower() == "true"
+API_KEY_VALIDATION_TTL_SECONDS = float(
+    os.environ.get("API_KEY_VALIDATION_TTL_SECONDS", "300")
+)
+API_KEY_VALIDATION_NEGATIVE_TTL_SECONDS = float(
+    os.environ.get("API_KEY_VALIDATION_NEGATIVE_TTL_SECONDS", "30")
+)
+API_KEY_VALIDATION_MAX_ENTRIES = int(
+    os.environ.get("API_KEY_VALIDATION_MAX_ENTRIES", "10000")
+)
+
+# Okta access tokens are verified offline against the issuer's JWKS, which is
+# fetched at startup and refreshed every OKTA_JWKS_REFRESH_SECONDS (and on an
+# unknown key id, at most once per OKTA_JWKS_MIN_REFRESH_SECONDS). Verified
+# tokens are cached by hash until they expire. OKTA_JWKS_URI overrides the
+# keys endpoint derived from OKTA_ISSUER, e.g. for a local stand-in issuer.
+OKTA_JWKS_URI = os.environ.get("OKTA_JWKS_URI")
+OKTA_JWKS_REFRESH_SECONDS = float(os.environ.get("OKTA_JWKS_REFRESH_SECONDS", "3600"))
+OKTA_JWKS_MIN_REFRESH_SECONDS = float(
+    os.environ.get("OKTA_JWKS_MIN_REFRESH_SECONDS", "30")
+)
+OKTA_LEEWAY_SECONDS = int(os.environ.get("OKTA_LEEWAY_SECONDS", "120"))
+OKTA_TOKEN_CACHE_MAX_ENTRIES = int(
+    os.environ.get("OKTA_TOKEN_CACHE_MAX_ENTRIES", "10000")
+)
+
+# Prometheus metrics, served at /metrics. With several worker processes, set
+# PROMETHEUS_MULTIPROC_DIR to a shared, empty directory: each process then
+# writes its samples to memory-mapped files that /metrics aggregates. Model
+# labels are capped at METRICS_MAX_MODELS distinct values ("other" beyond).
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() == "true"
+METRICS_MAX_MODELS = int(os.environ.get("METRICS_MAX_MODELS", "100"))
+
+# OpenTelemetry tracing. TRACING_EXPORTER is "otlp" (OTLP/HTTP, configured by
+# the standard OTEL_EXPORTER_OTLP_* variables; defaults to a local collector on
+# :4318) or "file" (one JSON span per line in TRACING_FILE, for tests). Root
+# spans are kept with probability TRACING_SAMPLE_RATIO; spans with a remote
+# parent follow the caller's sampling decision.
+TRACING_ENABLED = os.environ.get("TRACING_ENABLED", "false").lower() == "true"
+TRACING_EXPORTER = os.environ.get("TRACING_EXPORTER", "otlp")
+TRACING_FILE = os.environ.get("TRACING_FILE", "traces.jsonl")
+TRACING_SAMPLE_RATIO = float(os.environ.get("TRACING_SAMPLE_RATIO", "1.0"))
+TRACING_SERVICE_NAME = os.environ.get("OTEL_SERVICE_NAME", "llm-gateway-middleware")
+
+# Server-Timing response header with per-stage durations (auth, session,
+# prompt, convert, upstream, persist). On for every request with SERVER_TIMING,
+# or per request with an "X-Server-Timing: true" header ("false" opts out).
+# Streams end with one more event carrying the final breakdown and TTFT.
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "false").lower() == "true"
+
+# On-demand profiling with pyinstrument's sampling profiler. A request sent
+# with "X-Middleware-Profile: <master key>" is profiled end to end (streamed
+# body included); POST /middleware/profile?seconds=N profiles everything this
+# worker's event loop runs for N seconds. Nothing is sampled otherwise.
+# Profiles are speedscope JSON or pyinstrument HTML, kept in PROFILE_DIR.
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "/tmp/middleware-profiles")
+PROFILE_INTERVAL_SECONDS = float(os.environ.get("PROFILE_INTERVAL_SECONDS", "0.001"))
+PROFILE_MAX_WINDOW_SECONDS = float(os.environ.get("PROFILE_MAX_WINDOW_SECONDS", "60"))
+PROFILE_MAX_FILES = int(os.environ.get("PROFILE_MAX_FILES", "50"))
+
+# Named callables returning JSON-serializable stats, served by /middleware/stats
+middleware_stats = {}
+middleware_stats["logging"] = log_writer.stats
+
+# The Okta verifier is created on first use; okta_jwt_verifier is only imported
+# when Okta JWT auth is configured
+if not (OKTA_AUDIENCE and OKTA_ISSUER):
+    log_event(
+        logging.INFO,
+        "OKTA_AUDIENCE or OKTA_ISSUER are empty. Support for Okta JWT Auth is disabled.",
     )
-else:
-    print(
-        f"OKTA_AUDIENCE or OKTA_ISSUER are empty. Support for Okta JWT Auth is disabled."
+
+
+def okta_jwks_uri(issuer: str) -> str:
+    """The keys endpoint okta_jwt_verifier derives from an issuer URL."""
+    jwks_uri_base = issuer if issuer.endswith("/") else issuer + "/"
+    if "/oauth2/" not in jwks_uri_base:
+        jwks_uri_base = urljoin(jwks_uri_base, "oauth2/")
+    return urljoin(jwks_uri_base, "v1/keys")
+
+
+class OktaTokenVerifier:
+    """
+    Verifies Okta access tokens (RS256, iss/aud/exp) with okta_jwt_verifier's
+    JWTUtils, but keeps the JWKS itself: it is prefetched, refreshed in the
+    background and refetched when a token names an unknown key id, so
+    verification never waits on the network for known keys. Verified tokens
+    are cached by SHA-256 until their exp; when a refresh drops a key, cached
+    tokens signed with it are evicted.
+    """
+
+    def __init__(
+        self,
+        issuer: str,
+        audience: str,
+        jwks_uri: str,
+        refresh_interval: float,
+        min_refresh_interval: float,
+        leeway: int,
+        max_entries: int,
+    ):
+        self.issuer = issuer
+        self.audience = audience
+        self.jwks_uri = jwks_uri
+        self.refresh_interval = refresh_interval
+        self.min_refresh_interval = min_refresh_interval
+        self.leeway = leeway
+        self.max_entries = max_entries
+        self.jwt_utils = importlib.import_module("okta_jwt_verifier.jwt_utils").JWTUtils
+        self.keys = {}
+        self.fetched_at = None
+        self._refreshing = None
+        self._refresh_task = None
+        self._tokens = collections.OrderedDict()
+        self.counters = collections.Counter()
+
+    def start(self):
+        """Prefetches the JWKS and keeps refreshing it in the background."""
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def _refresh_loop(self):
+        while True:
+            try:
+                await self.refresh()
+                delay = self.refresh_interval
+            except Exception as e:
+                log_event(logging.WARNING, "Okta JWKS refresh failed", error=str(e))
+                delay = self.min_refresh_interval
+            await asyncio.sleep(delay)
+
+    async def refresh(self):
+        # Concurrent callers share one fetch
+        if self._refreshing is None:
+            self._refreshing = asyncio.ensure_future(self._fetch_keys())
+        await asyncio.shield(self._refreshing)
+
+    async def _fetch_keys(self):
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(
+                    self.jwks_uri, timeout=aiohttp.ClientTimeout(total=10)
+                ) as resp:
+                    resp.raise_for_status()
+                    jwks = json_codec.loads(await resp.read())
+        finally:
+            self._refreshing = None
+        keys = {key["kid"]: key for key in jwks.get("keys", []) if "kid" in key}
+        retired = self.keys.keys() - keys.keys()
+        if retired:
+            log_event(
+                logging.INFO, "Okta signing keys rotated out", kids=sorted(retired)
+            )
+            for token_hash, (_, _, kid) in list(self._tokens.items()):
+                if kid in retired:
+                    del self._tokens[token_hash]
+        self.keys = keys
+        self.fetched_at = time.monotonic()
+        self.counters["jwks_fetches"] += 1
+
+    async def get_key(self, kid: str) -> Dict[str, Any]:
+        key = self.keys.get(kid)
+        if key is None and (
+            self.fetched_at is None
+            or time.monotonic() - self.fetched_at >= self.min_refresh_interval
+        ):
+            # Possibly a newly rotated-in key
+            await self.refresh()
+            key = self.keys.get(kid)
+        if key is None:
+            raise ValueError("No matching JWK")
+        return key
+
+    async def verify(self, token: str) -> Dict[str, Any]:
+        """Returns the token's claims, raising if it isn't a valid access token."""
+        token_hash = hashlib.sha256(token.encode("utf-8")).hexdigest()
+        entry = self._tokens.get(token_hash)
+        if entry is not None:
+            claims, expires_at, _ = entry
+            if time.time() < expires_at:
+                self._tokens.move_to_end(token_hash)
+                self.counters["hits"] += 1
+                return claims
+            del self._tokens[token_hash]
+
+        self.counters["misses"] += 1
+        self.start()
+        headers, claims, _, _ = self.jwt_utils.parse_token(token)
+        if headers.get("alg") != "RS256":
+            raise ValueError('Header claim "alg" is invalid.')
+        self.jwt_utils.verify_claims(
+            claims, ("iss", "aud", "exp"), self.audience, self.issuer, self.leeway
+        )
+        key = await self.get_key(headers.get("kid"))
+        self.jwt_utils.verify_signature(token, key)
+
+        self._tokens[token_hash] = (claims, claims["exp"], headers.get("kid"))
+        while len(self._tokens) > self.max_entries:
+            self._tokens.popitem(last=False)
+        return claims
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "keys": len(self.keys),
+            "cached_tokens": len(self._tokens),
+        }
+
+
+@lru_cache(maxsize=None)
+def get_access_token_verifier() -> Optional[OktaTokenVerifier]:
+    """Returns the Okta access token verifier, or None when Okta is disabled."""
+    if not (OKTA_AUDIENCE and OKTA_ISSUER):
+        return None
+    verifier = OktaTokenVerifier(
+        OKTA_ISSUER,
+        OKTA_AUDIENCE,
+        OKTA_JWKS_URI or okta_jwks_uri(OKTA_ISSUER),
+        OKTA_JWKS_REFRESH_SECONDS,
+        OKTA_JWKS_MIN_REFRESH_SECONDS,
+        OKTA_LEEWAY_SECONDS,
+        OKTA_TOKEN_CACHE_MAX_ENTRIES,
     )
+    middleware_stats["okta"] = verifier.stats
+    return verifier
 
 
 def setup_database():
     to_thread.current_default_thread_limiter().total_tokens = 1000
-    print("Thread limiter configured")
-    print(f"setting up database")
+    log_event(logging.INFO, "Thread limiter configured")
+    log_event(logging.INFO, "setting up database")
     try:
         database_url = os.environ.get("DATABASE_MIDDLEWARE_URL")
         if not database_url:
-            print(f"DATABASE_MIDDLEWARE_URL environment variable not set")
+            log_event(
+                logging.ERROR, "DATABASE_MIDDLEWARE_URL environment variable not set"
+            )
             raise ValueError("DATABASE_MIDDLEWARE_URL environment variable not set")
 
-        # Parse the URL to get base connection to postgres database
-        url_parts = database_url.rsplit("/", 1)
-        base_url = f"{url_parts[0]}/postgres"
-        temp_engine = create_engine(base_url)
+        # Parse the URL to get base connection to postgres database
+        url_parts = database_url.rsplit("/", 1)
+        base_url = f"{url_parts[0]}/postgres"
+        temp_engine = create_engine(base_url)
+
+        # Check if middleware database exists
+        with temp_engine.connect() as conn:
+            conn.execute(text("COMMIT"))  # Close any open transaction
+            result = conn.execute(
+                text("SELECT 1 FROM pg_database WHERE datname = 'middleware'")
+            )
+            if not result.scalar():
+                # Database doesn't exist, create it
+                conn.execute(text("COMMIT"))  # Ensure we're not in a transaction
+                conn.execute(text("CREATE DATABASE middleware"))
+                log_event(logging.INFO, "Created middleware database")
+
+        # Now connect to the middleware database using modified URL
+        engine = create_engine(f"{url_parts[0]}/middleware")
+        metadata_obj = MetaData()
+
+        # Rest of your existing code remains the same
+        with engine.begin() as conn:
+            inspector = inspect(engine)
+            if "chat_sessions" not in inspector.get_table_names():
+                chat_sessions_table = Table(
+                    "chat_sessions",
+                    metadata_obj,
+                    Column("session_id", String, primary_key=True),
+                    Column("chat_history", Text),
+                    Column("api_key_hash", String),
+                )
+                metadata_obj.create_all(engine)
+                log_event(logging.INFO, "Created chat_sessions table")
+            else:
+                chat_sessions_table = Table(
+                    "chat_sessions", metadata_obj, autoload_with=engine
+                )
+                columns = [c.name for c in chat_sessions_table.columns]
+                if "api_key_hash" not in columns:
+                    conn.execute(
+                        text(
+                            "ALTER TABLE chat_sessions ADD COLUMN api_key_hash VARCHAR;"
+                        )
+                    )
+                else:
+                    log_event(
+                        logging.INFO,
+                        "chat_sessions table already exists with api_key_hash column",
+                    )
+
+            # Check and create index within the same transaction
+            indexes = inspector.get_indexes("chat_sessions")
+            index_names = [idx["name"] for idx in indexes]
+
+            if "idx_chat_sessions_api_key_hash" not in index_names:
+                log_event(logging.INFO, "Creating index idx_chat_sessions_api_key_hash")
+                conn.execute(
+                    text(
+                        "CREATE INDEX idx_chat_sessions_api_key_hash ON chat_sessions (api_key_hash)"
+                    )
+                )
+                log_event(logging.INFO, "Index created successfully")
+
+        # Verify table exists after transaction commits
+        with engine.connect() as conn:
+            result = conn.execute(
+                text(
+                    "SELECT EXISTS (SELECT 1 FROM information_schema.tables WHERE table_name = 'chat_sessions')"
+                )
+            )
+            if not result.scalar():
+                raise Exception(
+                    "Table creation failed - table does not exist after create_all()"
+                )
+            log_event(logging.INFO, "Table verification successful")
+
+        return engine, chat_sessions_table
+
+    except SQLAlchemyError as e:
+        log_event(logging.ERROR, "Database setup error", error=str(e))
+        raise
+    except Exception as e:
+        log_event(logging.ERROR, "Database setup error", error=str(e))
+        raise
+
+
+@app.on_event("startup")
+async def startup_event():
+    log_event(logging.INFO, "doing startup_event")
+    global db_engine, chat_sessions
+    db_engine, chat_sessions = setup_database()
+    batch_jobs.setup_batch_tables(db_engine)
+    loop_lag_monitor.start()
+    batch_jobs.start_batch_workers()
+    if PROMPT_CACHE_PRELOAD_ARNS:
+        await prompt_cache.preload(PROMPT_CACHE_PRELOAD_ARNS)
+    if LAZY_INIT_PREWARM:
+        # Warm optional clients after startup so the first request that needs
+        # them doesn't pay for the imports, without delaying readiness
+        prewarm_tasks.append(asyncio.create_task(prewarm_optional_clients()))
+
+
+prewarm_tasks = []
+
+
+async def prewarm_optional_clients():
+    started = time.perf_counter()
+    access_token_verifier = await to_thread.run_sync(get_access_token_verifier)
+    if access_token_verifier:
+        access_token_verifier.start()
+    if RESPONSE_CACHE and RESPONSE_CACHE_REDIS and REDIS_HOST:
+        await to_thread.run_sync(import_optional, "redis.asyncio")
+    log_event(
+        logging.INFO,
+        "Prewarmed optional clients",
+        seconds=round(time.perf_counter() - started, 3),
+    )
+
+
+def hash_api_key(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+def key_seconds_remaining(info: Dict[str, Any]) -> Optional[float]:
+    """Seconds until a /key/info key expires, or None if it never does."""
+    expires = info.get("expires")
+    if not expires:
+        return None
+    try:
+        expires_at = datetime.fromisoformat(expires.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    return (expires_at - datetime.now(timezone.utc)).total_seconds()
+
+
+class InvalidApiKey(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=401, detail={"error": "Invalid API key"})
+
+
+class ApiKeyValidator:
+    """
+    Caches LiteLLM /key/info lookups by key hash. Concurrent lookups for the
+    same key share one request. Lookups that fail for reasons other than the
+    key itself (LiteLLM down, 5xx, or a 403 for a key that may not read its
+    own info) are not cached and don't reject the key.
+    """
+
+    def __init__(self, positive_ttl: float, negative_ttl: float, max_entries: int):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._inflight = {}
+        self.counters = collections.Counter()
+
+    async def validate(self, api_key: str, api_key_hash: str):
+        if MASTER_KEY and api_key == MASTER_KEY:
+            return
+        entry = self._entries.get(api_key_hash)
+        if entry is not None and entry[1] > time.monotonic():
+            self._entries.move_to_end(api_key_hash)
+            self.counters["hits"] += 1
+            valid = entry[0]
+        else:
+            inflight = self._inflight.get(api_key_hash)
+            if inflight is not None:
+                self.counters["coalesced"] += 1
+            else:
+                self.counters["misses"] += 1
+                inflight = asyncio.ensure_future(self._load(api_key, api_key_hash))
+                self._inflight[api_key_hash] = inflight
+            valid = await asyncio.shield(inflight)
+        if valid is False:
+            self.counters["rejected"] += 1
+            raise InvalidApiKey()
+
+    async def _load(self, api_key: str, api_key_hash: str) -> Optional[bool]:
+        # Runs as its own task so a cancelled caller doesn't discard the result
+        try:
+            valid, ttl = await self._lookup(api_key)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log_event(logging.WARNING, "API key validation unavailable", error=str(e))
+            self.counters["errors"] += 1
+            return None
+        finally:
+            self._inflight.pop(api_key_hash, None)
+        if valid is not None:
+            self._entries[api_key_hash] = (valid, time.monotonic() + ttl)
+            self._entries.move_to_end(api_key_hash)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return valid
+
+    async def _lookup(self, api_key: str) -> (Optional[bool], float):
+        """Returns (valid, ttl); valid is None when LiteLLM couldn't say."""
+        async with aiohttp.ClientSession() as session:
+            async with session.get(
+                f"{LITELLM_ENDPOINT}/key/info",
+                headers={"Authorization": f"Bearer {api_key}"},
+                timeout=aiohttp.ClientTimeout(total=5),
+            ) as resp:
+                if resp.status in (400, 401, 404):
+                    return False, self.negative_ttl
+                if resp.status == 403:
+                    # A valid key whose allowed_routes exclude /key/info
+                    self.counters["forbidden"] += 1
+                    return None, 0
+                if resp.status != 200:
+                    self.counters["errors"] += 1
+                    return None, 0
+                info = json_codec.loads(await resp.read()).get("info") or {}
+
+        if info.get("blocked"):
+            return False, self.negative_ttl
+        ttl = self.positive_ttl
+        remaining = key_seconds_remaining(info)
+        if remaining is not None:
+            if remaining <= 0:
+                return False, self.negative_ttl
+            ttl = min(ttl, remaining)
+        return True, ttl
+
+    def invalidate(self):
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "entries": len(self._entries),
+        }
+
+
+api_key_validator = ApiKeyValidator(
+    API_KEY_VALIDATION_TTL_SECONDS,
+    API_KEY_VALIDATION_NEGATIVE_TTL_SECONDS,
+    API_KEY_VALIDATION_MAX_ENTRIES,
+)
+middleware_stats["api_keys"] = api_key_validator.stats
+
+
+async def validate_api_key(api_key: str, request: Optional[Request] = None) -> str:
+    """
+    Returns the key's hash, rejecting keys LiteLLM doesn't know with a 401
+    when API_KEY_VALIDATION is on. Call before touching sessions. Batch
+    workers call with their job's own key; given their `request`, the hash is
+    the batch submitter's, so sessions, admission and caching stay theirs.
+    """
+    if request is not None:
+        # Only set server-side, by batch_jobs.batch_worker_request
+        on_behalf_of = request.scope.get("state", {}).get("on_behalf_of")
+        if on_behalf_of:
+            return on_behalf_of["api_key_hash"]
+    api_key_hash = hash_api_key(api_key)
+    if API_KEY_VALIDATION:
+        with timing_stage("auth"), tracing.span("auth.validate_api_key"):
+            await api_key_validator.validate(api_key, api_key_hash)
+    return api_key_hash
+
+
+def require_master_key(request: Request):
+    auth_header = request.headers.get("Authorization")
+    if not MASTER_KEY or auth_header != f"Bearer {MASTER_KEY}":
+        raise HTTPException(
+            status_code=401, detail={"error": "Master key required for this endpoint"}
+        )
+
+
+def get_request_deadline(model_id: Optional[str]) -> float:
+    return float(MODEL_REQUEST_DEADLINES.get(model_id, REQUEST_DEADLINE_SECONDS))
+
+
+def should_record_response(completed: bool, content_parts: List[str]) -> bool:
+    return completed or (PARTIAL_RESPONSE_POLICY == "save" and bool(content_parts))
+
+
+class DisconnectAwareStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that always listens for http.disconnect, whatever ASGI spec
+    version the server reports. When the client goes away the body iterator is
+    cancelled at its current await, so generators stop pulling from LiteLLM and
+    their finally blocks release the upstream connection straight away.
+    """
+
+    async def __call__(self, scope, receive, send) -> None:
+        async with anyio.create_task_group() as task_group:
+
+            async def stream_response():
+                try:
+                    await self.stream_response(send)
+                except OSError:
+                    log_event(logging.DEBUG, "Client disconnected while streaming")
+                task_group.cancel_scope.cancel()
+
+            async def listen_for_disconnect():
+                await self.listen_for_disconnect(receive)
+                task_group.cancel_scope.cancel()
+
+            task_group.start_soon(stream_response)
+            await listen_for_disconnect()
+
+        if self.background is not None:
+            await self.background()
+
+
+class StreamBufferPool:
+    """
+    Accounts for the bytes buffered by every active stream and enforces the
+    process-wide budget.
+    """
+
+    def __init__(self, total_max_bytes: int):
+        self.total_max_bytes = total_max_bytes
+        self.total_bytes = 0
+        self.peak_total_bytes = 0
+        self.peak_stream_bytes = 0
+        self.stalls = 0
+        self.buffers = set()
+        self._room = asyncio.Event()
+        self._room.set()
+
+    def has_room(self, size: int) -> bool:
+        return self.total_bytes + size <= self.total_max_bytes
+
+    async def wait_for_room(self):
+        self.stalls += 1
+        self._room.clear()
+        await self._room.wait()
+
+    def add(self, size: int):
+        self.total_bytes += size
+        if self.total_bytes > self.peak_total_bytes:
+            self.peak_total_bytes = self.total_bytes
+
+    def remove(self, size: int):
+        self.total_bytes -= size
+        if self.total_bytes < self.total_max_bytes:
+            self._room.set()
+
+    def stats(self) -> Dict[str, Any]:
+        per_stream = [buffer.buffered_bytes for buffer in self.buffers]
+        return {
+            "streams": len(per_stream),
+            "buffered_bytes": self.total_bytes,
+            "peak_buffered_bytes": self.peak_total_bytes,
+            "max_stream_buffered_bytes": max(per_stream, default=0),
+            "peak_stream_buffered_bytes": self.peak_stream_bytes,
+            "stream_max_bytes": STREAM_BUFFER_MAX_BYTES,
+            "total_max_bytes": self.total_max_bytes,
+            "stalls": self.stalls,
+        }
+
+
+class StreamBuffer:
+    """
+    Bounded FIFO between the upstream reader and the client writer of one stream.
+    put() waits while this stream or the whole process is over budget. While it
+    waits nothing reads from LiteLLM, so the aiohttp/httpx socket buffers fill,
+    the transport pauses reading and TCP flow control pushes back on LiteLLM.
+    """
+
+    def __init__(self, pool: StreamBufferPool, max_bytes: int):
+        self.pool = pool
+        self.max_bytes = max_bytes
+        self.buffered_bytes = 0
+        self.peak_bytes = 0
+        self._chunks = collections.deque()
+        self._closed = False
+        self._readable = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+
+    async def put(self, chunk: bytes):
+        size = len(chunk)
+        # An empty buffer always takes one chunk, so oversized chunks can't deadlock
+        while self.buffered_bytes and self.buffered_bytes + size > self.max_bytes:
+            self.pool.stalls += 1
+            self._writable.clear()
+            await self._writable.wait()
+        while self.buffered_bytes and not self.pool.has_room(size):
+            await self.pool.wait_for_room()
+
+        self._chunks.append(chunk)
+        self.buffered_bytes += size
+        if self.buffered_bytes > self.peak_bytes:
+            self.peak_bytes = self.buffered_bytes
+            if self.peak_bytes > self.pool.peak_stream_bytes:
+                self.pool.peak_stream_bytes = self.peak_bytes
+        self.pool.add(size)
+        self._readable.set()
+
+    async def get(self) -> Optional[bytes]:
+        while not self._chunks:
+            if self._closed:
+                return None
+            self._readable.clear()
+            await self._readable.wait()
+
+        chunk = self._chunks.popleft()
+        self.buffered_bytes -= len(chunk)
+        self.pool.remove(len(chunk))
+        self._writable.set()
+        return chunk
+
+    def close(self):
+        self._closed = True
+        self._readable.set()
+
+    def discard(self):
+        self.pool.remove(self.buffered_bytes)
+        self.buffered_bytes = 0
+        self._chunks.clear()
+
+
+stream_buffer_pool = StreamBufferPool(STREAM_BUFFER_TOTAL_MAX_BYTES)
+middleware_stats["stream_buffers"] = stream_buffer_pool.stats
+
+
+class CoalescedStream:
+    """
+    One upstream stream fanned out to every subscriber. Chunks are kept for the
+    lifetime of the flight so late joiners replay from the first event. The
+    upstream is cancelled once the last subscriber goes away.
+    """
+
+    def __init__(self, open_stream, on_done):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+        self._on_done = on_done
+        self.headers = asyncio.get_running_loop().create_future()
+        self.task = asyncio.ensure_future(self._run(open_stream))
+
+    async def _run(self, open_stream):
+        try:
+            response_headers, events = await open_stream()
+            self.headers.set_result(response_headers)
+            async for chunk in events:
+                self.chunks.append(chunk)
+                self._notify()
+        except BaseException as e:
+            self.error = e
+            if not self.headers.done():
+                self.headers.set_exception(e)
+                # Retrieved by whoever awaits the headers; avoid "never retrieved"
+                self.headers.exception()
+        finally:
+            self.done = True
+            self._notify()
+            self._on_done(self)
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def subscribe(self) -> AsyncGenerator:
+        index = 0
+        try:
+            while True:
+                changed = self._changed
+                if index < len(self.chunks):
+                    chunk = self.chunks[index]
+                    index += 1
+                    yield chunk
+                elif self.done:
+                    if self.error is not None and not isinstance(
+                        self.error, asyncio.CancelledError
+                    ):
+                        raise self.error
+                    return
+                else:
+                    await changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                self.task.cancel()
+
+
+class RequestCoalescer:
+    """
+    Single-flight for identical deterministic requests. Requests are keyed by
+    the API key hash plus the normalized request (sorted keys), so only the
+    same caller can share a response. At most max_waiters requests join one flight; the rest
+    go upstream on their own.
+    """
+
+    def __init__(self, max_waiters: int):
+        self.max_waiters = max_waiters
+        self.requests = 0
+        self.upstream_calls = 0
+        self.coalesced = 0
+        self.overflow = 0
+        self._calls = {}
+        self._streams = {}
+
+    @staticmethod
+    def is_eligible(data: Dict[str, Any], history_enabled: bool) -> bool:
+        # Session requests read and write per-session state, so never share them
+        return not history_enabled and data.get("temperature") == 0
+
+    @staticmethod
+    def make_key(api_key_hash: str, canonical_request: bytes) -> str:
+        digest = hashlib.sha256(api_key_hash.encode("utf-8"))
+        digest.update(canonical_request)
+        return digest.hexdigest()
+
+    async def call(self, key: str, fn):
+        self.requests += 1
+        entry = self._calls.get(key)
+        if entry is not None:
+            if entry["waiters"] < self.max_waiters:
+                entry["waiters"] += 1
+                self.coalesced += 1
+                return await asyncio.shield(entry["task"])
+            self.overflow += 1
+            return await fn()
+
+        # The call runs in its own task so a disconnecting leader doesn't cancel
+        # it for the other waiters
+        task = asyncio.ensure_future(fn())
+        entry = {"task": task, "waiters": 1}
+        self._calls[key] = entry
+        self.upstream_calls += 1
+
+        def on_done(finished):
+            if self._calls.get(key) is entry:
+                del self._calls[key]
+            if not finished.cancelled():
+                finished.exception()
+
+        task.add_done_callback(on_done)
+        return await asyncio.shield(task)
+
+    async def stream(self, key: str, open_stream) -> (Dict[str, str], AsyncGenerator):
+        self.requests += 1
+        flight = self._streams.get(key)
+        if flight is not None and flight.subscribers >= self.max_waiters:
+            self.overflow += 1
+            return await open_stream()
+
+        if flight is None:
+
+            def on_done(finished):
+                if self._streams.get(key) is finished:
+                    del self._streams[key]
+
+            flight = CoalescedStream(open_stream, on_done)
+            self._streams[key] = flight
+            self.upstream_calls += 1
+        else:
+            self.coalesced += 1
+
+        flight.subscribers += 1
+        try:
+            response_headers = await asyncio.shield(flight.headers)
+        except BaseException:
+            flight.subscribers -= 1
+            raise
+        return response_headers, flight.subscribe()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": REQUEST_COALESCING,
+            "requests": self.requests,
+            "upstream_calls": self.upstream_calls,
+            "coalesced": self.coalesced,
+            "overflow": self.overflow,
+            "dedup_ratio": self.coalesced / self.requests if self.requests else 0.0,
+            "in_flight": len(self._calls) + len(self._streams),
+            "max_waiters": self.max_waiters,
+        }
+
+
+request_coalescer = RequestCoalescer(COALESCE_MAX_WAITERS)
+middleware_stats["coalescing"] = request_coalescer.stats
+
+
+class ResponseCache:
+    """
+    Two-tier exact-match cache of encoded response bodies. Keys are
+    "<api_key_hash>:<route>:<sha256 of the canonical request>", so entries are
+    scoped to a tenant and a tenant's entries can be purged by prefix.
+    """
+
+    REDIS_PREFIX = "middleware:response-cache:"
+
+    def __init__(self, max_entries: int, max_bytes: int, default_ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.total_bytes = 0
+        self._entries = collections.OrderedDict()
+        self._redis = None
+        self.counters = collections.Counter()
+
+    @staticmethod
+    def is_eligible(data: Dict[str, Any], history_enabled: bool) -> bool:
+        if history_enabled:
+            return False
+        return not RESPONSE_CACHE_DETERMINISTIC_ONLY or data.get("temperature") == 0
+
+    @staticmethod
+    def make_key(api_key_hash: str, route: str, canonical_request: bytes) -> str:
+        return f"{api_key_hash}:{route}:{hashlib.sha256(canonical_request).hexdigest()}"
+
+    def get_redis(self):
+        if self._redis is None and RESPONSE_CACHE_REDIS and REDIS_HOST:
+            aioredis = import_optional("redis.asyncio")
+            if aioredis is None:
+                return None
+            self._redis = aioredis.Redis(
+                host=REDIS_HOST,
+                port=REDIS_PORT,
+                password=REDIS_PASSWORD,
+                ssl=REDIS_SSL,
+                socket_timeout=0.5,
+            )
+        return self._redis
+
+    def _store_local(self, key: str, stored_at: float, ttl: float, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        self._drop_local(key)
+        self._entries[key] = (stored_at, stored_at + ttl, value)
+        self.total_bytes += len(value)
+        while (
+            len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes
+        ):
+            _, (_, _, evicted) = self._entries.popitem(last=False)
+            self.total_bytes -= len(evicted)
+            self.counters["evictions"] += 1
+
+    def _drop_local(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= len(entry[2])
+
+    async def get(self, key: str, max_age: Optional[float] = None) -> Optional[bytes]:
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            stored_at, expires_at, value = entry
+            if expires_at <= now:
+                self._drop_local(key)
+                self.counters["expirations"] += 1
+            elif max_age is None or now - stored_at <= max_age:
+                self._entries.move_to_end(key)
+                self.counters["local_hits"] += 1
+                return value
+
+        redis_client = self.get_redis()
+        if redis_client is not None:
+            try:
+                stored = await redis_client.get(self.REDIS_PREFIX + key)
+            except Exception as e:
+                log_event(
+                    logging.WARNING, "Response cache Redis get failed", error=str(e)
+                )
+                self.counters["redis_errors"] += 1
+                stored = None
+            if stored is not None:
+                header, value = stored.split(b"\n", 1)
+                stored_at, expires_at = (float(v) for v in header.split(b" "))
+                if max_age is None or now - stored_at <= max_age:
+                    self.counters["redis_hits"] += 1
+                    local_ttl = min(expires_at - now, RESPONSE_CACHE_LOCAL_TTL_SECONDS)
+                    if local_ttl > 0:
+                        self._store_local(key, stored_at, local_ttl, value)
+                    return value
+
+        self.counters["misses"] += 1
+        return None
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        ttl = self.default_ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        now = time.time()
+        self.counters["stores"] += 1
+        redis_client = self.get_redis()
+        if redis_client is None:
+            self._store_local(key, now, ttl, value)
+            return
+
+        self._store_local(key, now, min(ttl, RESPONSE_CACHE_LOCAL_TTL_SECONDS), value)
+        header = f"{now} {now + ttl}\n".encode("utf-8")
+        try:
+            await redis_client.set(
+                self.REDIS_PREFIX + key, header + value, px=int(ttl * 1000)
+            )
+        except Exception as e:
+            log_event(logging.WARNING, "Response cache Redis set failed", error=str(e))
+            self.counters["redis_errors"] += 1
+
+    async def purge(self, prefix: str = "") -> int:
+        """Removes every entry whose key starts with prefix (all entries if empty)."""
+        purged = 0
+        for key in [k for k in self._entries if k.startswith(prefix)]:
+            self._drop_local(key)
+            purged += 1
+
+        redis_client = self.get_redis()
+        if redis_client is not None:
+            # Redis holds every entry, so its count is the authoritative one
+            purged = 0
+            batch = []
+            async for redis_key in redis_client.scan_iter(
+                match=f"{self.REDIS_PREFIX}{prefix}*", count=500
+            ):
+                batch.append(redis_key)
+                if len(batch) >= 500:
+                    purged += await redis_client.unlink(*batch)
+                    batch = []
+            if batch:
+                purged += await redis_client.unlink(*batch)
+
+        self.counters["purged"] += purged
+        return purged
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = (
+            self.counters["local_hits"]
+            + self.counters["redis_hits"]
+            + self.counters["misses"]
+        )
+        hits = self.counters["local_hits"] + self.counters["redis_hits"]
+        return {
+            "enabled": RESPONSE_CACHE,
+            "redis_enabled": self.get_redis() is not None,
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "hit_ratio": hits / lookups if lookups else 0.0,
+            **self.counters,
+        }
+
+
+def get_cache_directives(
+    request: Request,
+) -> (bool, bool, Optional[float], Optional[float]):
+    """
+    Reads the per-request cache controls:
+      Cache-Control: no-store   -> neither read nor write the cache
+      Cache-Control: no-cache   -> skip the lookup but store the fresh response
+      Cache-Control: max-age=N  -> only accept entries younger than N seconds
+      X-Cache-TTL: N            -> store the response for N seconds
+    Returns (read, write, max_age, ttl).
+    """
+    read = write = True
+    max_age = ttl = None
+    for directive in request.headers.get("Cache-Control", "").lower().split(","):
+        directive = directive.strip()
+        if directive == "no-store":
+            read = write = False
+        elif directive == "no-cache":
+            read = False
+        elif directive.startswith("max-age="):
+            try:
+                max_age = float(directive[len("max-age=") :])
+            except ValueError:
+                pass
+    if "X-Cache-TTL" in request.headers:
+        try:
+            ttl = float(request.headers["X-Cache-TTL"])
+        except ValueError:
+            pass
+    return read, write, max_age, ttl
+
+
+response_cache = ResponseCache(
+    RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL_SECONDS
+)
+middleware_stats["response_cache"] = response_cache.stats
+
+
+class AdmissionRejected(HTTPException):
+    def __init__(self, scope: str, reason: str):
+        super().__init__(
+            status_code=429,
+            detail={
+                "error": f"Too many concurrent requests for this {scope} ({reason})"
+            },
+            headers={"Retry-After": str(ADMISSION_RETRY_AFTER_SECONDS)},
+        )
+
+
+def is_number(value: Any) -> bool:
+    # JSON booleans decode to bool, which is an int subclass
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def is_count(value: Any) -> bool:
+    return is_number(value) and isinstance(value, int) and value >= 0
+
+
+class ConcurrencyLimiter:
+    """
+    Counting semaphore with a bounded FIFO queue. A released slot is handed
+    straight to the oldest waiter, so queued requests can't be overtaken.
+    """
+
+    def __init__(self, concurrency: int, queue_depth: int):
+        self.concurrency = concurrency
+        self.queue_depth = queue_depth
+        self.active = 0
+        self._waiters = collections.deque()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def is_idle(self) -> bool:
+        return self.active == 0 and not self._waiters
+
+    async def acquire(self, scope: str, timeout: float):
+        if self.concurrency <= 0 or (
+            self.active < self.concurrency and not self._waiters
+        ):
+            self.active += 1
+            return
+        if len(self._waiters) >= self.queue_depth:
+            raise AdmissionRejected(scope, "queue full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as we gave up; pass it on
+                self.release()
+            else:
+                waiter.cancel()
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+            if isinstance(e, asyncio.TimeoutError):
+                raise AdmissionRejected(scope, "queue timeout")
+            raise
+
+    def release(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def wake(self):
+        # Called after the limit is raised at runtime
+        while self._waiters and (
+            self.concurrency <= 0 or self.active < self.concurrency
+        ):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.active += 1
+                waiter.set_result(None)
+
+
+class AdmissionTicket:
+    def __init__(self, releases):
+        self._releases = releases
+
+    def release(self):
+        releases, self._releases = self._releases, []
+        for release in reversed(releases):
+            release()
+
+
+class AdmissionController:
+    """
+    Per-API-key and per-model admission. Tickets are stored on the request
+    state and released by AdmissionReleaseMiddleware once the response,
+    including any stream, has finished.
+    """
+
+    def __init__(self):
+        self.config = {
+            "key_concurrency": ADMISSION_KEY_CONCURRENCY,
+            "key_queue_depth": ADMISSION_KEY_QUEUE_DEPTH,
+            "model_concurrency": ADMISSION_MODEL_CONCURRENCY,
+            "model_queue_depth": ADMISSION_MODEL_QUEUE_DEPTH,
+            "queue_timeout_seconds": ADMISSION_QUEUE_TIMEOUT_SECONDS,
+            # {api_key_hash or model: {"concurrency": n, "queue_depth": m}}
+            "key_overrides": {},
+            "model_overrides": {},
+        }
+        self._limiters = {"key": {}, "model": {}}
+        self.counters = collections.Counter()
+        self.queue_wait = {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+
+    def limits_for(self, dimension: str, key: str) -> (int, int):
+        override = self.config[f"{dimension}_overrides"].get(key, {})
+        return (
+            int(override.get("concurrency", self.config[f"{dimension}_concurrency"])),
+            int(override.get("queue_depth", self.config[f"{dimension}_queue_depth"])),
+        )
+
+    def _limiter(self, dimension: str, key: str) -> ConcurrencyLimiter:
+        limiter = self._limiters[dimension].get(key)
+        if limiter is None:
+            limiter = ConcurrencyLimiter(*self.limits_for(dimension, key))
+            self._limiters[dimension][key] = limiter
+        return limiter
+
+    def discard_if_idle(self, dimension: str, key: str, limiter: ConcurrencyLimiter):
+        if limiter.is_idle() and self._limiters[dimension].get(key) is limiter:
+            del self._limiters[dimension][key]
+
+    def _release(self, dimension: str, key: str, limiter: ConcurrencyLimiter):
+        limiter.release()
+        self.discard_if_idle(dimension, key, limiter)
+
+    def validate_config(self, changes: Any):
+        if not isinstance(changes, dict):
+            raise ValueError("Body must be a JSON object")
+        for name, value in changes.items():
+            if name not in self.config:
+                raise ValueError(f"Unknown admission setting: {name}")
+            if name == "queue_timeout_seconds":
+                if not is_number(value) or value <= 0:
+                    raise ValueError(f"{name} must be a positive number")
+            elif name.endswith("_overrides"):
+                if not isinstance(value, dict):
+                    raise ValueError(f"{name} must be an object")
+                for key, override in value.items():
+                    if override is not None and (
+                        not isinstance(override, dict)
+                        or not override.keys() <= {"concurrency", "queue_depth"}
+                        or not all(is_count(limit) for limit in override.values())
+                    ):
+                        raise ValueError(
+                            f"{name}[{key!r}] must be null or an object with "
+                            "non-negative integer concurrency and queue_depth"
+                        )
+            elif not is_count(value):
+                raise ValueError(f"{name} must be a non-negative integer")
+
+    def update_config(self, changes: Dict[str, Any]):
+        """Raises ValueError, leaving the config untouched, if any change is invalid."""
+        self.validate_config(changes)
+        for name, value in changes.items():
+            if name.endswith("_overrides"):
+                self.config[name].update(value)
+                self.config[name] = {k: v for k, v in self.config[name].items() if v}
+            else:
+                self.config[name] = value
+        for dimension, limiters in self._limiters.items():
+            for key, limiter in limiters.items():
+                limiter.concurrency, limiter.queue_depth = self.limits_for(
+                    dimension, key
+                )
+                limiter.wake()
+
+    async def admit(
+        self,
+        request: Request,
+        api_key_hash: str,
+        model: Optional[str],
+        is_streaming: bool = False,
+    ):
+        started = anyio.current_time()
+        acquired = []
+        try:
+            for dimension, key in (("key", api_key_hash), ("model", model or "")):
+                limiter = self._limiter(dimension, key)
+                scope = "API key" if dimension == "key" else "model"
+                try:
+                    await limiter.acquire(scope, self.config["queue_timeout_seconds"])
+                except AdmissionRejected:
+                    self.counters[f"rejected_{dimension}"] += 1
+                    self.discard_if_idle(dimension, key, limiter)
+                    raise
+                acquired.append(partial(self._release, dimension, key, limiter))
+            try:
+                if await fair_scheduler.acquire(
+                    request,
+                    api_key_hash,
+                    is_streaming,
+                    self.config["queue_timeout_seconds"],
+                ):
+                    acquired.append(fair_scheduler.release)
+            except AdmissionRejected:
+                self.counters["rejected_scheduler"] += 1
+                raise
+        except BaseException:
+            AdmissionTicket(acquired).release()
+            raise
+
+        waited = anyio.current_time() - started
+        self.counters["admitted"] += 1
+        self.queue_wait["count"] += 1
+        self.queue_wait["total_seconds"] += waited
+        self.queue_wait["max_seconds"] = max(self.queue_wait["max_seconds"], waited)
+        request.state.admission_ticket = AdmissionTicket(acquired)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "queue_wait": self.queue_wait,
+            "active": {
+                dimension: {
+                    key: {"active": limiter.active, "queued": limiter.queued}
+                    for key, limiter in limiters.items()
+                }
+                for dimension, limiters in self._limiters.items()
+            },
+        }
+
+
+class AdmissionReleaseMiddleware:
+    """Releases the request's admission ticket after the full ASGI response."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            ticket = scope.get("state", {}).get("admission_ticket")
+            if ticket is not None:
+                ticket.release()
+
+
+class FairScheduler:
+    """
+    Start-time fair queuing over a shared pool of slots. Each request gets a
+    finish tag of max(virtual time, tenant's last tag) + 1 / weight; the
+    lowest tag in the highest waiting priority class is served next, so a
+    tenant with a deep backlog can't starve others in the same class.
+    """
+
+    def __init__(self, concurrency: int, tenants: Dict[str, Dict[str, Any]]):
+        self.config = {"concurrency": concurrency, "tenants": dict(tenants)}
+        self.active = 0
+        self.virtual_time = 0.0
+        self._finish_tags = {}
+        self._queues = {name: [] for name in PRIORITY_CLASSES}
+        self._sequence = itertools.count()
+        self.queue_latency = {
+            name: {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+            for name in PRIORITY_CLASSES
+        }
+
+    def classify(self, request: Request, api_key_hash: str, is_streaming: bool):
+        metadata = self.config["tenants"].get(api_key_hash, {})
+        priority = request.headers.get(PRIORITY_HEADER, "").lower()
+        if priority not in PRIORITY_CLASSES:
+            priority = metadata.get(
+                "priority", "interactive" if is_streaming else "default"
+            )
+        tenant = metadata.get("tenant", api_key_hash)
+        return tenant, float(metadata.get("weight", 1)), priority
+
+    def _waiting(self) -> bool:
+        return any(self._queues.values())
+
+    def _record(self, priority: str, waited: float):
+        latency = self.queue_latency[priority]
+        latency["count"] += 1
+        latency["total_seconds"] += waited
+        latency["max_seconds"] = max(latency["max_seconds"], waited)
+
+    async def acquire(
+        self, request: Request, api_key_hash: str, is_streaming: bool, timeout: float
+    ) -> bool:
+        """Waits for a slot. Returns False when scheduling is disabled."""
+        if self.config["concurrency"] <= 0:
+            return False
+
+        tenant, weight, priority = self.classify(request, api_key_hash, is_streaming)
+        tag = max(self.virtual_time, self._finish_tags.get(tenant, 0.0)) + 1 / weight
+        self._finish_tags[tenant] = tag
+        request.state.priority_class = priority
+
+        if self.active < self.config["concurrency"] and not self._waiting():
+            self.active += 1
+            self.virtual_time = tag
+            self._record(priority, 0.0)
+            return True
+
+        started = anyio.current_time()
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queues[priority], (tag, next(self._sequence), waiter))
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            else:
+                # Left in the heap and skipped when popped
+                waiter.cancel()
+            if isinstance(e, asyncio.TimeoutError):
+                raise AdmissionRejected("tenant", "queue timeout")
+            raise
+        self._record(priority, anyio.current_time() - started)
+        return True
+
+    def _next_waiter(self):
+        for priority in PRIORITY_CLASSES:
+            queue = self._queues[priority]
+            while queue:
+                tag, _, waiter = heapq.heappop(queue)
+                if not waiter.done():
+                    self.virtual_time = tag
+                    return waiter
+        return None
+
+    def release(self):
+        waiter = self._next_waiter()
+        if waiter is not None:
+            waiter.set_result(None)
+            return
+        self.active -= 1
+        if self.active == 0:
+            # Idle: tags only matter relative to each other
+            self._finish_tags.clear()
+
+    def validate_config(self, changes: Any):
+        if not isinstance(changes, dict):
+            raise ValueError("Body must be a JSON object")
+        for name, value in changes.items():
+            if name not in self.config:
+                raise ValueError(f"Unknown scheduler setting: {name}")
+            if name == "concurrency":
+                if not is_count(value):
+                    raise ValueError("concurrency must be a non-negative integer")
+                continue
+            if not isinstance(value, dict):
+                raise ValueError("tenants must be an object")
+            for key, metadata in value.items():
+                if metadata is None:
+                    continue
+                if not isinstance(metadata, dict) or not metadata.keys() <= {
+                    "tenant",
+                    "weight",
+                    "priority",
+                }:
+                    raise ValueError(
+                        f"tenants[{key!r}] must be null or an object with "
+                        "tenant, weight and priority"
+                    )
+                if not isinstance(metadata.get("tenant", ""), str):
+                    raise ValueError(f"tenants[{key!r}].tenant must be a string")
+                weight = metadata.get("weight", 1)
+                if not is_number(weight) or weight <= 0:
+                    raise ValueError(
+                        f"tenants[{key!r}].weight must be a positive number"
+                    )
+                if metadata.get("priority", "default") not in PRIORITY_CLASSES:
+                    raise ValueError(
+                        f"tenants[{key!r}].priority must be one of "
+                        f"{', '.join(PRIORITY_CLASSES)}"
+                    )
+
+    def update_config(self, changes: Dict[str, Any]):
+        """Raises ValueError, leaving the config untouched, if any change is invalid."""
+        self.validate_config(changes)
+        for name, value in changes.items():
+            if name == "tenants":
+                self.config[name].update(value)
+                self.config[name] = {k: v for k, v in self.config[name].items() if v}
+            else:
+                self.config[name] = value
+        while self.config["concurrency"] <= 0 or (
+            self.active < self.config["concurrency"]
+        ):
+            waiter = self._next_waiter()
+            if waiter is None:
+                break
+            self.active += 1
+            waiter.set_result(None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": self.active,
+            "queued": {
+                name: sum(1 for _, _, waiter in queue if not waiter.done())
+                for name, queue in self._queues.items()
+            },
+            "queue_latency": self.queue_latency,
+        }
+
+
+class MiddlewareMetrics:
+    """
+    Prometheus instruments for the middleware. Streams are aggregated locally
+    and observed once when they end (mean inter-token latency, tokens per
+    second), so the per-token path never touches a metric. When disabled or
+    prometheus_client isn't installed, every method is a no-op.
+    """
+
+    LATENCY_BUCKETS = (
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1,
+        2.5,
+        5,
+        10,
+        30,
+        60,
+        120,
+        300,
+    )
+    TOKEN_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2)
+    TOKEN_RATE_BUCKETS = (1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 300, 500)
+    SIZE_BUCKETS = tuple(256 * 4**i for i in range(10))  # 256 B .. 64 MiB
+    LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+    def __init__(self, enabled: bool, max_models: int):
+        self.prometheus = import_optional("prometheus_client") if enabled else None
+        self.enabled = self.prometheus is not None
+        self.max_models = max_models
+        self._models = set()
+        if not self.enabled:
+            return
+        histogram = self.prometheus.Histogram
+        self.request_latency = histogram(
+            "middleware_request_duration_seconds",
+            "Time from request to the end of the response, by route and model",
+            ["route", "model", "status"],
+            buckets=self.LATENCY_BUCKETS,
+        )
+        self.upstream_latency = histogram(
+            "middleware_upstream_duration_seconds",
+            "Time for LiteLLM to respond (response headers for streams)",
+            ["route", "model"],
+            buckets=self.LATENCY_BUCKETS,
+        )
+        self.time_to_first_token = histogram(
+            "middleware_time_to_first_token_seconds",
+            "Time from the upstream call to the first streamed content",
+            ["route", "model"],
+            buckets=self.LATENCY_BUCKETS,
+        )
+        self.inter_token_latency = histogram(
+            "middleware_inter_token_latency_seconds",
+            "Mean gap between streamed content chunks, one sample per stream",
+            ["route", "model"],
+            buckets=self.TOKEN_LATENCY_BUCKETS,
+        )
+        self.tokens_per_second = histogram(
+            "middleware_stream_tokens_per_second",
+            "Output tokens per second after the first token, one sample per stream",
+            ["route", "model"],
+            buckets=self.TOKEN_RATE_BUCKETS,
+        )
+        self.db_latency = histogram(
+            "middleware_db_duration_seconds",
+            "Database call latency by operation",
+            ["operation"],
+            buckets=self.LATENCY_BUCKETS,
+        )
+        self.history_size = histogram(
+            "middleware_chat_history_bytes",
+            "Serialized chat history size loaded or stored",
+            ["operation"],
+            buckets=self.SIZE_BUCKETS,
+        )
+        self.streams_in_flight = self.prometheus.Gauge(
+            "middleware_streams_in_flight",
+            "Streaming responses currently open",
+            ["route"],
+            multiprocess_mode="livesum",
+        )
+        self.loop_lag = histogram(
+            "middleware_event_loop_lag_seconds",
+            "How late the event loop lag monitor's periodic sleep woke up",
+            buckets=self.LOOP_LAG_BUCKETS,
+        )
+        self.loop_lag_current = self.prometheus.Gauge(
+            "middleware_event_loop_lag_current_seconds",
+            "Most recent event loop lag sample (the worst worker's)",
+            multiprocess_mode="livemax",
+        )
+
+    def model_label(self, model: Optional[str]) -> str:
+        if not model:
+            return "unknown"
+        if model not in self._models:
+            if len(self._models) >= self.max_models:
+                return "other"
+            self._models.add(model)
+        return model
+
+    def request(self, route: str, model: Optional[str], status: int, seconds: float):
+        if self.enabled:
+            self.request_latency.labels(
+                route, self.model_label(model), str(status)
+            ).observe(seconds)
+
+    def upstream(self, route: str, model: Optional[str], seconds: float):
+        if self.enabled:
+            self.upstream_latency.labels(route, self.model_label(model)).observe(
+                seconds
+            )
+
+    def db(self, operation: str, seconds: float):
+        if self.enabled:
+            self.db_latency.labels(operation).observe(seconds)
+
+    def history(self, operation: str, size: int):
+        if self.enabled:
+            self.history_size.labels(operation).observe(size)
+
+    def event_loop_lag(self, seconds: float):
+        if self.enabled:
+            self.loop_lag.observe(seconds)
+            self.loop_lag_current.set(seconds)
+
+    def stream_started(self, route: str):
+        if self.enabled:
+            self.streams_in_flight.labels(route).inc()
+
+    def stream_finished(
+        self,
+        route: str,
+        model: Optional[str],
+        started: float,
+        first_token_at: Optional[float],
+        last_token_at: Optional[float],
+        chunks: int,
+        tokens: Optional[int] = None,
+    ):
+        """
+        Observes one stream. `chunks` counts content chunks; `tokens` is the
+        upstream's completion token count when reported, else `chunks`.
+        """
+        if not self.enabled:
+            return
+        self.streams_in_flight.labels(route).dec()
+        if first_token_at is None:
+            return
+        model = self.model_label(model)
+        self.time_to_first_token.labels(route, model).observe(first_token_at - started)
+        generation = last_token_at - first_token_at
+        if chunks > 1 and generation > 0:
+            self.inter_token_latency.labels(route, model).observe(
+                generation / (chunks - 1)
+            )
+            self.tokens_per_second.labels(route, model).observe(
+                (tokens or chunks) / generation
+            )
+
+    def render(self) -> (bytes, str):
+        prometheus = self.prometheus
+        registry = prometheus.REGISTRY
+        if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+            registry = prometheus.CollectorRegistry()
+            multiprocess = import_optional("prometheus_client.multiprocess")
+            multiprocess.MultiProcessCollector(registry)
+        return prometheus.generate_latest(registry), prometheus.CONTENT_TYPE_LATEST
+
+
+metrics = MiddlewareMetrics(METRICS_ENABLED, METRICS_MAX_MODELS)
+
+
+class Tracing:
+    """
+    Thin wrapper over the OpenTelemetry SDK. When tracing is disabled or the
+    SDK isn't installed, spans are null contexts and nothing is propagated.
+    """
+
+    def __init__(
+        self,
+        enabled: bool,
+        exporter: str,
+        file_path: str,
+        sample_ratio: float,
+        service_name: str,
+    ):
+        self.tracer = None
+        if not enabled:
+            return
+        trace = import_optional("opentelemetry.trace")
+        sdk_trace = import_optional("opentelemetry.sdk.trace")
+        if trace is None or sdk_trace is None:
+            log_event(
+                logging.WARNING,
+                "TRACING_ENABLED is set but opentelemetry-sdk is not installed",
+            )
+            return
+        export = importlib.import_module("opentelemetry.sdk.trace.export")
+        sampling = importlib.import_module("opentelemetry.sdk.trace.sampling")
+        resources = importlib.import_module("opentelemetry.sdk.resources")
+
+        provider = sdk_trace.TracerProvider(
+            resource=resources.Resource.create({"service.name": service_name}),
+            sampler=sampling.ParentBased(sampling.TraceIdRatioBased(sample_ratio)),
+        )
+        if exporter == "file":
+            # Written synchronously so tests can read spans as soon as they end
+            out = open(file_path, "a", encoding="utf-8")
+            provider.add_span_processor(
+                export.SimpleSpanProcessor(
+                    export.ConsoleSpanExporter(
+                        out=out,
+                        formatter=lambda span: span.to_json(indent=None) + "\n",
+                    )
+                )
+            )
+        else:
+            otlp = importlib.import_module(
+                "opentelemetry.exporter.otlp.proto.http.trace_exporter"
+            )
+            provider.add_span_processor(
+                export.BatchSpanProcessor(otlp.OTLPSpanExporter())
+            )
+        trace.set_tracer_provider(provider)
+
+        self.trace = trace
+        self.propagate = importlib.import_module("opentelemetry.propagate")
+        self.tracer = trace.get_tracer("middleware")
+        log_event(
+            logging.INFO,
+            "Tracing enabled",
+            exporter=exporter,
+            sample_ratio=sample_ratio,
+        )
+
+    def span(self, name: str, kind: str = "INTERNAL", context=None, **attributes):
+        """Context manager for a span that is current while it is open."""
+        if self.tracer is None:
+            return nullcontext()
+        return self.tracer.start_as_current_span(
+            name,
+            context=context,
+            kind=self.trace.SpanKind[kind],
+            attributes={k: v for k, v in attributes.items() if v is not None},
+        )
+
+    def start_span(self, name: str, kind: str = "INTERNAL", **attributes):
+        """
+        Starts a span that outlives the current block (e.g. an upstream
+        stream); pass it to end_span when done. Returns None when disabled.
+        """
+        if self.tracer is None:
+            return None
+        return self.tracer.start_span(
+            name,
+            kind=self.trace.SpanKind[kind],
+            attributes={k: v for k, v in attributes.items() if v is not None},
+        )
+
+    def end_span(self, span, error: Optional[BaseException] = None):
+        if span is None:
+            return
+        if error is not None:
+            span.record_exception(error)
+            span.set_status(self.trace.Status(self.trace.StatusCode.ERROR))
+        span.end()
+
+    def set_attributes(self, **attributes):
+        """Sets attributes on the current span, if any."""
+        if self.tracer is not None:
+            self.trace.get_current_span().set_attributes(attributes)
+
+    def inject(self, headers: Dict[str, str], span=None) -> Dict[str, str]:
+        """
+        Adds W3C trace context for the current span (or `span`) to outgoing
+        headers, so LiteLLM's spans join the middleware's trace.
+        """
+        if self.tracer is not None:
+            context = self.trace.set_span_in_context(span) if span else None
+            self.propagate.inject(headers, context=context)
+        return headers
+
+    def extract(self, scope) -> Any:
+        """Returns the caller's trace context from an ASGI scope's headers."""
+        headers = {
+            name.decode("latin-1"): value.decode("latin-1")
+            for name, value in scope["headers"]
+            if name in (b"traceparent", b"tracestate")
+        }
+        return self.propagate.extract(headers) if headers else None
+
+
+tracing = Tracing(
+    TRACING_ENABLED,
+    TRACING_EXPORTER,
+    TRACING_FILE,
+    TRACING_SAMPLE_RATIO,
+    TRACING_SERVICE_NAME,
+)
+
+
+class ServerTiming:
+    """
+    Stage durations for one request. A stage opened inside another (the
+    prompt fetch during conversion) is subtracted from the outer one, so the
+    stages never double count. Open stages are tracked per task, since batch
+    sub-requests time their stages concurrently within one request.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.durations = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        outer = open_timing_stages.get()
+        nested = [0.0]  # seconds spent in stages opened inside this one
+        open_timing_stages.set(outer + (nested,))
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            open_timing_stages.set(outer)
+            if outer:
+                outer[-1][0] += elapsed
+            self.add(name, elapsed - nested[0])
+
+    def add(self, name: str, seconds: float):
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    def breakdown(self, **extra: float) -> Dict[str, float]:
+        """Milliseconds per stage, then `extra` marks and the total so far."""
+        timings = {**self.durations, **extra}
+        timings["total"] = time.perf_counter() - self.started
+        return {name: round(seconds * 1000, 1) for name, seconds in timings.items()}
+
+    def header(self) -> bytes:
+        return ", ".join(
+            f"{name};dur={ms}" for name, ms in self.breakdown().items()
+        ).encode("latin-1")
+
+
+server_timing = ContextVar("server_timing", default=None)
+open_timing_stages = ContextVar("open_timing_stages", default=())
+
+
+def timing_stage(name: Optional[str]):
+    """Times a stage of the current request when Server-Timing is on for it."""
+    timing = server_timing.get()
+    if timing is None or name is None:
+        return nullcontext()
+    return timing.stage(name)
+
+
+def server_timing_trailer(first_token_at: Optional[float]) -> Optional[Dict]:
+    """
+    The final breakdown for a stream's trailing event, with time to first
+    token measured from the request's arrival. None when Server-Timing is off.
+    """
+    timing = server_timing.get()
+    if timing is None:
+        return None
+    if first_token_at is None:
+        return timing.breakdown()
+    return timing.breakdown(ttft=first_token_at - timing.started)
+
+
+def timed_db(operation: str, stage: Optional[str] = None):
+    """
+    Records the decorated database call's latency under `operation`, inside a
+    span of the same name. `stage` is its Server-Timing stage.
+    """
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                with timing_stage(stage), tracing.span(
+                    f"db.{operation}", "CLIENT", **{"db.operation.name": operation}
+                ):
+                    return fn(*args, **kwargs)
+            finally:
+                metrics.db(operation, time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
+
+
+class MetricsMiddleware:
+    """
+    Observes request latency by route template, model and status. Latency runs
+    to the end of the response body, so streams count in full. Handlers label
+    the model with request.state.model.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not metrics.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            metrics.request(
+                route.path if route is not None else "unmatched",
+                scope.get("state", {}).get("model"),
+                status,
+                time.perf_counter() - started,
+            )
+
+
+class TracingMiddleware:
+    """
+    Opens the server span for each HTTP request, continuing the caller's
+    trace when it sends a traceparent header. The span stays current for the
+    handler and for the whole response body, so stage spans nest under it.
+    FastAPI releases with built-in telemetry already open one; it is reused.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or tracing.tracer is None:
+            await self.app(scope, receive, send)
+            return
+
+        current = tracing.trace.get_current_span()
+        if current.is_recording() and current.kind == tracing.trace.SpanKind.SERVER:
+            await self.app(scope, receive, self.annotating(scope, current, send))
+            return
+
+        with tracing.span(
+            scope["method"],
+            "SERVER",
+            context=tracing.extract(scope),
+            **{"http.request.method": scope["method"], "url.path": scope["path"]},
+        ) as span:
+            await self.app(scope, receive, self.annotating(scope, span, send))
+            route = scope.get("route")
+            if route is not None:
+                span.update_name(f"{scope['method']} {route.path}")
+                span.set_attribute("http.route", route.path)
+
+    @staticmethod
+    def annotating(scope, span, send):
+        # The handler has picked the model by the time the response starts;
+        # a framework-owned span may already be closed after the last body
+        async def send_annotated(message):
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                span.set_attribute("http.response.status_code", status)
+                if status >= 500:
+                    span.set_status(tracing.trace.StatusCode.ERROR)
+                model = scope.get("state", {}).get("model")
+                if model:
+                    span.set_attribute("gen_ai.request.model", model)
+            await send(message)
+
+        return send_annotated
+
+
+class ServerTimingMiddleware:
+    """
+    Collects stage timings for requests that have Server-Timing on and adds
+    the header as the response starts. Streams add their later stages to a
+    trailing event instead (see server_timing_trailer).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        enabled = SERVER_TIMING
+        if scope["type"] == "http":
+            for name, value in scope["headers"]:
+                if name == b"x-server-timing":
+                    enabled = value.lower() in (b"true", b"1")
+                    break
+        if not enabled or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timing = ServerTiming()
+        token = server_timing.set(timing)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [
+                    *message.get("headers", []),
+                    (b"server-timing", timing.header()),
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            server_timing.reset(token)
+
+
+class ProfileBusy(HTTPException):
+    def __init__(self):
+        super().__init__(
+            status_code=409, detail={"error": "Another profile is already running"}
+        )
+
+
+class OnDemandProfiler:
+    """
+    Runs at most one pyinstrument profile at a time and keeps the newest
+    `max_files` results on disk. Profiles and their index are per worker.
+    """
+
+    FORMATS = {
+        "speedscope": (".speedscope.json", "application/json"),
+        "html": (".html", "text/html"),
+    }
+
+    def __init__(self, directory: str, interval: float, max_files: int):
+        self.directory = directory
+        self.interval = interval
+        self.max_files = max_files
+        self.running = None
+        self._profiles = collections.OrderedDict()
+        self.counters = collections.Counter()
+
+    def start(self, target: str, async_mode: str):
+        """
+        Starts profiling on the current (event loop) thread. "enabled" follows
+        only the calling task's context; "disabled" samples everything.
+        """
+        pyinstrument = import_optional("pyinstrument")
+        if pyinstrument is None:
+            raise HTTPException(
+                status_code=501, detail={"error": "pyinstrument is not installed"}
+            )
+        if self.running is not None:
+            self.counters["busy"] += 1
+            raise ProfileBusy()
+        profiler = pyinstrument.Profiler(interval=self.interval, async_mode=async_mode)
+        profiler.start(target_description=target)
+        self.running = target
+        return profiler
+
+    def stop(self, profiler):
+        profiler.stop()
+        self.running = None
+
+    @staticmethod
+    def new_id() -> str:
+        return f"{int(time.time())}-{uuid.uuid4().hex[:8]}"
+
+    async def save(
+        self, profiler, output_format: str, target: str, profile_id: str
+    ) -> Dict[str, Any]:
+        suffix, media_type = self.FORMATS[output_format]
+        path = os.path.join(self.directory, profile_id + suffix)
+
+        def render():
+            renderers = importlib.import_module("pyinstrument.renderers")
+            renderer = (
+                renderers.SpeedscopeRenderer()
+                if output_format == "speedscope"
+                else renderers.HTMLRenderer()
+            )
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(profiler.output(renderer))
+
+        # Rendering walks every sample; keep it off the loop
+        await to_thread.run_sync(render)
+        self._profiles[profile_id] = {
+            "id": profile_id,
+            "target": target,
+            "format": output_format,
+            "path": path,
+            "media_type": media_type,
+            "created_at": int(time.time()),
+            "duration_seconds": round(profiler.last_session.duration, 3),
+            "samples": profiler.last_session.sample_count,
+        }
+        self.counters["saved"] += 1
+        while len(self._profiles) > self.max_files:
+            _, evicted = self._profiles.popitem(last=False)
+            with suppress(OSError):
+                os.remove(evicted["path"])
+        log_event(logging.INFO, "Saved profile", profile_id=profile_id, target=target)
+        return self._profiles[profile_id]
+
+    def get(self, profile_id: str) -> Optional[Dict[str, Any]]:
+        return self._profiles.get(profile_id)
+
+    def list(self) -> List[Dict[str, Any]]:
+        return [
+            {k: v for k, v in profile.items() if k not in ("path", "media_type")}
+            for profile in reversed(self._profiles.values())
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.counters, "running": self.running, "stored": len(self._profiles)}
+
+
+on_demand_profiler = OnDemandProfiler(
+    PROFILE_DIR, PROFILE_INTERVAL_SECONDS, PROFILE_MAX_FILES
+)
+middleware_stats["profiler"] = on_demand_profiler.stats
+
+
+class ProfilingMiddleware:
+    """
+    Profiles requests sent with "X-Middleware-Profile: <master key>" (and an
+    optional "X-Middleware-Profile-Format: speedscope|html"). The response
+    carries X-Profile-Id; fetch the file from /middleware/profiles/{id}. A
+    header with the wrong key, or a profile already running, is ignored.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not MASTER_KEY:
+            await self.app(scope, receive, send)
+            return
+        profile_key = output_format = None
+        for name, value in scope["headers"]:
+            if name == b"x-middleware-profile":
+                profile_key = value.decode("latin-1")
+            elif name == b"x-middleware-profile-format":
+                output_format = value.decode("latin-1").lower()
+        if profile_key != MASTER_KEY or on_demand_profiler.running is not None:
+            await self.app(scope, receive, send)
+            return
+        if output_format not in OnDemandProfiler.FORMATS:
+            output_format = "speedscope"
+
+        target = f"{scope['method']} {scope['path']}"
+        profile_id = on_demand_profiler.new_id()
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [
+                    *message.get("headers", []),
+                    (b"x-profile-id", profile_id.encode("latin-1")),
+                ]
+            await send(message)
+
+        try:
+            profiler = on_demand_profiler.start(target, "enabled")
+        except HTTPException:
+            # pyinstrument missing, or another profile won the race
+            await self.app(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            on_demand_profiler.stop(profiler)
+            # Saved once the response is complete, so it never delays the body
+            await on_demand_profiler.save(profiler, output_format, target, profile_id)
+
+
+fair_scheduler = FairScheduler(SCHEDULER_CONCURRENCY, SCHEDULER_TENANTS)
+middleware_stats["scheduler"] = fair_scheduler.stats
+admission_controller = AdmissionController()
+middleware_stats["admission"] = admission_controller.stats
+app.add_middleware(AdmissionReleaseMiddleware)
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(ServerTimingMiddleware)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
+
+
+class LoadShed(HTTPException):
+    def __init__(self, lag_ms: float):
+        super().__init__(
+            status_code=503,
+            detail={
+                "error": f"Middleware overloaded (event loop lag {lag_ms:.0f}ms), retry later"
+            },
+            headers={"Retry-After": str(LOOP_LAG_RETRY_AFTER_SECONDS)},
+        )
+
+
+class EventLoopLagMonitor:
+    """
+    Measures how late a periodic sleep wakes up. A blocked loop (sync DB calls,
+    large encodes, boto3) shows up as one large sample once it recovers.
+    """
+
+    def __init__(self, interval: float, window: int):
+        self.interval = interval
+        self.samples = collections.deque(maxlen=window)
+        self.current_ms = 0.0
+        self.shedding = False
+        self.shed_count = 0
+        self._task = None
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            self.record(max(0.0, time.perf_counter() - expected) * 1000)
+
+    def record(self, lag_ms: float):
+        self.samples.append(lag_ms)
+        self.current_ms = lag_ms
+        metrics.event_loop_lag(lag_ms / 1000)
+        # Hysteresis so shedding doesn't flap around the threshold
+        if LOOP_LAG_SHED_THRESHOLD_MS > 0:
+            if lag_ms > LOOP_LAG_SHED_THRESHOLD_MS:
+                self.shedding = True
+            elif lag_ms < LOOP_LAG_SHED_THRESHOLD_MS / 2:
+                self.shedding = False
+
+    def check(self, is_streaming: bool):
+        # Streams are protected; only new non-streaming work is shed
+        if self.shedding and not is_streaming:
+            self.shed_count += 1
+            raise LoadShed(self.current_ms)
+
+    def is_ready(self) -> bool:
+        return not (
+            LOOP_LAG_READINESS_THRESHOLD_MS > 0
+            and self.current_ms > LOOP_LAG_READINESS_THRESHOLD_MS
+        )
 
-        # Check if middleware database exists
-        with temp_engine.connect() as conn:
-            conn.execute(text("COMMIT"))  # Close any open transaction
-            result = conn.execute(
-                text("SELECT 1 FROM pg_database WHERE datname = 'middleware'")
-            )
-            if not result.scalar():
-                # Database doesn't exist, create it
-                conn.execute(text("COMMIT"))  # Ensure we're not in a transaction
-                conn.execute(text("CREATE DATABASE middleware"))
-                print("Created middleware database")
+    def percentiles(self) -> Dict[str, float]:
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {}
 
-        # Now connect to the middleware database using modified URL
-        engine = create_engine(f"{url_parts[0]}/middleware")
-        metadata_obj = MetaData()
+        def pick(q):
+            return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
 
-        # Rest of your existing code remains the same
-        with engine.begin() as conn:
-            inspector = inspect(engine)
-            if "chat_sessions" not in inspector.get_table_names():
-                chat_sessions_table = Table(
-                    "chat_sessions",
-                    metadata_obj,
-                    Column("session_id", String, primary_key=True),
-                    Column("chat_history", Text),
-                    Column("api_key_hash", String),
-                )
-                metadata_obj.create_all(engine)
-                print("Created chat_sessions table")
-            else:
-                chat_sessions_table = Table(
-                    "chat_sessions", metadata_obj, autoload_with=engine
-                )
-                columns = [c.name for c in chat_sessions_table.columns]
-                if "api_key_hash" not in columns:
-                    conn.execute(
-                        text(
-                            "ALTER TABLE chat_sessions ADD COLUMN api_key_hash VARCHAR;"
-                        )
-                    )
-                else:
-                    print("chat_sessions table already exists with api_key_hash column")
+        return {
+            "p50_ms": round(pick(0.5), 2),
+            "p90_ms": round(pick(0.9), 2),
+            "p99_ms": round(pick(0.99), 2),
+            "max_ms": round(ordered[-1], 2),
+        }
 
-            # Check and create index within the same transaction
-            indexes = inspector.get_indexes("chat_sessions")
-            index_names = [idx["name"] for idx in indexes]
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "current_ms": round(self.current_ms, 2),
+            "shedding": self.shedding,
+            "shed": self.shed_count,
+            **self.percentiles(),
+        }
 
-            if "idx_chat_sessions_api_key_hash" not in index_names:
-                print("Creating index idx_chat_sessions_api_key_hash")
-                conn.execute(
-                    text(
-                        "CREATE INDEX idx_chat_sessions_api_key_hash ON chat_sessions (api_key_hash)"
-                    )
-                )
-                print("Index created successfully")
 
-        # Verify table exists after transaction commits
-        with engine.connect() as conn:
-            result = conn.execute(
-                text(
-                    "SELECT EXISTS (SELECT 1 FROM information_schema.tables WHERE table_name = 'chat_sessions')"
-                )
-            )
-            if not result.scalar():
-                raise Exception(
-                    "Table creation failed - table does not exist after create_all()"
-                )
-            print("Table verification successful")
+loop_lag_monitor = EventLoopLagMonitor(
+    LOOP_LAG_SAMPLE_INTERVAL_SECONDS, LOOP_LAG_WINDOW_SAMPLES
+)
+middleware_stats["event_loop"] = loop_lag_monitor.stats
 
-        return engine, chat_sessions_table
 
-    except SQLAlchemyError as e:
-        print(f"Database setup error: {str(e)}")
-        raise
-    except Exception as e:
-        print(f"Database setup error: {str(e)}")
-        raise
+async def buffered_stream(source: AsyncGenerator) -> AsyncGenerator:
+    """
+    Reads `source` in a separate task through a bounded StreamBuffer. Upstream
+    reads overlap with client writes until the stream's budget is used, then
+    stall until the client catches up. Cancelling the consumer (client
+    disconnect) cancels the reader, which runs the source's cleanup.
+    """
+    if STREAM_BUFFER_MAX_BYTES <= 0:
+        async for chunk in source:
+            yield chunk
+        return
 
+    buffer = StreamBuffer(stream_buffer_pool, STREAM_BUFFER_MAX_BYTES)
 
-@app.on_event("startup")
-async def startup_event():
-    print(f"doing startup_event")
-    global db_engine, chat_sessions
-    db_engine, chat_sessions = setup_database()
+    async def pump():
+        try:
+            async for chunk in source:
+                await buffer.put(chunk)
+        finally:
+            buffer.close()
+
+    stream_buffer_pool.buffers.add(buffer)
+    reader = asyncio.ensure_future(pump())
+    try:
+        while True:
+            chunk = await buffer.get()
+            if chunk is None:
+                break
+            yield chunk
+        # Surfaces upstream errors raised inside the reader task
+        await reader
+    finally:
+        if not reader.done():
+            reader.cancel()
+        with anyio.CancelScope(shield=True):
+            await asyncio.gather(reader, return_exceptions=True)
+        buffer.discard()
+        stream_buffer_pool.buffers.discard(buffer)
+
+
+def get_delta_flush_delay(request: Request, route: str) -> Optional[float]:
+    """Seconds to hold content deltas for, or None when coalescing is off."""
+    setting = request.headers.get("X-Delta-Coalescing", "").strip().lower()
+    if setting in ("off", "false", "0"):
+        return None
+    if setting in ("on", "true"):
+        return DELTA_COALESCE_MAX_DELAY_MS / 1000
+    if setting:
+        try:
+            return max(0.0, float(setting)) / 1000 or None
+        except ValueError:
+            pass
+    if route in DELTA_COALESCING_ROUTES:
+        return DELTA_COALESCE_MAX_DELAY_MS / 1000
+    return None
 
 
-def hash_api_key(api_key: str) -> str:
-    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+async def coalesce_deltas(
+    events: AsyncGenerator,
+    max_delay: float,
+    get_text: Callable[[Any], Optional[str]],
+    set_text: Callable[[Any, str], Any],
+) -> AsyncGenerator:
+    """
+    Merges consecutive content deltas from `events`. `get_text` returns an
+    event's delta text, or None for anything that must pass through as is
+    (role, finish, usage); `set_text` rewrites a held event with the merged
+    text. A held delta is flushed when the delay or size budget runs out, when
+    a non-delta event arrives or when the stream ends.
+    """
+    queue = asyncio.Queue(maxsize=64)
+    end = object()
+
+    async def pump():
+        try:
+            async for event in events:
+                await queue.put((event, None))
+            await queue.put((end, None))
+        except Exception as e:
+            await queue.put((end, e))
+        finally:
+            with anyio.CancelScope(shield=True):
+                await events.aclose()
 
+    loop = asyncio.get_running_loop()
+    reader = asyncio.ensure_future(pump())
+    held, parts, size, flush_at = None, [], 0, 0.0
+    first_delta = True
+    try:
+        while True:
+            if held is None:
+                event, error = await queue.get()
+            else:
+                try:
+                    event, error = await asyncio.wait_for(
+                        queue.get(), max(0.0, flush_at - loop.time())
+                    )
+                except asyncio.TimeoutError:
+                    yield set_text(held, "".join(parts))
+                    held, parts, size = None, [], 0
+                    continue
 
+            text = None if event is end else get_text(event)
+            if text is None or first_delta:
+                if held is not None:
+                    yield set_text(held, "".join(parts))
+                    held, parts, size = None, [], 0
+                if event is end:
+                    if error is not None:
+                        raise error
+                    return
+                if text is not None:
+                    first_delta = False
+                yield event
+                continue
+
+            if held is None:
+                held, flush_at = event, loop.time() + max_delay
+            parts.append(text)
+            size += len(text)
+            if size >= DELTA_COALESCE_MAX_CHARS:
+                yield set_text(held, "".join(parts))
+                held, parts, size = None, [], 0
+    finally:
+        if not reader.done():
+            reader.cancel()
+        with anyio.CancelScope(shield=True):
+            await asyncio.gather(reader, return_exceptions=True)
+
+
+def get_sse_delta_text(chunk: Dict[str, Any]) -> Optional[str]:
+    choices = chunk.get("choices")
+    if not choices or len(choices) != 1 or chunk.get("usage"):
+        return None
+    choice = choices[0]
+    delta = choice.get("delta") or {}
+    content = delta.get("content")
+    if (
+        not isinstance(content, str)
+        or choice.get("finish_reason") is not None
+        or any(value for key, value in delta.items() if key != "content")
+    ):
+        return None
+    return content
+
+
+def set_sse_delta_text(chunk: Dict[str, Any], text: str) -> Dict[str, Any]:
+    chunk["choices"][0]["delta"]["content"] = text
+    return chunk
+
+
+async def iter_sse_data(body: aiohttp.StreamReader) -> AsyncGenerator[bytes, None]:
+    """Yields the payload of each SSE `data:` line until `[DONE]`."""
+    pending = bytearray()
+    async for chunk in body.iter_any():
+        pending += chunk
+        start = 0
+        while True:
+            end = pending.find(b"\n", start)
+            if end < 0:
+                break
+            line = bytes(pending[start:end]).strip()
+            start = end + 1
+            if line.startswith(b"data:"):
+                data = line[5:].lstrip()
+                if data == b"[DONE]":
+                    return
+                yield data
+        del pending[:start]
+
+
+@timed_db("get_session", "session")
 def get_session_data(session_id: str) -> Optional[Dict[str, Any]]:
     with db_engine.connect() as conn:
         stmt = select(chat_sessions.c.chat_history, chat_sessions.c.api_key_hash).where(
@@ -180,32 +2911,40 @@ def get_session_data(session_id: str) -> Optional[Dict[str, Any]]:
         )
         result = conn.execute(stmt).fetchone()
         if result:
+            if result[0]:
+                metrics.history("load", len(result[0]))
             return {
-                "chat_history": json.loads(result[0]) if result[0] else None,
+                "chat_history": json_codec.loads(result[0]) if result[0] else None,
                 "api_key_hash": result[1],
             }
     return None
 
 
+@timed_db("create_session", "session")
 def create_chat_history(
     session_id: str, chat_history: List[Dict[str, str]], api_key_hash: str
 ):
+    encoded_history = json_codec.dumps(chat_history).decode("utf-8")
+    metrics.history("store", len(encoded_history))
     with db_engine.connect() as conn:
         stmt = insert(chat_sessions).values(
             session_id=session_id,
-            chat_history=json.dumps(chat_history),
+            chat_history=encoded_history,
             api_key_hash=api_key_hash,
         )
         conn.execute(stmt)
         conn.commit()
 
 
+@timed_db("update_session", "persist")
 def update_chat_history(session_id: str, chat_history: List[Dict[str, str]]):
+    encoded_history = json_codec.dumps(chat_history).decode("utf-8")
+    metrics.history("store", len(encoded_history))
     with db_engine.connect() as conn:
         stmt = (
             update(chat_sessions)
             .where(chat_sessions.c.session_id == session_id)
-            .values(chat_history=json.dumps(chat_history))
+            .values(chat_history=encoded_history)
         )
         conn.execute(stmt)
         conn.commit()
@@ -222,31 +2961,70 @@ class CustomEventStream:
             self.position += 1
 
 
-def create_event_message(payload, event_type_name):
-    header_name = b":event-type"
-    header_name_length = len(header_name)
-    event_name_bytes = event_type_name.encode("utf-8")
-    event_name_length = len(event_name_bytes)
-
-    headers_bytes = (
-        struct.pack("B", header_name_length)
-        + header_name
-        + b"\x07"
-        + struct.pack(">H", event_name_length)
-        + event_name_bytes
-    )
+class EventStreamEncoder:
+    """
+    Encodes application/vnd.amazon.eventstream frames. The header block for
+    each event type is built once. Small frames are concatenated and the
+    message CRC re-hashes the prelude; large frames copy the payload once and
+    continue the prelude CRC over the headers and payload instead.
+    """
+
+    # Below this many payload bytes, one %-format plus a re-hash beats join
+    LARGE_PAYLOAD_BYTES = 1024
+
+    _pack_prelude = struct.Struct(">II").pack
+    _pack_crc = struct.Struct(">I").pack
+
+    def __init__(self):
+        # event type -> (header block, header block length)
+        self._headers = {}
+
+    def header_block(self, event_type_name: str) -> (bytes, int):
+        header_name = b":event-type"
+        event_name_bytes = event_type_name.encode("utf-8")
+        headers_bytes = (
+            struct.pack("B", len(header_name))
+            + header_name
+            + b"\x07"
+            + struct.pack(">H", len(event_name_bytes))
+            + event_name_bytes
+        )
+        self._headers[event_type_name] = (headers_bytes, len(headers_bytes))
+        return self._headers[event_type_name]
+
+    def encode(self, payload: bytes, event_type_name: str) -> bytes:
+        headers = self._headers.get(event_type_name)
+        if headers is None:
+            headers = self.header_block(event_type_name)
+        headers_bytes, headers_length = headers
+
+        prelude = self._pack_prelude(len(payload) + headers_length + 16, headers_length)
+        crc = zlib.crc32(prelude)
+        prelude_crc = self._pack_crc(crc)
+        if len(payload) < self.LARGE_PAYLOAD_BYTES:
+            message = b"%b%b%b%b" % (prelude, prelude_crc, headers_bytes, payload)
+            return message + self._pack_crc(zlib.crc32(message))
+        # Copying and hashing the payload dominate, so do each exactly once
+        crc = zlib.crc32(headers_bytes, zlib.crc32(prelude_crc, crc))
+        crc = zlib.crc32(payload, crc)
+        return b"".join(
+            (prelude, prelude_crc, headers_bytes, payload, self._pack_crc(crc))
+        )
+
 
-    headers_length = len(headers_bytes)
-    payload_length = len(payload)
-    total_length = payload_length + headers_length + 16
+event_stream_encoder = EventStreamEncoder()
 
-    prelude = struct.pack(">I", total_length) + struct.pack(">I", headers_length)
-    prelude_crc = struct.pack(">I", zlib.crc32(prelude) & 0xFFFFFFFF)
 
-    message_parts = prelude + prelude_crc + headers_bytes + payload
-    message_crc = struct.pack(">I", zlib.crc32(message_parts) & 0xFFFFFFFF)
+def create_event_message(payload, event_type_name):
+    return event_stream_encoder.encode(payload, event_type_name)
+
 
-    return message_parts + message_crc
+STOP_REASON_MAP = {
+    "stop": "end_turn",
+    "length": "max_tokens",
+    "tool_calls": "tool_use",
+    "content_filter": "content_filtered",
+}
 
 
 def convert_messages_to_openai(
@@ -274,28 +3052,21 @@ def convert_messages_to_openai(
 
 
 async def convert_bedrock_to_openai(
-    model_id: str, bedrock_request: Dict[str, Any], streaming: bool
+    model_id: str,
+    bedrock_request: Dict[str, Any],
+    streaming: bool,
+    request: Optional[Request] = None,
 ) -> Dict[str, Any]:
     prompt_variables = bedrock_request.get("promptVariables", {})
     final_prompt_text = None
     if model_id.startswith("arn:aws:bedrock:"):
-        prompt_id, prompt_version = parse_prompt_arn(model_id)
-        if prompt_id:
-            if prompt_version:
-                prompt = bedrock_client.get_prompt(
-                    promptIdentifier=prompt_id, promptVersion=prompt_version
-                )
-            else:
-                prompt = bedrock_client.get_prompt(promptIdentifier=prompt_id)
-
-            variants = prompt.get("variants", [])
-            variant = variants[0]
-            template_text = variant["templateConfiguration"]["text"]["text"]
-
-            validate_prompt_variables(template_text, prompt_variables)
-            final_prompt_text = construct_prompt_text_from_variables(
-                template_text, prompt_variables
+        managed_prompt = await get_managed_prompt(model_id)
+        if managed_prompt:
+            variant, template = select_prompt_variant(
+                request, model_id, managed_prompt, streaming
             )
+            template.validate(prompt_variables)
+            final_prompt_text = template.render(prompt_variables)
             model_id = variant["modelId"]
 
     completion_params = {"model": model_id}
@@ -313,6 +3084,8 @@ async def convert_bedrock_to_openai(
     completion_params["messages"] = messages
     if streaming:
         completion_params["stream"] = True
+        # Usage arrives in a final chunk and feeds the Bedrock metadata event
+        completion_params["stream_options"] = {"include_usage": True}
 
     if "inferenceConfig" in bedrock_request:
         config = bedrock_request["inferenceConfig"]
@@ -355,14 +3128,8 @@ async def convert_openai_to_bedrock(openai_response: Dict[str, Any]) -> Dict[str
     }
 
     if "finish_reason" in openai_response["choices"][0]:
-        stop_reason_map = {
-            "stop": "end_turn",
-            "length": "max_tokens",
-            "tool_calls": "tool_use",
-            "content_filter": "content_filtered",
-        }
         finish_reason = openai_response["choices"][0]["finish_reason"]
-        bedrock_response["stopReason"] = stop_reason_map.get(finish_reason, "end_turn")
+        bedrock_response["stopReason"] = STOP_REASON_MAP.get(finish_reason, "end_turn")
 
     return bedrock_response
 
@@ -373,82 +3140,625 @@ async def openai_stream_to_bedrock_chunks(openai_stream):
         finish_reason = chunk.choices[0].finish_reason
 
         if delta.role:
-            event_payload = json.dumps({"role": delta.role}).encode("utf-8")
+            event_payload = json_codec.dumps({"role": delta.role})
             yield create_event_message(event_payload, "messageStart")
 
         if delta.content:
-            event_payload = json.dumps(
+            event_payload = json_codec.dumps(
                 {
                     "contentBlockIndex": 0,
                     "delta": {"text": delta.content},
                 }
-            ).encode("utf-8")
+            )
             yield create_event_message(event_payload, "contentBlockDelta")
 
-        if finish_reason == "stop":
-            event_payload = json.dumps({"stopReason": "end_turn"}).encode("utf-8")
-            yield create_event_message(event_payload, "messageStop")
+        if finish_reason == "stop":
+            event_payload = json_codec.dumps({"stopReason": "end_turn"})
+            yield create_event_message(event_payload, "messageStop")
+
+
+def parse_prompt_arn(arn: str):
+    if "prompt/" not in arn:
+        return None, None
+
+    after_prompt = arn.split("prompt/", 1)[1]
+
+    if ":" in after_prompt:
+        prompt_id, prompt_version = after_prompt.split(":", 1)
+        return prompt_id, prompt_version
+    else:
+        return after_prompt, None
+
+
+class ManagedPrompt:
+    """A fetched managed prompt with each variant's template compiled."""
+
+    def __init__(self, prompt: Dict[str, Any]):
+        self.prompt = prompt
+        self.variants = [
+            (
+                variant,
+                compile_prompt_template(
+                    variant["templateConfiguration"]["text"]["text"]
+                ),
+            )
+            for variant in prompt.get("variants", [])
+        ]
+
+
+class ManagedPromptCache:
+    """
+    Caches bedrock-agent get_prompt responses. Fetches run in a worker thread
+    so the boto3 call doesn't block the event loop, and concurrent misses for
+    the same prompt share one fetch. The client is built by `client_factory`
+    on the first fetch; `client` can be set to any object with a boto3 style
+    get_prompt, e.g. a client wrapped in botocore's Stubber. If refreshing an
+    expired DRAFT fails, the stale prompt is served until a fetch succeeds,
+    unless the prompt no longer exists.
+    """
+
+    def __init__(self, client_factory: Callable, draft_ttl: float):
+        self.client_factory = client_factory
+        self.client = None
+        self.draft_ttl = draft_ttl
+        self._entries = {}
+        self._inflight = {}
+        self.counters = collections.Counter()
+
+    def _fresh(self, key, entry) -> bool:
+        prompt_version = key[1]
+        if prompt_version and prompt_version != "DRAFT":
+            return True
+        return time.monotonic() - entry["fetched_at"] < self.draft_ttl
+
+    def get_client(self):
+        if self.client is None:
+            self.client = self.client_factory()
+        return self.client
+
+    def _fetch(self, prompt_id: str, prompt_version: Optional[str]):
+        client = self.get_client()
+        if prompt_version:
+            return client.get_prompt(
+                promptIdentifier=prompt_id, promptVersion=prompt_version
+            )
+        return client.get_prompt(promptIdentifier=prompt_id)
+
+    async def get(self, prompt_id: str, prompt_version: Optional[str]):
+        key = (prompt_id, prompt_version)
+        entry = self._entries.get(key)
+        if entry is not None and self._fresh(key, entry):
+            self.counters["hits"] += 1
+            return entry["managed_prompt"]
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.counters["coalesced"] += 1
+            return await asyncio.shield(inflight)
+
+        self.counters["misses"] += 1
+        inflight = asyncio.ensure_future(self._load(key))
+        self._inflight[key] = inflight
+        return await asyncio.shield(inflight)
+
+    async def _load(self, key):
+        # Runs as its own task so a cancelled caller doesn't discard the result
+        try:
+            prompt = await to_thread.run_sync(self._fetch, *key)
+        except Exception as e:
+            self.counters["errors"] += 1
+            stale = self._entries.get(key)
+            error_code = getattr(e, "response", {}).get("Error", {}).get("Code")
+            if stale is None or error_code == "ResourceNotFoundException":
+                self._entries.pop(key, None)
+                raise
+            self.counters["stale"] += 1
+            log_event(
+                logging.WARNING,
+                "Prompt refresh failed, serving the cached version",
+                prompt_id=key[0],
+                error=str(e),
+            )
+            return stale["managed_prompt"]
+        finally:
+            self._inflight.pop(key, None)
+        managed_prompt = ManagedPrompt(prompt)
+        self._entries[key] = {
+            "managed_prompt": managed_prompt,
+            "fetched_at": time.monotonic(),
+        }
+        return managed_prompt
+
+    async def preload(self, arns: List[str]):
+        for arn in arns:
+            prompt_id, prompt_version = parse_prompt_arn(arn)
+            if not prompt_id:
+                log_event(
+                    logging.WARNING, "Skipping prompt preload for invalid ARN", arn=arn
+                )
+                continue
+            try:
+                await self.get(prompt_id, prompt_version)
+            except Exception as e:
+                log_event(
+                    logging.WARNING, "Prompt preload failed", arn=arn, error=str(e)
+                )
+        log_event(logging.INFO, f"Preloaded {len(self._entries)} managed prompts")
+
+    def invalidate(self):
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.counters, "entries": len(self._entries)}
+
+
+prompt_cache = ManagedPromptCache(get_bedrock_client, PROMPT_CACHE_DRAFT_TTL_SECONDS)
+middleware_stats["prompt_cache"] = prompt_cache.stats
+
+
+async def get_managed_prompt(model_id: str) -> Optional[ManagedPrompt]:
+    """Returns the managed prompt for a prompt ARN, or None for other ARNs."""
+    prompt_id, prompt_version = parse_prompt_arn(model_id)
+    if not prompt_id:
+        return None
+    with timing_stage("prompt"), tracing.span(
+        "bedrock.get_prompt",
+        "CLIENT",
+        prompt_id=prompt_id,
+        prompt_version=prompt_version or "DRAFT",
+    ):
+        return await prompt_cache.get(prompt_id, prompt_version)
+
+
+class VariantSelector:
+    """
+    Picks a managed-prompt variant per request from per-variant latency and
+    error EWMAs. Stats are keyed by prompt ARN, kind ("ttft" for streams,
+    "response" otherwise, which measure different things) and variant name.
+    """
+
+    POLICIES = ("first", "fastest", "cheapest_under_slo", "weighted")
+    KINDS = ("ttft", "response")
+
+    def __init__(self, config: Dict[str, Any]):
+        self.config = config
+        self._variants = collections.defaultdict(
+            lambda: {kind: {} for kind in self.KINDS}
+        )
+
+    def _stats(
+        self, prompt_arn: str, kind: str, variant: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        name = variant.get("name") or variant.get("modelId")
+        stats = self._variants[prompt_arn][kind].get(name)
+        if stats is None:
+            stats = {
+                "model_id": variant.get("modelId"),
+                "selected": 0,
+                "samples": 0,
+                "errors": 0,
+                "latency_ewma": None,
+                "error_ewma": 0.0,
+            }
+            self._variants[prompt_arn][kind][name] = stats
+        return stats
+
+    @staticmethod
+    def expected_latency(stats: Dict[str, Any]) -> float:
+        # Failed attempts are retried elsewhere, so errors inflate the latency
+        if stats["latency_ewma"] is None:
+            return float("inf")
+        return stats["latency_ewma"] / max(0.01, 1 - stats["error_ewma"])
+
+    def choose(
+        self, prompt_arn: str, managed_prompt: ManagedPrompt, kind: str
+    ) -> tuple:
+        """
+        Returns (index, variant, template) for the next request of `kind`. The
+        chosen variant's outcome is reported back with record().
+        """
+        variants = managed_prompt.variants
+        policy = self.config["policy"]
+        if len(variants) == 1 or policy == "first":
+            index = 0
+        else:
+            stats = [self._stats(prompt_arn, kind, variant) for variant, _ in variants]
+            cold = [
+                i
+                for i, s in enumerate(stats)
+                if s["samples"] < self.config["min_samples"]
+            ]
+            if cold:
+                index = min(cold, key=lambda i: stats[i]["selected"])
+            elif random.random() < self.config["explore_rate"]:
+                index = random.randrange(len(variants))
+            elif policy == "cheapest_under_slo":
+                index = self._cheapest_under_slo(stats)
+            elif policy == "weighted":
+                weights = [1 / self.expected_latency(s) for s in stats]
+                if sum(weights) > 0:
+                    index = random.choices(range(len(stats)), weights=weights)[0]
+                else:
+                    # Only failures observed so far: nothing to prefer
+                    index = random.randrange(len(stats))
+            else:
+                index = min(
+                    range(len(stats)), key=lambda i: self.expected_latency(stats[i])
+                )
+        variant, template = variants[index]
+        self._stats(prompt_arn, kind, variant)["selected"] += 1
+        return index, variant, template
+
+    def _cheapest_under_slo(self, stats: List[Dict[str, Any]]) -> int:
+        slo = self.config["slo_ms"] / 1000
+        eligible = [
+            i
+            for i, s in enumerate(stats)
+            if s["latency_ewma"] is not None
+            and s["latency_ewma"] <= slo
+            and s["error_ewma"] <= self.config["max_error_rate"]
+        ]
+        if not eligible:
+            # Nothing meets the SLO; fall back to the fastest variant
+            return min(range(len(stats)), key=lambda i: self.expected_latency(stats[i]))
+        costs = self.config["costs"]
+        return min(
+            eligible,
+            key=lambda i: (
+                costs.get(stats[i]["model_id"], float("inf")),
+                stats[i]["latency_ewma"],
+            ),
+        )
+
+    def record(
+        self,
+        prompt_arn: str,
+        kind: str,
+        variant: Dict[str, Any],
+        latency: Optional[float],
+        error: bool = False,
+    ):
+        """Folds one outcome into the EWMAs; `latency` is ignored for errors."""
+        stats = self._stats(prompt_arn, kind, variant)
+        alpha = self.config["alpha"]
+        stats["samples"] += 1
+        if stats["samples"] == 1:
+            stats["error_ewma"] = float(error)
+        else:
+            stats["error_ewma"] += alpha * (float(error) - stats["error_ewma"])
+        if error:
+            stats["errors"] += 1
+        elif stats["latency_ewma"] is None:
+            stats["latency_ewma"] = latency
+        else:
+            stats["latency_ewma"] += alpha * (latency - stats["latency_ewma"])
+
+    def update_config(self, update: Dict[str, Any]):
+        if "policy" in update and update["policy"] not in self.POLICIES:
+            raise ValueError(f"policy must be one of {', '.join(self.POLICIES)}")
+        self.config.update(update)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "policy": self.config["policy"],
+            "prompts": {
+                prompt_arn: {
+                    kind: {
+                        name: {
+                            "model_id": s["model_id"],
+                            "selected": s["selected"],
+                            "samples": s["samples"],
+                            "errors": s["errors"],
+                            "latency_ms_ewma": (
+                                None
+                                if s["latency_ewma"] is None
+                                else round(s["latency_ewma"] * 1000, 1)
+                            ),
+                            "error_rate_ewma": round(s["error_ewma"], 4),
+                        }
+                        for name, s in variants.items()
+                    }
+                    for kind, variants in kinds.items()
+                }
+                for prompt_arn, kinds in self._variants.items()
+            },
+        }
+
+
+variant_selector = VariantSelector(
+    {
+        "policy": PROMPT_VARIANT_POLICY,
+        "alpha": PROMPT_VARIANT_EWMA_ALPHA,
+        "min_samples": PROMPT_VARIANT_MIN_SAMPLES,
+        "explore_rate": PROMPT_VARIANT_EXPLORE_RATE,
+        "slo_ms": PROMPT_VARIANT_SLO_MS,
+        "max_error_rate": PROMPT_VARIANT_MAX_ERROR_RATE,
+        "costs": PROMPT_VARIANT_COSTS,
+    }
+)
+middleware_stats["prompt_variants"] = variant_selector.stats
+
+
+def select_prompt_variant(
+    request: Optional[Request],
+    prompt_arn: str,
+    managed_prompt: ManagedPrompt,
+    streaming: bool,
+) -> tuple:
+    """
+    Chooses a variant and remembers it on request.state so the handler can
+    report the upstream outcome with record_variant_outcome(): time to first
+    token for streams, full response time otherwise.
+    """
+    kind = "ttft" if streaming else "response"
+    _, variant, template = variant_selector.choose(prompt_arn, managed_prompt, kind)
+    if request is not None:
+        request.state.prompt_variant = (prompt_arn, kind, variant)
+    return variant, template
+
+
+def record_variant_outcome(request: Request, started: float, status: int = 200):
+    """
+    Reports the upstream outcome for the request's variant, at most once.
+    5xx and 429 count as errors; other 4xx say nothing about the variant and
+    are not recorded.
+    """
+    selection = getattr(request.state, "prompt_variant", None)
+    if selection is None:
+        return
+    request.state.prompt_variant = None
+    error = status >= 500 or status == 429
+    if status >= 400 and not error:
+        return
+    prompt_arn, kind, variant = selection
+    variant_selector.record(
+        prompt_arn, kind, variant, time.perf_counter() - started, error=error
+    )
+
+
+PROMPT_PLACEHOLDER = re.compile(r"{{\s*(\w+)\s*}}")
+
+
+class CompiledPromptTemplate:
+    """
+    A prompt template split once into literal text and placeholder names, so
+    rendering is a single join and validation a set comparison.
+    """
+
+    def __init__(self, template_text: str):
+        # Even indexes hold literal text, odd indexes placeholder names
+        self.segments = PROMPT_PLACEHOLDER.split(template_text)
+        self.placeholders = frozenset(self.segments[1::2])
+
+    def validate(self, variables: Dict[str, Any]):
+        if self.placeholders != variables.keys():
+            detail_message = {
+                "message": f"Prompt variable mismatch. Template placeholders: {set(self.placeholders)}. Provided variables: {set(variables.keys())}."
+            }
+            raise HTTPException(status_code=400, detail=detail_message)
+
+    def render(self, variables: Dict[str, Any]) -> str:
+        segments = self.segments.copy()
+        for index in range(1, len(segments), 2):
+            segments[index] = variables[segments[index]].get("text", "")
+        return "".join(segments)
+
+
+@lru_cache(maxsize=1024)
+def compile_prompt_template(template_text: str) -> CompiledPromptTemplate:
+    return CompiledPromptTemplate(template_text)
+
+
+def validate_prompt_variables(template_text: str, variables: Dict[str, Any]):
+    compile_prompt_template(template_text).validate(variables)
+
+
+def construct_prompt_text_from_variables(template_text: str, variables: dict) -> str:
+    return compile_prompt_template(template_text).render(variables)
+
+
+@app.get("/")
+@app.get("/bedrock/health/liveliness")
+async def health_check():
+    try:
+        async with httpx.AsyncClient() as client:
+            response = await client.get(
+                f"{LITELLM_ENDPOINT}/health/liveliness", timeout=5.0
+            )
+            if response.status_code == 200:
+                return CodecJSONResponse(
+                    content={"status": "healthy", "litellm": "connected"}
+                )
+            else:
+                return CodecJSONResponse(
+                    status_code=503, content={"status": "unhealthy", "litellm": "error"}
+                )
+    except Exception as e:
+        return CodecJSONResponse(
+            status_code=503,
+            content={"status": "unhealthy", "litellm": "disconnected", "error": str(e)},
+        )
+
+
+@app.get("/bedrock/health/readiness")
+async def readiness_check():
+    ready = loop_lag_monitor.is_ready()
+    return CodecJSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "status": "ready" if ready else "overloaded",
+            "event_loop": loop_lag_monitor.stats(),
+        },
+    )
+
+
+@app.get("/metrics")
+async def get_metrics():
+    if not metrics.enabled:
+        raise HTTPException(
+            status_code=404, detail={"error": "Prometheus metrics are disabled"}
+        )
+    # Multi-process collection reads every worker's files, so keep it off the loop
+    content, media_type = await anyio.to_thread.run_sync(metrics.render)
+    return Response(content=content, media_type=media_type)
+
+
+@app.get("/middleware/stats")
+async def get_middleware_stats(request: Request):
+    require_master_key(request)
+    return {name: provider() for name, provider in middleware_stats.items()}
+
+
+@app.get("/middleware/admission")
+async def get_admission_config(request: Request):
+    require_master_key(request)
+    return admission_controller.config
+
+
+@app.post("/middleware/admission")
+async def update_admission_config(request: Request):
+    """
+    Changes admission limits at runtime, e.g.
+    {"key_concurrency": 8, "model_overrides": {"gpt-4o": {"concurrency": 32}}}.
+    Override entries set to null are removed.
+    """
+    require_master_key(request)
+    try:
+        admission_controller.update_config(json_codec.loads(await request.body()))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail={"error": str(e)})
+    return admission_controller.config
+
+
+@app.get("/middleware/scheduler")
+async def get_scheduler_config(request: Request):
+    require_master_key(request)
+    return fair_scheduler.config
+
+
+@app.post("/middleware/scheduler")
+async def update_scheduler_config(request: Request):
+    """
+    Changes the fair scheduler at runtime, e.g.
+    {"concurrency": 64, "tenants": {"<api_key_hash>": {"tenant": "team-a", "weight": 4}}}.
+    """
+    require_master_key(request)
+    try:
+        fair_scheduler.update_config(json_codec.loads(await request.body()))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail={"error": str(e)})
+    return fair_scheduler.config
+
+
+@app.get("/middleware/prompt-variants")
+async def get_prompt_variant_stats(request: Request):
+    require_master_key(request)
+    return variant_selector.stats()
+
+
+@app.post("/middleware/prompt-variants")
+async def update_prompt_variant_config(request: Request):
+    """
+    Changes variant selection at runtime, e.g.
+    {"policy": "cheapest_under_slo", "slo_ms": 1500, "costs": {"gpt-4o": 10}}.
+    """
+    require_master_key(request)
+    try:
+        variant_selector.update_config(json_codec.loads(await request.body()))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail={"error": str(e)})
+    return variant_selector.stats()
+
 
+@app.post("/middleware/api-keys/invalidate")
+async def invalidate_api_key_cache(request: Request):
+    """Forgets cached key validations, e.g. after revoking a key in LiteLLM."""
+    require_master_key(request)
+    api_key_validator.invalidate()
+    return {"invalidated": True}
 
-def parse_prompt_arn(arn: str):
-    if "prompt/" not in arn:
-        return None, None
 
-    after_prompt = arn.split("prompt/", 1)[1]
+@app.post("/middleware/profile")
+async def profile_window(
+    request: Request, seconds: float = 10, output_format: str = "speedscope"
+):
+    """
+    Samples everything this worker's event loop runs for `seconds` and returns
+    the profile. With several workers, only the one serving this call is seen.
+    """
+    require_master_key(request)
+    if output_format not in OnDemandProfiler.FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail={
+                "error": f"output_format must be one of {list(OnDemandProfiler.FORMATS)}"
+            },
+        )
+    if not 0 < seconds <= PROFILE_MAX_WINDOW_SECONDS:
+        raise HTTPException(
+            status_code=400,
+            detail={"error": f"seconds must be in (0, {PROFILE_MAX_WINDOW_SECONDS}]"},
+        )
+    target = f"window of {seconds}s"
+    profiler = on_demand_profiler.start(target, "disabled")
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        on_demand_profiler.stop(profiler)
+    profile = await on_demand_profiler.save(
+        profiler, output_format, target, on_demand_profiler.new_id()
+    )
+    return FileResponse(
+        profile["path"],
+        media_type=profile["media_type"],
+        headers={"X-Profile-Id": profile["id"]},
+    )
 
-    if ":" in after_prompt:
-        prompt_id, prompt_version = after_prompt.split(":", 1)
-        return prompt_id, prompt_version
-    else:
-        return after_prompt, None
 
+@app.get("/middleware/profiles")
+async def list_profiles(request: Request):
+    require_master_key(request)
+    return {"data": on_demand_profiler.list()}
 
-def validate_prompt_variables(template_text: str, variables: Dict[str, Any]):
-    found_placeholders = re.findall(r"{{\s*(\w+)\s*}}", template_text)
-    placeholders_set = set(found_placeholders)
-    variables_set = set(variables.keys())
 
-    if placeholders_set != variables_set:
-        detail_message = {
-            "message": f"Prompt variable mismatch. Template placeholders: {placeholders_set}. Provided variables: {variables_set}."
-        }
-        raise HTTPException(status_code=400, detail=detail_message)
+@app.get("/middleware/profiles/{profile_id}")
+async def get_profile(profile_id: str, request: Request):
+    require_master_key(request)
+    profile = on_demand_profiler.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail={"error": "Profile not found"})
+    return FileResponse(profile["path"], media_type=profile["media_type"])
 
 
-def construct_prompt_text_from_variables(template_text: str, variables: dict) -> str:
-    for var_name, var_value in variables.items():
-        value = var_value.get("text", "")
-        template_text = template_text.replace(f"{{{{{var_name}}}}}", value)
-    return template_text
+@app.post("/middleware/prompt-cache/invalidate")
+async def invalidate_prompt_cache(request: Request):
+    require_master_key(request)
+    prompt_cache.invalidate()
+    return {"invalidated": True}
 
 
-@app.get("/")
-@app.get("/bedrock/health/liveliness")
-async def health_check():
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{LITELLM_ENDPOINT}/health/liveliness", timeout=5.0
-            )
-            if response.status_code == 200:
-                return JSONResponse(
-                    content={"status": "healthy", "litellm": "connected"}
-                )
-            else:
-                return JSONResponse(
-                    status_code=503, content={"status": "unhealthy", "litellm": "error"}
-                )
-    except Exception as e:
-        return JSONResponse(
-            status_code=503,
-            content={"status": "unhealthy", "litellm": "disconnected", "error": str(e)},
-        )
+@app.post("/middleware/cache/purge")
+async def purge_response_cache(request: Request):
+    """
+    Purges the middleware response cache. An optional JSON body of
+    {"api_key": "..."} or {"api_key_hash": "..."} limits the purge to one tenant.
+    """
+    require_master_key(request)
+    body = await request.body()
+    options = json_codec.loads(body) if body else {}
+    prefix = ""
+    if options.get("api_key"):
+        prefix = f"{hash_api_key(options['api_key'])}:"
+    elif options.get("api_key_hash"):
+        prefix = f"{options['api_key_hash']}:"
+    purged = await response_cache.purge(prefix)
+    return {"purged": purged}
 
 
 async def process_chat_request(
     model_id: str, request: Request
-) -> (Dict[str, Any], str):
-    body = await request.json()
+) -> (Dict[str, Any] | bytes, str):
+    body = json_codec.loads(await request.body())
     additional_fields = body.get("additionalModelRequestFields", {})
 
     session_id = additional_fields.get("session_id", None)
@@ -464,13 +3774,18 @@ async def process_chat_request(
     if auth_header and auth_header.startswith("Bearer "):
         api_key = auth_header[len("Bearer ") :]
     else:
-        print(f"Missing or invalid Authorization header: {auth_header}")
+        log_event(
+            logging.INFO,
+            "Missing or invalid Authorization header",
+            route="bedrock",
+        )
         raise HTTPException(
             status_code=401, detail={"error": "Missing or invalid Authorization header"}
         )
 
-    provided_hash = hash_api_key(api_key)
+    provided_hash = await validate_api_key(api_key, request)
     # print(f"provided_hash: {provided_hash}")
+    await admission_controller.admit(request, provided_hash, model_id)
 
     if history_enabled:
         if session_id is not None:
@@ -479,8 +3794,11 @@ async def process_chat_request(
             if session_data is not None:
                 # Verify API key hash matches
                 if session_data["api_key_hash"] != provided_hash:
-                    print(
-                        f"Unauthorized: API key does not match session owner: {session_data['api_key_hash']} provided_hash: {provided_hash}"
+                    log_event(
+                        logging.INFO,
+                        "Unauthorized: API key does not match session owner",
+                        route="bedrock",
+                        session_id=session_id,
                     )
                     raise HTTPException(
                         status_code=401,
@@ -503,7 +3821,9 @@ async def process_chat_request(
     else:
         chat_history = []
 
-    openai_format = await convert_bedrock_to_openai(model_id, body, False)
+    with timing_stage("convert"):
+        openai_format = await convert_bedrock_to_openai(model_id, body, False, request)
+    request.state.model = openai_format["model"]
     # print(f"openai_format: {openai_format}")
 
     if history_enabled:
@@ -517,25 +3837,66 @@ async def process_chat_request(
         # Replace openai_format["messages"] with the full chat_history
         openai_format["messages"] = chat_history
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            LITELLM_CHAT,
-            json=openai_format,
-            headers={
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json",
-            },
-            timeout=30.0,
+    # Cached entries hold the already-converted Bedrock response body
+    cache_key = None
+    if RESPONSE_CACHE and response_cache.is_eligible(openai_format, history_enabled):
+        cache_read, cache_write, cache_max_age, cache_ttl = get_cache_directives(
+            request
         )
+        cache_key = response_cache.make_key(
+            provided_hash, "bedrock", json_codec.dumps_sorted(openai_format)
+        )
+        if cache_read:
+            cached = await response_cache.get(cache_key, cache_max_age)
+            if cached is not None:
+                request.state.cache_status = "HIT"
+                return cached, session_id
+        if not cache_write:
+            cache_key = None
+
+    deadline = get_request_deadline(openai_format["model"])
+    started = time.perf_counter()
+    async with httpx.AsyncClient() as client:
+        try:
+            with anyio.fail_after(deadline), timing_stage("upstream"), tracing.span(
+                "litellm.chat",
+                "CLIENT",
+                **{"gen_ai.request.model": openai_format["model"]},
+            ):
+                response = await client.post(
+                    LITELLM_CHAT,
+                    content=json_codec.dumps(openai_format),
+                    headers=tracing.inject(
+                        {
+                            "Authorization": f"Bearer {api_key}",
+                            "Content-Type": "application/json",
+                        }
+                    ),
+                    timeout=deadline,
+                )
+        except (TimeoutError, httpx.TimeoutException):
+            record_variant_outcome(request, started, 504)
+            raise HTTPException(
+                status_code=504,
+                detail={"error": f"LiteLLM did not respond within {deadline}s"},
+            )
+        except httpx.TransportError:
+            record_variant_outcome(request, started, 502)
+            raise
 
+        record_variant_outcome(request, started, response.status_code)
+        metrics.upstream(
+            "bedrock", openai_format["model"], response.elapsed.total_seconds()
+        )
         if response.status_code != 200:
             raise HTTPException(
                 status_code=response.status_code,
                 detail={"error": f"Error from LiteLLM endpoint: {response.text}"},
             )
 
-        openai_response = response.json()
-        bedrock_response = await convert_openai_to_bedrock(openai_response)
+        with timing_stage("convert"):
+            openai_response = json_codec.loads(response.content)
+            bedrock_response = await convert_openai_to_bedrock(openai_response)
 
     # Append assistant's response to history
     if history_enabled:
@@ -546,13 +3907,19 @@ async def process_chat_request(
         update_chat_history(session_id, chat_history)
         bedrock_response["session_id"] = session_id
 
+    if cache_key:
+        encoded_response = json_codec.dumps(bedrock_response)
+        await response_cache.set(cache_key, encoded_response, cache_ttl)
+        request.state.cache_status = "MISS"
+        return encoded_response, session_id
+
     return bedrock_response, session_id
 
 
 async def process_streaming_chat_request(
     model_id: str, request: Request
-) -> (AsyncGenerator, str, List[Dict[str, str]], List[str], bool):
-    body = await request.json()
+) -> (AsyncGenerator, str, List[Dict[str, str]], List[str], bool, Dict[str, bool]):
+    body = json_codec.loads(await request.body())
     auth_header = request.headers.get("Authorization")
     if auth_header and auth_header.startswith("Bearer "):
         api_key = auth_header[len("Bearer ") :]
@@ -561,7 +3928,10 @@ async def process_streaming_chat_request(
             status_code=401, detail={"error": "Missing or invalid Authorization header"}
         )
 
-    provided_hash = hash_api_key(api_key)
+    provided_hash = await validate_api_key(api_key, request)
+    await admission_controller.admit(
+        request, provided_hash, model_id, is_streaming=True
+    )
     additional_fields = body.get("additionalModelRequestFields", {})
     session_id = additional_fields.get("session_id", None)
     enable_history = additional_fields.get("enable_history", False)
@@ -590,7 +3960,9 @@ async def process_streaming_chat_request(
     else:
         chat_history = []
 
-    openai_params = await convert_bedrock_to_openai(model_id, body, True)
+    with timing_stage("convert"):
+        openai_params = await convert_bedrock_to_openai(model_id, body, True, request)
+    request.state.model = openai_params["model"]
 
     # Append the user message to chat_history
     if history_enabled:
@@ -604,36 +3976,163 @@ async def process_streaming_chat_request(
 
     # print(f'final message sent to llm: {openai_params["messages"]}')
 
-    client = AsyncOpenAI(api_key=api_key, base_url=LITELLM_ENDPOINT)
-    stream = await client.chat.completions.create(**openai_params)
+    deadline = get_request_deadline(openai_params["model"])
+    started = time.perf_counter()
+    # LiteLLM's SSE is transcoded straight into event-stream frames, without
+    # building SDK chunk objects per token
+    session = aiohttp.ClientSession()
+    # Covers the whole upstream stream, so it ends in stream_wrapper
+    upstream_span = tracing.start_span(
+        "litellm.chat",
+        "CLIENT",
+        **{"gen_ai.request.model": openai_params["model"], "stream": True},
+    )
+    try:
+        with timing_stage("upstream"):
+            response = await session.post(
+                LITELLM_CHAT,
+                data=json_codec.dumps(openai_params),
+                headers=tracing.inject(
+                    {
+                        "Content-Type": "application/json",
+                        "Authorization": f"Bearer {api_key}",
+                    },
+                    upstream_span,
+                ),
+                timeout=aiohttp.ClientTimeout(total=deadline),
+            )
+        metrics.upstream(
+            "bedrock", openai_params["model"], time.perf_counter() - started
+        )
+        if response.status != 200:
+            record_variant_outcome(request, started, response.status)
+            error_text = await response.text()
+            response.close()
+            raise RuntimeError(f"Error code: {response.status} - {error_text}")
+    except BaseException as e:
+        if isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError)):
+            record_variant_outcome(request, started, 502)
+        tracing.end_span(upstream_span, e)
+        await session.close()
+        raise
 
     assistant_content_parts = []
+    stream_state = {"completed": False, "persisted": False}
+
+    flush_delay = get_delta_flush_delay(request, "bedrock")
+
+    async def upstream_chunks():
+        async for data in iter_sse_data(response.content):
+            try:
+                yield json_codec.loads(data)
+            except json.JSONDecodeError:
+                continue
 
     async def stream_wrapper():
         message_started = False
         content_block_index = 0
-        async for chunk in stream:
-            delta = chunk.choices[0].delta
-            finish_reason = chunk.choices[0].finish_reason
-
-            if delta.role and not message_started:
-                event_payload = json.dumps({"role": delta.role}).encode("utf-8")
-                yield create_event_message(event_payload, "messageStart")
-                message_started = True
-
-            if delta.content:
-                assistant_content_parts.append(delta.content)
-                event_payload = json.dumps(
-                    {
-                        "contentBlockIndex": content_block_index,
-                        "delta": {"text": delta.content},
-                    }
-                ).encode("utf-8")
-                yield create_event_message(event_payload, "contentBlockDelta")
+        block_open = False
+        usage = None
+        first_token_at = last_token_at = None
+        stream_error = None
+        chunks = upstream_chunks()
+        metrics.stream_started("bedrock")
+        if flush_delay:
+            chunks = coalesce_deltas(
+                chunks, flush_delay, get_sse_delta_text, set_sse_delta_text
+            )
+        try:
+            async for chunk in chunks:
+                if chunk.get("usage"):
+                    usage = chunk["usage"]
+                if not chunk.get("choices"):
+                    continue
+                choice = chunk["choices"][0]
+                delta = choice.get("delta") or {}
+                content = delta.get("content")
+
+                if not message_started and (delta.get("role") or content):
+                    event_payload = json_codec.dumps(
+                        {"role": delta.get("role") or "assistant"}
+                    )
+                    yield create_event_message(event_payload, "messageStart")
+                    message_started = True
+
+                if content:
+                    last_token_at = time.perf_counter()
+                    if not assistant_content_parts:
+                        # Time to first token is the variant's latency sample
+                        first_token_at = last_token_at
+                        record_variant_outcome(request, started)
+                    assistant_content_parts.append(content)
+                    event_payload = json_codec.dumps(
+                        {
+                            "contentBlockIndex": content_block_index,
+                            "delta": {"text": content},
+                        }
+                    )
+                    yield create_event_message(event_payload, "contentBlockDelta")
+                    block_open = True
+
+                finish_reason = choice.get("finish_reason")
+                if finish_reason:
+                    if block_open:
+                        event_payload = json_codec.dumps(
+                            {"contentBlockIndex": content_block_index}
+                        )
+                        yield create_event_message(event_payload, "contentBlockStop")
+                        block_open = False
+                    event_payload = json_codec.dumps(
+                        {"stopReason": STOP_REASON_MAP.get(finish_reason, "end_turn")}
+                    )
+                    yield create_event_message(event_payload, "messageStop")
 
-            if finish_reason == "stop":
-                event_payload = json.dumps({"stopReason": "end_turn"}).encode("utf-8")
-                yield create_event_message(event_payload, "messageStop")
+            metadata = {
+                "metrics": {"latencyMs": int((time.perf_counter() - started) * 1000)}
+            }
+            if usage:
+                metadata["usage"] = {
+                    "inputTokens": usage.get("prompt_tokens", 0),
+                    "outputTokens": usage.get("completion_tokens", 0),
+                    "totalTokens": usage.get("total_tokens", 0),
+                }
+            if server_timing.get() is not None:
+                # Save history before the last event so its time is included
+                if history_enabled and assistant_content_parts:
+                    await finalize_streaming_chat_history(
+                        session_id, chat_history, assistant_content_parts
+                    )
+                    stream_state["persisted"] = True
+                metadata["serverTiming"] = server_timing_trailer(first_token_at)
+            yield create_event_message(json_codec.dumps(metadata), "metadata")
+            stream_state["completed"] = True
+        except asyncio.TimeoutError as e:
+            record_variant_outcome(request, started, 504)
+            log_event(
+                logging.WARNING,
+                "Stream exceeded deadline",
+                route="bedrock",
+                model=openai_params["model"],
+                deadline=deadline,
+            )
+            stream_error = e
+        finally:
+            # Runs on completion, deadline and client disconnect alike. Shielded
+            # so that a cancelled stream still closes the upstream connection.
+            with anyio.CancelScope(shield=True):
+                await chunks.aclose()
+                response.close()
+                await session.close()
+            metrics.stream_finished(
+                "bedrock",
+                openai_params["model"],
+                started,
+                first_token_at,
+                last_token_at,
+                len(assistant_content_parts),
+                usage.get("completion_tokens") if usage else None,
+            )
+            tracing.end_span(upstream_span, stream_error)
 
     return (
         stream_wrapper(),
@@ -641,6 +4140,7 @@ async def process_streaming_chat_request(
         chat_history,
         assistant_content_parts,
         history_enabled,
+        stream_state,
     )
 
 
@@ -674,31 +4174,51 @@ async def handle_bedrock_streaming_request(model_id: str, request: Request):
             chat_history,
             assistant_content_parts,
             history_enabled,
+            stream_state,
         ) = await process_streaming_chat_request(model_id, request)
 
         async def finalizing_stream():
-            async for event in stream_wrapper:
-                yield event
-            if history_enabled:
-                await finalize_streaming_chat_history(
-                    session_id, chat_history, assistant_content_parts
-                )
+            try:
+                async for event in stream_wrapper:
+                    yield event
+            finally:
+                with anyio.CancelScope(shield=True):
+                    await stream_wrapper.aclose()
+                    if (
+                        history_enabled
+                        and not stream_state["persisted"]
+                        and should_record_response(
+                            stream_state["completed"], assistant_content_parts
+                        )
+                    ):
+                        await finalize_streaming_chat_history(
+                            session_id, chat_history, assistant_content_parts
+                        )
 
-        response = StreamingResponse(
-            finalizing_stream(), media_type="application/vnd.amazon.eventstream"
+        response = DisconnectAwareStreamingResponse(
+            buffered_stream(finalizing_stream()),
+            media_type="application/vnd.amazon.eventstream",
         )
         if history_enabled:
             response.headers["X-Session-Id"] = session_id
         return response
+    except (AdmissionRejected, InvalidApiKey) as he:
+        return CodecJSONResponse(
+            status_code=he.status_code,
+            content={
+                "Message": he.detail,
+            },
+            headers=he.headers,
+        )
     except HTTPException as he:
-        return JSONResponse(
+        return CodecJSONResponse(
             status_code=400,
             content={
                 "Message": he.detail,
             },
         )
     except Exception as e:
-        return JSONResponse(
+        return CodecJSONResponse(
             status_code=500,
             content={
                 "Message": f"Internal server error: {str(e)}",
@@ -717,24 +4237,43 @@ async def handle_bedrock_request_prompts(
 @app.post("/bedrock/model/{model_id}/converse")
 async def handle_bedrock_request(model_id: str, request: Request):
     try:
+        loop_lag_monitor.check(is_streaming=False)
         bedrock_response, session_id = await process_chat_request(model_id, request)
 
         if session_id:
             headers = {"X-Session-Id": session_id}
         else:
             headers = {}
-        return JSONResponse(content=bedrock_response, headers=headers)
+        cache_status = getattr(request.state, "cache_status", None)
+        if cache_status:
+            headers["X-Cache"] = cache_status
+        if isinstance(bedrock_response, bytes):
+            return Response(
+                content=bedrock_response,
+                headers=headers,
+                media_type="application/json",
+            )
+        return CodecJSONResponse(content=bedrock_response, headers=headers)
     except HTTPException as he:
-        print(f"HTTPException he: {he}")
-        return JSONResponse(
+        log_event(
+            logging.INFO,
+            "Bedrock request rejected",
+            route="bedrock",
+            status_code=he.status_code,
+            detail=he.detail,
+        )
+        return CodecJSONResponse(
             status_code=he.status_code,
             content={
                 "Message": he.detail,
             },
+            headers=he.headers,
         )
     except Exception as e:
-        print(f"exception e: {e}")
-        return JSONResponse(
+        log_event(
+            logging.ERROR, "Bedrock request failed", route="bedrock", exc_info=True
+        )
+        return CodecJSONResponse(
             status_code=500,
             content={
                 "Message": f"Internal server error: {str(e)}",
@@ -742,16 +4281,160 @@ async def handle_bedrock_request(model_id: str, request: Request):
         )
 
 
-async def get_chat_stream(
+# Top-level keys consumed by the middleware and never forwarded to LiteLLM
+REQUEST_CONTROL_FIELDS = ("enable_history", "session_id", "promptVariables")
+
+_JSON_STRUCTURAL = re.compile(rb'[{}\[\],:"]')
+
+
+def iter_json_tokens(body: bytes, pos: int = 0):
+    """
+    Yields (start, end) for each string and structural character in a JSON
+    document. String bodies are skipped with bytes.find (memchr speed), so large
+    prompt values cost almost nothing to step over.
+    """
+    search = _JSON_STRUCTURAL.search
+    find = body.find
+    while True:
+        match = search(body, pos)
+        if match is None:
+            return
+        start = match.start()
+        if body[start] != 0x22:  # not '"'
+            pos = start + 1
+            yield start, pos
+            continue
+        end = find(b'"', start + 1)
+        while end != -1:
+            backslashes = 0
+            while body[end - 1 - backslashes] == 0x5C:  # '\\'
+                backslashes += 1
+            if backslashes % 2 == 0:
+                break
+            end = find(b'"', end + 1)
+        if end == -1:
+            return
+        pos = end + 1
+        yield start, pos
+
+
+def scan_top_level_fields(body: bytes) -> Optional[List[tuple]]:
+    """
+    Locates the members of a top-level JSON object without decoding their values.
+    Returns a list of (key, member_start, value_start, value_end) byte offsets, or
+    None if the body does not look like a JSON object (callers then fall back to
+    a full decode, which reports the error).
+    """
+    start = len(body) - len(body.lstrip())
+    if not body[start : start + 1] == b"{":
+        return None
+
+    fields = []
+    depth = 0
+    key = None
+    member_start = value_start = None
+    end = None
+    for token_start, token_end in iter_json_tokens(body, start):
+        char = body[token_start : token_start + 1]
+        if depth == 1:
+            if char == b'"':
+                if key is None:
+                    key = json_codec.loads(body[token_start:token_end])
+                    member_start = token_start
+                continue
+            if char == b":":
+                if key is None or value_start is not None:
+                    return None
+                value_start = token_end
+                continue
+            if char in (b",", b"}"):
+                if key is not None:
+                    if value_start is None:
+                        return None
+                    fields.append((key, member_start, value_start, token_start))
+                elif char == b"," or fields:
+                    return None
+                key = member_start = value_start = None
+                if char == b"}":
+                    depth = 0
+                    end = token_end
+                    break
+                continue
+        if char in (b"{", b"["):
+            depth += 1
+        elif char in (b"}", b"]"):
+            depth -= 1
+            if depth < 1:
+                return None
+
+    if end is None or body[end:].strip():
+        return None
+    return fields
+
+
+def strip_top_level_fields(body: bytes, fields: List[tuple], names) -> bytes:
+    """
+    Rebuilds the object from the original member bytes, dropping the given keys.
+    Member values are copied verbatim, never decoded or re-encoded.
+    """
+    view = memoryview(body)
+    kept = [
+        view[member_start:value_end]
+        for key, member_start, _, value_end in fields
+        if key not in names
+    ]
+    return b"{" + b",".join(kept) + b"}"
+
+
+def extract_passthrough_body(body: bytes) -> Optional[tuple]:
+    """
+    Returns (control_fields, upstream_body) when the request can be forwarded
+    as-is minus the control keys: history disabled and not a managed prompt.
+    Returns None when the messages need merging or rewriting.
+    """
+    fields = scan_top_level_fields(body)
+    if fields is None:
+        return None
+
+    spans = {key: (value_start, value_end) for key, _, value_start, value_end in fields}
+    control = {}
+    for name in ("model", "stream", "temperature", "enable_history", "session_id"):
+        if name in spans:
+            value_start, value_end = spans[name]
+            control[name] = json_codec.loads(body[value_start:value_end])
+
+    history_enabled = (control.get("session_id") is not None) or control.get(
+        "enable_history", False
+    )
+    model_id = control.get("model")
+    if history_enabled or (
+        isinstance(model_id, str) and model_id.startswith("arn:aws:bedrock:")
+    ):
+        return None
+
+    return control, strip_top_level_fields(body, fields, REQUEST_CONTROL_FIELDS)
+
+
+async def open_chat_stream(
     api_key: str,
-    data: dict,
+    request_body: bytes,
     session_id: str,
     chat_history: list,
     history_enabled: bool,
-):
+    deadline: float,
+    flush_delay: Optional[float] = None,
+    model: Optional[str] = None,
+    report_outcome: Optional[Callable[[int], None]] = None,
+) -> (Dict[str, str], AsyncGenerator):
     """
-    Returns a StreamingResponse that continuously yields messages from the LLM endpoint
-    using aiohttp, and also returns the upstream headers in the response.
+    Starts the streaming request to the LLM endpoint using aiohttp and returns the
+    upstream headers with an async generator of SSE events.
+    The upstream request is bounded by `deadline` seconds end to end and is
+    closed as soon as the generator is cancelled (e.g. the client disconnects).
+    With `flush_delay`, content deltas are coalesced (see coalesce_deltas).
+    `model` only labels the stream's metrics. `report_outcome` is called with
+    200 at the first content (or the end of an empty stream) and 504 when the
+    deadline cuts the stream short; it should ignore repeat calls.
     """
 
     # Semgrep incorrectly marks this method as unused
@@ -779,77 +4462,178 @@ async def get_chat_stream(
         "Content-Type": "application/json",
         "Authorization": f"Bearer {api_key}",
     }
-    response = await session.post(
-        f"{LITELLM_ENDPOINT}/v1/chat/completions",
-        json=data,
-        headers=headers,
-        timeout=None,  # or aiohttp.ClientTimeout(...)
+    started = time.perf_counter()
+    # Covers the whole upstream stream, so it ends in stream_events
+    upstream_span = tracing.start_span(
+        "litellm.chat", "CLIENT", **{"gen_ai.request.model": model, "stream": True}
     )
+    try:
+        with timing_stage("upstream"):
+            response = await session.post(
+                f"{LITELLM_ENDPOINT}/v1/chat/completions",
+                data=request_body,
+                headers=tracing.inject(headers, upstream_span),
+                timeout=aiohttp.ClientTimeout(total=deadline),
+            )
+    except BaseException as e:
+        tracing.end_span(upstream_span, e)
+        await session.close()
+        raise
+    metrics.upstream("openai", model, time.perf_counter() - started)
 
     # Extract upstream headers
     response_headers = dict(response.headers)
 
+    async def upstream_chunks():
+        # Read the response line by line
+        async for line in read_linewise(response.content):
+            line = line.strip()
+            if not line:
+                continue
+
+            # Check for sentinel lines
+            if line.startswith("data: [DONE]"):
+                break
+
+            # The OpenAI-like endpoints often prepend "data: " before JSON
+            if line.startswith("data: "):
+                line = line[len("data: ") :]
+
+            # Attempt to parse JSON from the line
+            try:
+                yield json_codec.loads(line)
+            except json.JSONDecodeError:
+                continue
+
     # Define an async generator that will yield SSE data from the response.
     async def stream_events():
         assistant_content_parts = []
         first_chunk = True
+        completed = False
+        content_chunks = 0
+        first_token_at = last_token_at = None
+        completion_tokens = None
+        stream_error = None
+        chunk_dict = {}
+        persisted = False
+
+        def record_history():
+            chat_history.append(
+                {"role": "assistant", "content": "".join(assistant_content_parts)}
+            )
+            update_chat_history(session_id, chat_history)
 
-        try:
-            # Read the response line by line
-            async for line in read_linewise(response.content):
-                line = line.strip()
-                if not line:
-                    continue
-
-                # Check for sentinel lines
-                if line.startswith("data: [DONE]"):
-                    break
-
-                # The OpenAI-like endpoints often prepend "data: " before JSON
-                if line.startswith("data: "):
-                    line = line[len("data: ") :]
-
-                # Attempt to parse JSON from the line
-                try:
-                    chunk_dict = json.loads(line)
-                except json.JSONDecodeError:
-                    continue
+        chunks = upstream_chunks()
+        metrics.stream_started("openai")
+        if flush_delay:
+            chunks = coalesce_deltas(
+                chunks, flush_delay, get_sse_delta_text, set_sse_delta_text
+            )
 
+        try:
+            async for chunk_dict in chunks:
                 # Inject session_id only into the first chunk if you wish
                 if first_chunk and history_enabled:
                     chunk_dict["session_id"] = session_id
                 first_chunk = False
 
                 # Yield as a Server-Sent Event
-                yield f"data: {json.dumps(chunk_dict)}\n\n".encode("utf-8")
+                yield b"data: " + json_codec.dumps(chunk_dict) + b"\n\n"
+
+                if chunk_dict.get("usage"):
+                    completion_tokens = chunk_dict["usage"].get("completion_tokens")
 
                 # Optionally accumulate partial content
                 choice = chunk_dict["choices"][0]
                 delta = choice.get("delta", {})
                 finish_reason = choice.get("finish_reason", None)
 
-                if history_enabled and "content" in delta and delta["content"]:
-                    assistant_content_parts.append(delta["content"])
+                if "content" in delta and delta["content"]:
+                    last_token_at = time.perf_counter()
+                    if first_token_at is None:
+                        first_token_at = last_token_at
+                        if report_outcome:
+                            report_outcome(200)
+                    content_chunks += 1
+                    if history_enabled:
+                        assistant_content_parts.append(delta["content"])
 
                 # You could break if finish_reason == "stop", if desired
                 # if finish_reason == "stop":
                 #     break
 
-            # Once streaming ends (for any reason), finalize chat history if desired
-            if history_enabled and assistant_content_parts:
-                assistant_message = {
-                    "role": "assistant",
-                    "content": "".join(assistant_content_parts),
+            completed = True
+            if report_outcome:
+                report_outcome(200)
+
+            if server_timing.get() is not None:
+                # Save history before the last event so its time is included
+                if history_enabled and assistant_content_parts:
+                    record_history()
+                    persisted = True
+                # Shaped like the usage chunk: no choices, so clients skip it
+                trailer = {
+                    key: chunk_dict[key]
+                    for key in ("id", "object", "created", "model")
+                    if key in chunk_dict
                 }
-                chat_history.append(assistant_message)
-                update_chat_history(session_id, chat_history)
+                trailer["choices"] = []
+                trailer["server_timing"] = server_timing_trailer(first_token_at)
+                yield b"data: " + json_codec.dumps(trailer) + b"\n\n"
+
+        except asyncio.TimeoutError as e:
+            stream_error = e
+            if report_outcome:
+                report_outcome(504)
+            log_event(
+                logging.WARNING,
+                "Stream exceeded deadline",
+                route="openai",
+                deadline=deadline,
+            )
+            error = {
+                "error": {"message": "Upstream deadline exceeded", "type": "timeout"}
+            }
+            yield b"data: " + json_codec.dumps(error) + b"\n\n"
 
         finally:
-            # Very important: Close the session once we're done streaming.
-            await session.close()
+            # Very important: Close the session once we're done streaming. This also
+            # runs when the client disconnects, so the upstream generation is cancelled
+            # instead of running to completion. Shielded so cancellation can't skip it.
+            with anyio.CancelScope(shield=True):
+                await chunks.aclose()
+                response.close()
+                await session.close()
+            metrics.stream_finished(
+                "openai",
+                model,
+                started,
+                first_token_at,
+                last_token_at,
+                content_chunks,
+                completion_tokens,
+            )
+            tracing.end_span(upstream_span, stream_error)
+
+            # Finalize chat history; early-ended streams follow PARTIAL_RESPONSE_POLICY
+            if (
+                history_enabled
+                and assistant_content_parts
+                and not persisted
+                and should_record_response(completed, assistant_content_parts)
+            ):
+                record_history()
+
+    return response_headers, stream_events()
 
+
+def build_sse_response(
+    events: AsyncGenerator, response_headers: Dict[str, str]
+) -> StreamingResponse:
     # Build the StreamingResponse using our generator
-    sresponse = StreamingResponse(stream_events(), media_type="text/event-stream")
+    sresponse = DisconnectAwareStreamingResponse(
+        buffered_stream(events), media_type="text/event-stream"
+    )
 
     # Exclude certain hop-by-hop or irrelevant headers
     excluded_headers = {
@@ -870,14 +4654,80 @@ async def get_chat_stream(
     return sresponse
 
 
+async def get_chat_stream(
+    api_key: str,
+    request_body: bytes,
+    session_id: str,
+    chat_history: list,
+    history_enabled: bool,
+    deadline: float,
+    flush_delay: Optional[float] = None,
+    model: Optional[str] = None,
+    report_outcome: Optional[Callable[[int], None]] = None,
+):
+    """
+    Returns a StreamingResponse that continuously yields messages from the LLM endpoint
+    using aiohttp, and also returns the upstream headers in the response.
+    """
+    response_headers, events = await open_chat_stream(
+        api_key,
+        request_body,
+        session_id,
+        chat_history,
+        history_enabled,
+        deadline,
+        flush_delay,
+        model,
+        report_outcome,
+    )
+    return build_sse_response(events, response_headers)
+
+
+async def post_chat_completion(
+    api_key: str, request_body: bytes, deadline: float, model: Optional[str] = None
+) -> (int, Dict[str, str], Dict[str, Any]):
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}",
+    }
+    started = time.perf_counter()
+    with timing_stage("upstream"), tracing.span(
+        "litellm.chat", "CLIENT", **{"gen_ai.request.model": model}
+    ):
+        async with aiohttp.ClientSession() as session:
+            async with session.post(
+                f"{LITELLM_ENDPOINT}/v1/chat/completions",
+                headers=tracing.inject(headers),
+                data=request_body,
+                timeout=aiohttp.ClientTimeout(total=deadline),
+            ) as resp:
+                response_headers = dict(resp.headers)
+                # Avoid passing through invalid content-length
+                response_headers.pop("Content-Length", None)
+                response_dict = json_codec.loads(await resp.read())
+    metrics.upstream("openai", model, time.perf_counter() - started)
+    return resp.status, response_headers, response_dict
+
+
 @app.post("/v1/chat/completions")
 @app.post("/chat/completions")
 async def proxy_request(request: Request):
     body = await request.body()
+    started = time.perf_counter()
 
     try:
-        data = json.loads(body)
+        with timing_stage("convert"):
+            passthrough = None
+            if LAZY_BODY_PARSING and len(body) >= LAZY_BODY_PARSING_MIN_BYTES:
+                passthrough = extract_passthrough_body(body)
+            if passthrough is not None:
+                # Only the control fields were decoded; the rest is forwarded verbatim
+                data, upstream_body = passthrough
+            else:
+                data = json_codec.loads(body)
+                upstream_body = None
         is_streaming = data.get("stream", False)
+        loop_lag_monitor.check(is_streaming)
 
         enable_history = data.pop("enable_history", False)
         session_id = data.pop("session_id", None)
@@ -890,7 +4740,10 @@ async def proxy_request(request: Request):
                 status_code=401,
                 detail={"error": "Missing or invalid Authorization header"},
             )
-        provided_hash = hash_api_key(api_key)
+        provided_hash = await validate_api_key(api_key, request)
+        await admission_controller.admit(
+            request, provided_hash, data.get("model"), is_streaming
+        )
 
         # Prepare or load chat_history
         if history_enabled:
@@ -918,13 +4771,14 @@ async def proxy_request(request: Request):
             # History not enabled: start with empty
             chat_history = []
 
-        # Merge incoming messages into chat_history in original order
-        new_messages = data.get("messages", [])
-        for msg in new_messages:
-            chat_history.append(msg)
+        if upstream_body is None:
+            # Merge incoming messages into chat_history in original order
+            new_messages = data.get("messages", [])
+            for msg in new_messages:
+                chat_history.append(msg)
 
-        # Now data["messages"] should be the entire conversation the model sees
-        data["messages"] = chat_history
+            # Now data["messages"] should be the entire conversation the model sees
+            data["messages"] = chat_history
 
         # ---------------------------------------------------------------------
         # Handle optional "Bedrock Prompt" logic (unchanged from your snippet):
@@ -933,23 +4787,13 @@ async def proxy_request(request: Request):
         prompt_variables = data.pop("promptVariables", {})
         final_prompt_text = None
         if model_id and model_id.startswith("arn:aws:bedrock:"):
-            prompt_id, prompt_version = parse_prompt_arn(model_id)
-            if prompt_id:
-                if prompt_version:
-                    prompt = bedrock_client.get_prompt(
-                        promptIdentifier=prompt_id, promptVersion=prompt_version
-                    )
-                else:
-                    prompt = bedrock_client.get_prompt(promptIdentifier=prompt_id)
-
-                variants = prompt.get("variants", [])
-                variant = variants[0]
-                template_text = variant["templateConfiguration"]["text"]["text"]
-
-                validate_prompt_variables(template_text, prompt_variables)
-                final_prompt_text = construct_prompt_text_from_variables(
-                    template_text, prompt_variables
+            managed_prompt = await get_managed_prompt(model_id)
+            if managed_prompt:
+                variant, template = select_prompt_variant(
+                    request, model_id, managed_prompt, is_streaming
                 )
+                template.validate(prompt_variables)
+                final_prompt_text = template.render(prompt_variables)
 
                 if "modelId" in variant:
                     data["model"] = variant["modelId"]
@@ -957,28 +4801,100 @@ async def proxy_request(request: Request):
         if final_prompt_text:
             data["messages"] = [{"role": "user", "content": final_prompt_text}]
 
+        if upstream_body is None:
+            with timing_stage("convert"):
+                upstream_body = json_codec.dumps(data)
+        model = request.state.model = data.get("model")
+        deadline = get_request_deadline(model)
+
+        # Cache and coalescing keys hash the normalized request. A passthrough
+        # body was never decoded, so those key on its exact bytes
+        canonical_request = upstream_body if passthrough is not None else None
+        cache_key = None
+        if (
+            RESPONSE_CACHE
+            and not is_streaming
+            and response_cache.is_eligible(data, history_enabled)
+        ):
+            cache_read, cache_write, cache_max_age, cache_ttl = get_cache_directives(
+                request
+            )
+            if canonical_request is None:
+                canonical_request = json_codec.dumps_sorted(data)
+            cache_key = response_cache.make_key(
+                provided_hash, "openai", canonical_request
+            )
+            if cache_read:
+                cached = await response_cache.get(cache_key, cache_max_age)
+                if cached is not None:
+                    return Response(
+                        content=cached,
+                        headers={"X-Cache": "HIT"},
+                        media_type="application/json",
+                    )
+            if not cache_write:
+                cache_key = None
+
+        coalesce_key = None
+        if REQUEST_COALESCING and request_coalescer.is_eligible(data, history_enabled):
+            if canonical_request is None:
+                canonical_request = json_codec.dumps_sorted(data)
+            coalesce_key = request_coalescer.make_key(provided_hash, canonical_request)
+
         # ---------------------------------------------------------------------
         # Stream vs. Non-Stream logic
         # ---------------------------------------------------------------------
+        started = time.perf_counter()
         if is_streaming:
+            if coalesce_key:
+                response_headers, events = await request_coalescer.stream(
+                    coalesce_key,
+                    partial(
+                        open_chat_stream,
+                        api_key,
+                        upstream_body,
+                        session_id,
+                        chat_history,
+                        history_enabled,
+                        deadline,
+                        get_delta_flush_delay(request, "openai"),
+                        model,
+                        partial(record_variant_outcome, request, started),
+                    ),
+                )
+                return build_sse_response(events, response_headers)
             return await get_chat_stream(
-                api_key, data, session_id, chat_history, history_enabled
+                api_key,
+                upstream_body,
+                session_id,
+                chat_history,
+                history_enabled,
+                deadline,
+                get_delta_flush_delay(request, "openai"),
+                model,
+                partial(record_variant_outcome, request, started),
             )
         else:
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {api_key}",
-            }
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{LITELLM_ENDPOINT}/v1/chat/completions",
-                    headers=headers,
-                    json=data,
-                ) as resp:
-                    response_headers = dict(resp.headers)
-                    # Avoid passing through invalid content-length
-                    response_headers.pop("Content-Length", None)
-                    response_dict = await resp.json()
+            if coalesce_key:
+                # Shared with the other waiters. Coalesced requests never have
+                # history enabled, so nothing below mutates it.
+                status_code, response_headers, response_dict = (
+                    await request_coalescer.call(
+                        coalesce_key,
+                        partial(
+                            post_chat_completion,
+                            api_key,
+                            upstream_body,
+                            deadline,
+                            model,
+                        ),
+                    )
+                )
+            else:
+                status_code, response_headers, response_dict = (
+                    await post_chat_completion(api_key, upstream_body, deadline, model)
+                )
+            record_variant_outcome(request, started, status_code)
 
             # If there's a response from the assistant, save it to history
             if response_dict.get("choices"):
@@ -993,28 +4909,201 @@ async def proxy_request(request: Request):
             if session_id:
                 response_dict["session_id"] = session_id
 
+            with timing_stage("convert"):
+                response_content = json_codec.dumps(response_dict)
+            if cache_key and response_dict.get("choices"):
+                await response_cache.set(cache_key, response_content, cache_ttl)
+                response_headers = {**response_headers, "X-Cache": "MISS"}
+
+            # LiteLLM's errors (429, 401, ...) keep their status
             return Response(
-                content=json.dumps(response_dict),
+                content=response_content,
+                status_code=status_code,
                 headers=response_headers,
                 media_type="application/json",
             )
 
     except json.JSONDecodeError:
         return Response(
-            content=json.dumps({"error": "Invalid JSON"}),
+            content=json_codec.dumps({"error": "Invalid JSON"}),
             status_code=400,
             media_type="application/json",
         )
     except HTTPException as he:
-        return JSONResponse(status_code=he.status_code, content=he.detail)
+        return CodecJSONResponse(
+            status_code=he.status_code, content=he.detail, headers=he.headers
+        )
+    except asyncio.TimeoutError:
+        record_variant_outcome(request, started, 504)
+        return CodecJSONResponse(
+            status_code=504,
+            content={"error": f"LiteLLM did not respond within {deadline}s"},
+        )
+    except aiohttp.ClientError as e:
+        record_variant_outcome(request, started, 502)
+        return Response(
+            content=json_codec.dumps({"error": str(e)}),
+            status_code=500,
+            media_type="application/json",
+        )
     except Exception as e:
         return Response(
-            content=json.dumps({"error": str(e)}),
+            content=json_codec.dumps({"error": str(e)}),
             status_code=500,
             media_type="application/json",
         )
 
 
+OPENAI_CHAT_PATHS = ("/v1/chat/completions", "/chat/completions")
+BEDROCK_CONVERSE_PATH = re.compile(r"^/bedrock/model/(.+)/converse$")
+
+
+def make_subrequest(request: Request, body: bytes) -> Request:
+    """
+    Builds a request sharing the caller's headers but with its own body and
+    state, so existing handlers can process one batch item.
+    """
+    on_behalf_of = request.scope.get("state", {}).get("on_behalf_of")
+    scope = {
+        **request.scope,
+        "state": {"on_behalf_of": on_behalf_of} if on_behalf_of else {},
+        "headers": [
+            (name, value)
+            for name, value in request.scope["headers"]
+            if name != b"content-length"
+        ],
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    return Request(scope, receive)
+
+
+async def dispatch_batch_item(request: Request, item: Dict[str, Any]) -> Response:
+    """
+    Runs one batch item, shaped like an OpenAI batch input line
+    ({"custom_id", "url", "body"}), through the regular chat or converse
+    handler. Streaming is not supported inside a batch.
+    """
+    url = item.get("url", "/v1/chat/completions")
+    body = dict(item.get("body") or {})
+    bedrock_match = BEDROCK_CONVERSE_PATH.match(url)
+    on_behalf_of = request.scope.get("state", {}).get("on_behalf_of")
+    if url in OPENAI_CHAT_PATHS:
+        body["stream"] = False
+        if on_behalf_of:
+            body["user"] = on_behalf_of["user"]
+        handler = proxy_request
+    elif bedrock_match:
+        if on_behalf_of:
+            body["additionalModelRequestFields"] = {
+                **(body.get("additionalModelRequestFields") or {}),
+                "user": on_behalf_of["user"],
+            }
+        handler = partial(handle_bedrock_request, bedrock_match.group(1))
+    else:
+        return CodecJSONResponse(
+            status_code=400, content={"error": f"Unsupported batch url: {url}"}
+        )
+
+    subrequest = make_subrequest(request, json_codec.dumps(body))
+    try:
+        return await handler(request=subrequest)
+    finally:
+        ticket = getattr(subrequest.state, "admission_ticket", None)
+        if ticket is not None:
+            ticket.release()
+
+
+def batch_result_line(index: int, item: Any, response: Response) -> bytes:
+    try:
+        body = json_codec.loads(response.body)
+    except (ValueError, AttributeError):
+        body = None
+    custom_id = item.get("custom_id") if isinstance(item, dict) else None
+    return (
+        json_codec.dumps(
+            {
+                "index": index,
+                "custom_id": custom_id,
+                "response": {"status_code": response.status_code, "body": body},
+            }
+        )
+        + b"\n"
+    )
+
+
+@app.post("/middleware/batch")
+async def batch_requests(request: Request):
+    """
+    Runs {"requests": [...], "parallelism": n} concurrently and streams one
+    NDJSON line per item, in completion order.
+    """
+    try:
+        payload = json_codec.loads(await request.body())
+    except json.JSONDecodeError:
+        return CodecJSONResponse(status_code=400, content={"error": "Invalid JSON"})
+    if not request.headers.get("Authorization", "").startswith("Bearer "):
+        return CodecJSONResponse(
+            status_code=401,
+            content={"error": "Missing or invalid Authorization header"},
+        )
+    items = payload.get("requests") if isinstance(payload, dict) else None
+    if not isinstance(items, list) or not items:
+        return CodecJSONResponse(
+            status_code=400, content={"error": "'requests' must be a non-empty list"}
+        )
+    if len(items) > BATCH_MAX_REQUESTS:
+        return CodecJSONResponse(
+            status_code=400,
+            content={"error": f"At most {BATCH_MAX_REQUESTS} requests per batch"},
+        )
+    parallelism = payload.get("parallelism", BATCH_MAX_PARALLELISM)
+    if (
+        not isinstance(parallelism, int)
+        or isinstance(parallelism, bool)
+        or parallelism < 1
+    ):
+        return CodecJSONResponse(
+            status_code=400,
+            content={"error": "'parallelism' must be a positive integer"},
+        )
+    parallelism = min(parallelism, BATCH_MAX_PARALLELISM)
+    slots = asyncio.Semaphore(parallelism)
+
+    async def run(index: int, item: Any):
+        async with slots:
+            if not isinstance(item, dict):
+                response = CodecJSONResponse(
+                    status_code=400, content={"error": "Batch item must be an object"}
+                )
+            else:
+                try:
+                    response = await dispatch_batch_item(request, item)
+                except Exception as e:
+                    response = CodecJSONResponse(
+                        status_code=500, content={"error": str(e)}
+                    )
+        return batch_result_line(index, item, response)
+
+    async def results():
+        tasks = [asyncio.create_task(run(i, item)) for i, item in enumerate(items)]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                yield await finished
+        finally:
+            # Client went away: stop the items that haven't finished
+            for task in tasks:
+                task.cancel()
+            with anyio.CancelScope(shield=True):
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    return DisconnectAwareStreamingResponse(
+        results(), media_type="application/x-ndjson"
+    )
+
+
 def convert_openai_to_bedrock_history(
     openai_history: List[Dict[str, str]]
 ) -> Dict[str, Any]:
@@ -1034,7 +5123,7 @@ def convert_openai_to_bedrock_history(
 
 @app.post("/bedrock/chat-history")
 async def get_bedrock_chat_history(request: Request):
-    body = await request.json()
+    body = json_codec.loads(await request.body())
     session_id = body.get("session_id")
     if not session_id:
         raise HTTPException(status_code=400, detail="session_id is required")
@@ -1047,7 +5136,7 @@ async def get_bedrock_chat_history(request: Request):
         raise HTTPException(
             status_code=401, detail={"error": "Missing or invalid Authorization header"}
         )
-    provided_hash = hash_api_key(api_key)
+    provided_hash = await validate_api_key(api_key)
 
     session_data = get_session_data(session_id)
     if not session_data or session_data["api_key_hash"] != provided_hash:
@@ -1065,7 +5154,7 @@ async def get_bedrock_chat_history(request: Request):
 
 @app.post("/chat-history")
 async def get_openai_chat_history(request: Request):
-    body = await request.json()
+    body = json_codec.loads(await request.body())
     session_id = body.get("session_id")
     if not session_id:
         raise HTTPException(status_code=400, detail="session_id is required")
@@ -1078,7 +5167,7 @@ async def get_openai_chat_history(request: Request):
         raise HTTPException(
             status_code=401, detail={"error": "Missing or invalid Authorization header"}
         )
-    provided_hash = hash_api_key(api_key)
+    provided_hash = await validate_api_key(api_key)
 
     session_data = get_session_data(session_id)
     if not session_data or session_data["api_key_hash"] != provided_hash:
@@ -1104,7 +5193,7 @@ async def list_session_ids_for_api_key(request: Request):
             status_code=401, detail={"error": "Missing or invalid Authorization header"}
         )
 
-    provided_hash = hash_api_key(api_key)
+    provided_hash = await validate_api_key(api_key)
 
     # Query all session_ids for this api_key_hash
     with db_engine.connect() as conn:
@@ -1145,28 +5234,34 @@ async def forward_user_new(request: Request):
     token = auth_header[len("Bearer ") :]
     final_headers = dict(request.headers)
     request_body = await request.body()
-    body_json = json.loads(request_body)
-
-    if not token.startswith("sk-") and access_token_verifier:
-        print(f"token is not api key, assume it is JWT")
+    body_json = json_codec.loads(request_body)
+
+    access_token_verifier = None
+    if not token.startswith("sk-"):
+        access_token_verifier = get_access_token_verifier()
+    if access_token_verifier:
+        log_event(
+            logging.DEBUG, "token is not api key, assume it is JWT", route="user_new"
+        )
         # Handle as JWT
         try:
-            await access_token_verifier.verify(token)
-            print(f"token is verified.")
+            claims = await access_token_verifier.verify(token)
+            log_event(logging.DEBUG, "token is verified.", route="user_new")
         except Exception as e:
-            print(f"exception: {e}")
+            log_event(
+                logging.INFO,
+                "JWT verification failed",
+                route="user_new",
+                error=str(e),
+            )
             # If the JWT verification fails, user is not authorized.
             raise HTTPException(
                 status_code=401, detail={"error": "Invalid or expired token"}
             ) from e
 
-        headers, claims, signing_input, signature = JWTUtils.parse_token(token)
-        print(
-            f"headers: {headers} claims: {claims} signing_input: {signing_input} signature: {signature}"
-        )
+        log_event(logging.DEBUG, "JWT claims", route="user_new", claims=claims)
 
         sub = claims.get("sub")
-        print(f"sub: {sub}")
         if not sub:
             raise HTTPException(
                 status_code=403, detail={"error": "No sub claim found in the token"}
@@ -1180,13 +5275,17 @@ async def forward_user_new(request: Request):
         body_json["user_email"] = sub
         body_json["user_id"] = sub
         body_json["user_role"] = "internal_user"
-        print(f"body_json: {body_json}")
-        request_body = json.dumps(body_json).encode()
+        request_body = json_codec.dumps(body_json)
         final_headers["content-length"] = str(len(request_body))
         final_headers["authorization"] = f"Bearer {MASTER_KEY}"
 
-    print(f"final_headers: {final_headers}")
-    print(f"request_body: {request_body}")
+    log_event(
+        logging.DEBUG,
+        "Forwarding /user/new",
+        route="user_new",
+        headers=final_headers,
+        body=request_body,
+    )
     async with httpx.AsyncClient() as client:
         response = await client.post(
             f"{LITELLM_ENDPOINT}/user/new",
@@ -1200,6 +5299,14 @@ async def forward_user_new(request: Request):
         )
 
 
+# batch_jobs dispatches items through the handlers above, so it's imported
+# last. It imports this module as "app", also when run as a script.
+sys.modules.setdefault("app", sys.modules[__name__])
+import batch_jobs  # noqa: E402
+
+app.include_router(batch_jobs.router)
+
+
 if __name__ == "__main__":
     import uvicorn
 
@@ -0,0 +1,1104 @@
+"""
+Asynchronous batch jobs, compatible with the OpenAI Batch API
+(/middleware/v1/files, /middleware/v1/batches).
+
+Imported by app.py once its handlers are defined; batch items are dispatched
+through those handlers, so they get the same conversion, admission, caching
+and session handling as live requests.
+"""
+
+import asyncio
+import base64
+import collections
+import importlib
+import json
+import logging
+import os
+import re
+import time
+import uuid
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+import anyio
+from anyio import to_thread
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import Response
+from sqlalchemy import Column, Integer, MetaData, String, Table, Text, inspect, text
+from sqlalchemy.sql import delete, insert, or_, select, update
+
+import app as middleware
+from app import (
+    BEDROCK_CONVERSE_PATH,
+    MASTER_KEY,
+    OPENAI_CHAT_PATHS,
+    PRIORITY_HEADER,
+    InvalidApiKey,
+    dispatch_batch_item,
+    json_codec,
+    key_seconds_remaining,
+    log_event,
+    middleware_stats,
+    timed_db,
+    validate_api_key,
+)
+
+# Asynchronous batch jobs (OpenAI Batch API-compatible, /middleware/v1/batches).
+# Jobs and results live in the middleware database; each task runs BATCH_WORKERS
+# worker loops (0 = submit only) that lease jobs and checkpoint every item.
+# Uploads and submissions are checked against LiteLLM's /key/info whatever
+# API_KEY_VALIDATION says. Submitters' keys are never stored: each job gets its
+# own LiteLLM key, generated with MASTER_KEY (required for batch jobs), with the
+# submitter's user, team, models, rate limits and remaining budget, expiring
+# with the job. It is stored encrypted with a key derived from MASTER_KEY and
+# deleted when the job ends. Workers check that the submitter's key still
+# exists, isn't blocked and hasn't expired before running a job and on every
+# lease renewal, and fail the job otherwise.
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", "1"))
+BATCH_JOB_CONCURRENCY = int(os.environ.get("BATCH_JOB_CONCURRENCY", "8"))
+BATCH_POLL_INTERVAL_SECONDS = float(os.environ.get("BATCH_POLL_INTERVAL_SECONDS", "5"))
+BATCH_LEASE_SECONDS = int(os.environ.get("BATCH_LEASE_SECONDS", "60"))
+BATCH_MAX_FILE_BYTES = int(os.environ.get("BATCH_MAX_FILE_BYTES", str(100 << 20)))
+BATCH_MAX_JOB_REQUESTS = int(os.environ.get("BATCH_MAX_JOB_REQUESTS", "50000"))
+BATCH_ITEM_RETRIES = int(os.environ.get("BATCH_ITEM_RETRIES", "5"))
+
+router = APIRouter()
+
+# Set by setup_batch_tables() at startup
+batch_files = None
+batch_jobs = None
+batch_items = None
+
+
+def setup_batch_tables(engine):
+    global batch_files, batch_jobs, batch_items
+    metadata_obj = MetaData()
+    files_table = Table(
+        "batch_files",
+        metadata_obj,
+        Column("file_id", String, primary_key=True),
+        Column("api_key_hash", String, index=True),
+        Column("filename", String),
+        Column("purpose", String),
+        Column("bytes", Integer),
+        Column("created_at", Integer),
+        Column("content", Text),
+    )
+    jobs_table = Table(
+        "batch_jobs",
+        metadata_obj,
+        Column("batch_id", String, primary_key=True),
+        Column("api_key_hash", String, index=True),
+        # LiteLLM user_id or key alias, sent as "user" with each request
+        Column("submitted_by", String),
+        # The job's own LiteLLM key, encrypted with get_batch_key_cipher()
+        Column("worker_key", Text),
+        Column("input_file_id", String),
+        Column("endpoint", String),
+        Column("completion_window", String),
+        Column("status", String, index=True),
+        Column("created_at", Integer),
+        Column("expires_at", Integer),
+        Column("in_progress_at", Integer),
+        Column("finalizing_at", Integer),
+        Column("completed_at", Integer),
+        Column("failed_at", Integer),
+        Column("expired_at", Integer),
+        Column("cancelling_at", Integer),
+        Column("cancelled_at", Integer),
+        Column("total", Integer, default=0),
+        Column("completed", Integer, default=0),
+        Column("failed", Integer, default=0),
+        Column("output_file_id", String),
+        Column("error_file_id", String),
+        Column("batch_metadata", Text),
+        Column("errors", Text),
+        Column("lease_owner", String),
+        Column("lease_expires_at", Integer),
+    )
+    items_table = Table(
+        "batch_items",
+        metadata_obj,
+        Column("batch_id", String, primary_key=True),
+        Column("line", Integer, primary_key=True),
+        Column("custom_id", String),
+        Column("request", Text),
+        Column("status", String),
+        Column("result", Text),
+    )
+    metadata_obj.create_all(engine)
+    existing_columns = {
+        column["name"] for column in inspect(engine).get_columns("batch_jobs")
+    }
+    with engine.begin() as conn:
+        # Earlier versions kept the submitter's raw API key in batch_jobs
+        if "api_key" in existing_columns:
+            conn.execute(text("ALTER TABLE batch_jobs DROP COLUMN api_key"))
+            log_event(logging.INFO, "Dropped batch_jobs.api_key")
+        if "submitted_by" not in existing_columns:
+            conn.execute(text("ALTER TABLE batch_jobs ADD COLUMN submitted_by VARCHAR"))
+        if "worker_key" not in existing_columns:
+            conn.execute(text("ALTER TABLE batch_jobs ADD COLUMN worker_key TEXT"))
+    log_event(logging.INFO, "Batch tables ready")
+    batch_files, batch_jobs, batch_items = files_table, jobs_table, items_table
+
+
+BATCH_ACTIVE_STATUSES = ("validating", "in_progress", "cancelling")
+batch_work_available = asyncio.Event()
+batch_worker_tasks = []
+batch_worker_counters = collections.Counter()
+
+
+def get_api_key(request: Request) -> str:
+    auth_header = request.headers.get("Authorization")
+    if auth_header and auth_header.startswith("Bearer "):
+        return auth_header[len("Bearer ") :]
+    raise HTTPException(
+        status_code=401, detail={"error": "Missing or invalid Authorization header"}
+    )
+
+
+def batch_file_object(row: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": row["file_id"],
+        "object": "file",
+        "bytes": row["bytes"],
+        "created_at": row["created_at"],
+        "filename": row["filename"],
+        "purpose": row["purpose"],
+        "status": "processed",
+    }
+
+
+def batch_job_object(row: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": row["batch_id"],
+        "object": "batch",
+        "endpoint": row["endpoint"],
+        "errors": json_codec.loads(row["errors"]) if row["errors"] else None,
+        "input_file_id": row["input_file_id"],
+        "completion_window": row["completion_window"],
+        "status": row["status"],
+        "output_file_id": row["output_file_id"],
+        "error_file_id": row["error_file_id"],
+        "created_at": row["created_at"],
+        "in_progress_at": row["in_progress_at"],
+        "expires_at": row["expires_at"],
+        "finalizing_at": row["finalizing_at"],
+        "completed_at": row["completed_at"],
+        "failed_at": row["failed_at"],
+        "expired_at": row["expired_at"],
+        "cancelling_at": row["cancelling_at"],
+        "cancelled_at": row["cancelled_at"],
+        "request_counts": {
+            "total": row["total"] or 0,
+            "completed": row["completed"] or 0,
+            "failed": row["failed"] or 0,
+        },
+        "metadata": (
+            json_codec.loads(row["batch_metadata"]) if row["batch_metadata"] else None
+        ),
+    }
+
+
+def insert_batch_file(
+    api_key_hash: str, filename: str, purpose: str, content: bytes, conn=None
+) -> Dict[str, Any]:
+    row = {
+        "file_id": f"file-{uuid.uuid4().hex}",
+        "api_key_hash": api_key_hash,
+        "filename": filename,
+        "purpose": purpose,
+        "bytes": len(content),
+        "created_at": int(time.time()),
+        "content": content.decode("utf-8"),
+    }
+    if conn is not None:
+        conn.execute(insert(batch_files).values(**row))
+        return row
+    with middleware.db_engine.begin() as conn:
+        conn.execute(insert(batch_files).values(**row))
+    return row
+
+
+def get_batch_file(file_id: str, api_key_hash: str) -> Optional[Dict[str, Any]]:
+    with middleware.db_engine.connect() as conn:
+        stmt = select(batch_files).where(
+            batch_files.c.file_id == file_id,
+            batch_files.c.api_key_hash == api_key_hash,
+        )
+        result = conn.execute(stmt).fetchone()
+        return dict(result._mapping) if result else None
+
+
+@timed_db("insert_batch_job")
+def insert_batch_job(row: Dict[str, Any]):
+    with middleware.db_engine.begin() as conn:
+        conn.execute(insert(batch_jobs).values(**row))
+
+
+@timed_db("get_batch_job")
+def get_batch_job(batch_id: str, api_key_hash: str) -> Optional[Dict[str, Any]]:
+    with middleware.db_engine.connect() as conn:
+        stmt = select(batch_jobs).where(
+            batch_jobs.c.batch_id == batch_id,
+            batch_jobs.c.api_key_hash == api_key_hash,
+        )
+        result = conn.execute(stmt).fetchone()
+        return dict(result._mapping) if result else None
+
+
+@timed_db("list_batch_jobs")
+def list_batch_jobs(
+    api_key_hash: str, after: Optional[str], limit: int
+) -> List[Dict[str, Any]]:
+    with middleware.db_engine.connect() as conn:
+        stmt = select(batch_jobs).where(batch_jobs.c.api_key_hash == api_key_hash)
+        if after:
+            cursor = conn.execute(
+                select(batch_jobs.c.created_at).where(batch_jobs.c.batch_id == after)
+            ).scalar()
+            if cursor is not None:
+                stmt = stmt.where(
+                    or_(
+                        batch_jobs.c.created_at < cursor,
+                        (batch_jobs.c.created_at == cursor)
+                        & (batch_jobs.c.batch_id < after),
+                    )
+                )
+        stmt = stmt.order_by(
+            batch_jobs.c.created_at.desc(), batch_jobs.c.batch_id.desc()
+        ).limit(limit + 1)
+        return [dict(row._mapping) for row in conn.execute(stmt)]
+
+
+def cancel_batch_job(batch_id: str, api_key_hash: str) -> Optional[Dict[str, Any]]:
+    with middleware.db_engine.begin() as conn:
+        conn.execute(
+            update(batch_jobs)
+            .where(
+                batch_jobs.c.batch_id == batch_id,
+                batch_jobs.c.api_key_hash == api_key_hash,
+                batch_jobs.c.status.in_(("validating", "in_progress")),
+            )
+            .values(status="cancelling", cancelling_at=int(time.time()))
+        )
+    return get_batch_job(batch_id, api_key_hash)
+
+
+@timed_db("claim_batch_job")
+def claim_batch_job(worker_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Leases the oldest active job whose lease is free or expired. Jobs left
+    behind by a stopped task are picked up again once their lease runs out.
+    """
+    now = int(time.time())
+    with middleware.db_engine.begin() as conn:
+        stmt = (
+            select(batch_jobs)
+            .where(
+                batch_jobs.c.status.in_(BATCH_ACTIVE_STATUSES),
+                or_(
+                    batch_jobs.c.lease_expires_at.is_(None),
+                    batch_jobs.c.lease_expires_at < now,
+                ),
+            )
+            .order_by(batch_jobs.c.created_at)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        )
+        result = conn.execute(stmt).fetchone()
+        if result is None:
+            return None
+        job = dict(result._mapping)
+        conn.execute(
+            update(batch_jobs)
+            .where(batch_jobs.c.batch_id == job["batch_id"])
+            .values(lease_owner=worker_id, lease_expires_at=now + BATCH_LEASE_SECONDS)
+        )
+        return job
+
+
+@timed_db("renew_batch_lease")
+def renew_batch_lease(batch_id: str, worker_id: str) -> Optional[str]:
+    """Extends the lease and returns the job status, or None if the lease was lost."""
+    with middleware.db_engine.begin() as conn:
+        result = conn.execute(
+            update(batch_jobs)
+            .where(
+                batch_jobs.c.batch_id == batch_id,
+                batch_jobs.c.lease_owner == worker_id,
+            )
+            .values(lease_expires_at=int(time.time()) + BATCH_LEASE_SECONDS)
+        )
+        if result.rowcount == 0:
+            return None
+        return conn.execute(
+            select(batch_jobs.c.status).where(batch_jobs.c.batch_id == batch_id)
+        ).scalar()
+
+
+def parse_batch_input(
+    content: str, endpoint: str
+) -> (List[Dict[str, Any]], List[Dict[str, Any]]):
+    """Every line's url must equal the batch's endpoint, as in the OpenAI API."""
+    items, errors, custom_ids = [], [], set()
+    for line_number, line in enumerate(content.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            item = json_codec.loads(line)
+        except json.JSONDecodeError:
+            item = None
+        if not isinstance(item, dict) or not isinstance(item.get("body"), dict):
+            message = "Line is not a JSON object with a 'body' object"
+        elif not isinstance(item.get("custom_id"), str):
+            message = "Missing 'custom_id'"
+        elif item["custom_id"] in custom_ids:
+            message = f"Duplicate custom_id '{item['custom_id']}'"
+        elif item.get("method", "POST") != "POST":
+            message = "Only POST requests are supported"
+        elif item.get(
+            "url"
+        ) not in OPENAI_CHAT_PATHS and not BEDROCK_CONVERSE_PATH.match(
+            item.get("url") or ""
+        ):
+            message = f"Unsupported url: {item.get('url')}"
+        elif item["url"] != endpoint:
+            message = (
+                f"url '{item['url']}' does not match the batch endpoint '{endpoint}'"
+            )
+        else:
+            custom_ids.add(item["custom_id"])
+            items.append({"custom_id": item["custom_id"], "request": line})
+            continue
+        errors.append(
+            {"code": "invalid_request", "message": message, "line": line_number}
+        )
+    if not items and not errors:
+        errors.append(
+            {"code": "empty_file", "message": "The input file has no requests"}
+        )
+    if len(items) > BATCH_MAX_JOB_REQUESTS:
+        errors.append(
+            {
+                "code": "too_many_requests",
+                "message": f"At most {BATCH_MAX_JOB_REQUESTS} requests per batch",
+            }
+        )
+    return items, errors
+
+
+@timed_db("start_batch_items")
+def start_batch_items(job: Dict[str, Any], worker_id: str) -> Optional[str]:
+    """Validates the input file and checkpoints one pending row per request."""
+    with middleware.db_engine.begin() as conn:
+        content = conn.execute(
+            select(batch_files.c.content).where(
+                batch_files.c.file_id == job["input_file_id"]
+            )
+        ).scalar()
+        items, errors = parse_batch_input(content or "", job["endpoint"])
+        now = int(time.time())
+        owned = (batch_jobs.c.batch_id == job["batch_id"]) & (
+            batch_jobs.c.lease_owner == worker_id
+        )
+        if errors:
+            conn.execute(
+                update(batch_jobs)
+                .where(owned)
+                .values(
+                    status="failed",
+                    failed_at=now,
+                    errors=json_codec.dumps({"object": "list", "data": errors}).decode(
+                        "utf-8"
+                    ),
+                    lease_owner=None,
+                    lease_expires_at=None,
+                )
+            )
+            return "failed"
+        conn.execute(
+            delete(batch_items).where(batch_items.c.batch_id == job["batch_id"])
+        )
+        conn.execute(
+            insert(batch_items),
+            [
+                {
+                    "batch_id": job["batch_id"],
+                    "line": line,
+                    "custom_id": item["custom_id"],
+                    "request": item["request"],
+                    "status": "pending",
+                }
+                for line, item in enumerate(items)
+            ],
+        )
+        conn.execute(
+            update(batch_jobs)
+            .where(owned, batch_jobs.c.status == "validating")
+            .values(status="in_progress", in_progress_at=now, total=len(items))
+        )
+    return "in_progress"
+
+
+@timed_db("load_batch_items")
+def load_pending_batch_items(batch_id: str) -> List[Dict[str, Any]]:
+    with middleware.db_engine.connect() as conn:
+        stmt = (
+            select(batch_items.c.line, batch_items.c.custom_id, batch_items.c.request)
+            .where(
+                batch_items.c.batch_id == batch_id,
+                batch_items.c.status == "pending",
+            )
+            .order_by(batch_items.c.line)
+        )
+        return [dict(row._mapping) for row in conn.execute(stmt)]
+
+
+@timed_db("record_batch_item")
+def record_batch_item(batch_id: str, line: int, succeeded: bool, result: bytes):
+    """Checkpoints one finished request together with the job's counters."""
+    status = "completed" if succeeded else "failed"
+    with middleware.db_engine.begin() as conn:
+        updated = conn.execute(
+            update(batch_items)
+            .where(
+                batch_items.c.batch_id == batch_id,
+                batch_items.c.line == line,
+                batch_items.c.status == "pending",
+            )
+            .values(status=status, result=result.decode("utf-8"))
+        )
+        if updated.rowcount:
+            conn.execute(
+                update(batch_jobs)
+                .where(batch_jobs.c.batch_id == batch_id)
+                .values({status: batch_jobs.c[status] + 1})
+            )
+
+
+@timed_db("finalize_batch_job")
+def finalize_batch_job(
+    job: Dict[str, Any],
+    worker_id: str,
+    final_status: str,
+    errors: Optional[List[Dict[str, Any]]] = None,
+):
+    """
+    Writes the output and error files and moves the job to its final status.
+    Requests never run (cancelled, expired or failed jobs) are reported in the
+    error file. The job's encrypted key is dropped.
+    """
+    now = int(time.time())
+    reason = "failed" if final_status == "failed" else f"was {final_status}"
+    output_lines, error_lines = [], []
+    with middleware.db_engine.begin() as conn:
+        rows = conn.execute(
+            select(batch_items.c.custom_id, batch_items.c.status, batch_items.c.result)
+            .where(batch_items.c.batch_id == job["batch_id"])
+            .order_by(batch_items.c.line)
+        )
+        for custom_id, status, result in rows:
+            if status == "completed":
+                output_lines.append(result)
+            elif status == "failed":
+                error_lines.append(result)
+            else:
+                error_lines.append(
+                    json_codec.dumps(
+                        {
+                            "id": f"batch_req_{uuid.uuid4().hex}",
+                            "custom_id": custom_id,
+                            "response": None,
+                            "error": {
+                                "code": f"batch_{final_status}",
+                                "message": f"The batch {reason} before this request ran",
+                            },
+                        }
+                    ).decode("utf-8")
+                )
+
+        values = {
+            "status": final_status,
+            "finalizing_at": now,
+            f"{final_status}_at": now,
+            "lease_owner": None,
+            "lease_expires_at": None,
+            "worker_key": None,
+        }
+        if errors:
+            values["errors"] = json_codec.dumps(
+                {"object": "list", "data": errors}
+            ).decode("utf-8")
+        for column, lines, filename in (
+            ("output_file_id", output_lines, "batch_output.jsonl"),
+            ("error_file_id", error_lines, "batch_errors.jsonl"),
+        ):
+            if lines:
+                content = ("\n".join(lines) + "\n").encode("utf-8")
+                values[column] = insert_batch_file(
+                    job["api_key_hash"], filename, "batch_output", content, conn=conn
+                )["file_id"]
+        conn.execute(
+            update(batch_jobs)
+            .where(
+                batch_jobs.c.batch_id == job["batch_id"],
+                batch_jobs.c.lease_owner == worker_id,
+            )
+            .values(**values)
+        )
+
+
+async def litellm_key_request(
+    method: str, path: str, api_key: str, payload: Optional[Dict[str, Any]] = None
+) -> (int, Any):
+    """Calls one of LiteLLM's key management routes; returns (status, JSON body)."""
+    async with aiohttp.ClientSession() as session:
+        async with session.request(
+            method,
+            f"{middleware.LITELLM_ENDPOINT}{path}",
+            headers={
+                "Authorization": f"Bearer {api_key}",
+                "Content-Type": "application/json",
+            },
+            data=json_codec.dumps(payload) if payload is not None else None,
+            timeout=aiohttp.ClientTimeout(total=10),
+        ) as resp:
+            try:
+                body = json_codec.loads(await resp.read())
+            except ValueError:
+                body = None
+            return resp.status, body
+
+
+def key_info_problem(info: Dict[str, Any]) -> Optional[str]:
+    """Why a key described by /key/info can't run batch work, or None."""
+    if info.get("blocked"):
+        return "blocked"
+    remaining = key_seconds_remaining(info)
+    if remaining is not None and remaining <= 0:
+        return "expired"
+    return None
+
+
+async def get_submitter_key_info(api_key: str) -> Dict[str, Any]:
+    """
+    Checks the caller's key against LiteLLM, whatever API_KEY_VALIDATION says,
+    and returns its /key/info. Refuses the request if LiteLLM can't vouch for it.
+    """
+    try:
+        status, body = await litellm_key_request("GET", "/key/info", api_key)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        log_event(
+            logging.WARNING, "Key info lookup failed", route="batch", error=str(e)
+        )
+        status, body = None, None
+    if status in (400, 401, 404):
+        raise InvalidApiKey()
+    if status == 403:
+        raise HTTPException(
+            status_code=403,
+            detail={"error": "Batch jobs need a key that may read its own /key/info"},
+        )
+    info = body.get("info") if status == 200 and isinstance(body, dict) else None
+    if not isinstance(info, dict):
+        raise HTTPException(
+            status_code=503,
+            detail={"error": "Couldn't verify the API key with LiteLLM"},
+        )
+    if key_info_problem(info):
+        raise InvalidApiKey()
+    return info
+
+
+async def check_submitter_key(job: Dict[str, Any]) -> Optional[str]:
+    """
+    Looks the submitter's key up by hash (LiteLLM stores keys as their SHA-256)
+    and returns why it may no longer run the job, or None if it may or LiteLLM
+    can't say right now.
+    """
+    try:
+        status, body = await litellm_key_request(
+            "GET", f"/key/info?key={job['api_key_hash']}", MASTER_KEY
+        )
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        log_event(
+            logging.WARNING, "Key info lookup failed", route="batch", error=str(e)
+        )
+        return None
+    if status in (400, 401, 404):
+        return "The API key that submitted this batch no longer exists"
+    if status != 200 or not isinstance(body, dict):
+        return None
+    problem = key_info_problem(body.get("info") or {})
+    if problem:
+        return f"The API key that submitted this batch is {problem}"
+    return None
+
+
+@lru_cache(maxsize=None)
+def get_batch_key_cipher():
+    """Encrypts jobs' keys at rest with a key derived from MASTER_KEY."""
+    fernet = importlib.import_module("cryptography.fernet")
+    hashes = importlib.import_module("cryptography.hazmat.primitives.hashes")
+    hkdf = importlib.import_module("cryptography.hazmat.primitives.kdf.hkdf")
+    derived = hkdf.HKDF(
+        algorithm=hashes.SHA256(), length=32, salt=None, info=b"batch-worker-keys"
+    ).derive(MASTER_KEY.encode("utf-8"))
+    return fernet.Fernet(base64.urlsafe_b64encode(derived))
+
+
+async def create_batch_key(
+    info: Dict[str, Any], batch_id: str, api_key_hash: str, expires_at: int
+) -> str:
+    """
+    Generates the job's LiteLLM key with the submitter's user, team, models,
+    rate limits and remaining budget, expiring with the job (or the
+    submitter's key, if sooner).
+    """
+    lifetime = expires_at - time.time()
+    remaining = key_seconds_remaining(info)
+    if remaining is not None:
+        lifetime = min(lifetime, remaining)
+    max_budget = info.get("max_budget")
+    payload = {
+        "models": info.get("models") or [],
+        "user_id": info.get("user_id"),
+        "team_id": info.get("team_id"),
+        "max_budget": (
+            None
+            if max_budget is None
+            else max(0.0, max_budget - (info.get("spend") or 0.0))
+        ),
+        "tpm_limit": info.get("tpm_limit"),
+        "rpm_limit": info.get("rpm_limit"),
+        "max_parallel_requests": info.get("max_parallel_requests"),
+        "duration": f"{max(1, int(lifetime))}s",
+        "metadata": {"batch_id": batch_id, "submitted_by_key_hash": api_key_hash},
+    }
+    try:
+        status, body = await litellm_key_request(
+            "POST",
+            "/key/generate",
+            MASTER_KEY,
+            {name: value for name, value in payload.items() if value is not None},
+        )
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        log_event(logging.WARNING, "Key generation failed", route="batch", error=str(e))
+        status, body = None, None
+    key = body.get("key") if status == 200 and isinstance(body, dict) else None
+    if not key:
+        raise HTTPException(
+            status_code=503,
+            detail={"error": "Couldn't create a LiteLLM key for the batch"},
+        )
+    return key
+
+
+async def delete_batch_key(key: str, batch_id: str):
+    try:
+        status, _ = await litellm_key_request(
+            "POST", "/key/delete", MASTER_KEY, {"keys": [key]}
+        )
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        status = str(e)
+    if status != 200:
+        # It still expires with the job
+        log_event(
+            logging.WARNING,
+            "Couldn't delete batch key",
+            route="batch",
+            batch_id=batch_id,
+            status=status,
+        )
+
+
+def batch_worker_request(job: Dict[str, Any], key: str) -> Request:
+    """
+    Base request the worker dispatches batch items with: authenticated with
+    the job's own key, acting on behalf of the job's submitter.
+    """
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/middleware/v1/batches",
+        "raw_path": b"/middleware/v1/batches",
+        "query_string": b"",
+        "root_path": "",
+        "client": None,
+        "server": None,
+        "app": middleware.app,
+        "headers": [
+            (b"authorization", f"Bearer {key}".encode("utf-8")),
+            (b"content-type", b"application/json"),
+            (PRIORITY_HEADER.lower().encode("utf-8"), b"batch"),
+        ],
+        "state": {
+            "on_behalf_of": {
+                "api_key_hash": job["api_key_hash"],
+                "user": job["submitted_by"],
+            }
+        },
+    }
+    return Request(scope)
+
+
+async def run_batch_item(base_request: Request, item: Dict[str, Any]) -> (bool, bytes):
+    request_line = json_codec.loads(item["request"])
+    for attempt in range(BATCH_ITEM_RETRIES + 1):
+        try:
+            response = await dispatch_batch_item(base_request, request_line)
+            status_code, body = response.status_code, json_codec.loads(response.body)
+        except Exception as e:
+            status_code, body = 500, {"error": str(e)}
+        # Shed or over the admission limits: back off instead of failing
+        if status_code not in (429, 503) or attempt == BATCH_ITEM_RETRIES:
+            break
+        await asyncio.sleep(min(2**attempt, 30))
+
+    succeeded = 200 <= status_code < 300
+    result = {
+        "id": f"batch_req_{uuid.uuid4().hex}",
+        "custom_id": item["custom_id"],
+        "response": {
+            "status_code": status_code,
+            "request_id": uuid.uuid4().hex,
+            "body": body,
+        },
+        "error": (
+            None
+            if succeeded
+            else {
+                "code": str(status_code),
+                "message": json_codec.dumps(body).decode("utf-8"),
+            }
+        ),
+    }
+    return succeeded, json_codec.dumps(result)
+
+
+async def fail_batch_job(job: Dict[str, Any], worker_id: str, key: str, message: str):
+    await to_thread.run_sync(
+        finalize_batch_job,
+        job,
+        worker_id,
+        "failed",
+        [{"code": "key_revoked", "message": message}],
+    )
+    if key:
+        await delete_batch_key(key, job["batch_id"])
+    batch_worker_counters["jobs_failed"] += 1
+    log_event(
+        logging.WARNING,
+        "Batch failed",
+        route="batch",
+        batch_id=job["batch_id"],
+        error=message,
+    )
+
+
+async def run_batch_job(job: Dict[str, Any], worker_id: str):
+    batch_id = job["batch_id"]
+    status = job["status"]
+    key, revoked = None, None
+    if not job["worker_key"]:
+        revoked = "The batch was submitted before batches had their own keys"
+    else:
+        fernet = importlib.import_module("cryptography.fernet")
+        try:
+            key = get_batch_key_cipher().decrypt(job["worker_key"].encode("utf-8"))
+            key = key.decode("utf-8")
+        except fernet.InvalidToken:
+            revoked = "The batch's key can't be decrypted; was MASTER_KEY changed?"
+    revoked = revoked or await check_submitter_key(job)
+    if revoked:
+        await fail_batch_job(job, worker_id, key, revoked)
+        return
+    if status == "validating":
+        status = await to_thread.run_sync(start_batch_items, job, worker_id)
+        if status == "failed":
+            return
+
+    pending = collections.deque()
+    if status == "in_progress" and time.time() < job["expires_at"]:
+        pending.extend(await to_thread.run_sync(load_pending_batch_items, batch_id))
+    base_request = batch_worker_request(job, key)
+    lease_lost = False
+
+    async def heartbeat(scope: anyio.CancelScope):
+        nonlocal status, lease_lost, revoked
+        while True:
+            await asyncio.sleep(BATCH_LEASE_SECONDS / 3)
+            current = await to_thread.run_sync(renew_batch_lease, batch_id, worker_id)
+            if current is None:
+                lease_lost = True
+                scope.cancel()
+                return
+            if current == "cancelling":
+                # Stop taking new requests; in-flight ones still checkpoint
+                status = current
+                pending.clear()
+            revoked = revoked or await check_submitter_key(job)
+            if revoked:
+                pending.clear()
+
+    async def drain():
+        while pending and time.time() < job["expires_at"]:
+            item = pending.popleft()
+            succeeded, result = await run_batch_item(base_request, item)
+            with anyio.CancelScope(shield=True):
+                await to_thread.run_sync(
+                    record_batch_item, batch_id, item["line"], succeeded, result
+                )
+            batch_worker_counters["completed" if succeeded else "failed"] += 1
+
+    async with anyio.create_task_group() as outer:
+        outer.start_soon(heartbeat, outer.cancel_scope)
+        async with anyio.create_task_group() as workers:
+            for _ in range(max(1, BATCH_JOB_CONCURRENCY)):
+                workers.start_soon(drain)
+        outer.cancel_scope.cancel()
+
+    if lease_lost:
+        log_event(
+            logging.WARNING,
+            "Lost lease on batch; another worker will resume it",
+            route="batch",
+            batch_id=batch_id,
+        )
+        return
+    if revoked:
+        await fail_batch_job(job, worker_id, key, revoked)
+        return
+    if status == "cancelling":
+        final_status = "cancelled"
+    elif await to_thread.run_sync(load_pending_batch_items, batch_id):
+        final_status = "expired"
+    else:
+        final_status = "completed"
+    await to_thread.run_sync(finalize_batch_job, job, worker_id, final_status)
+    await delete_batch_key(key, batch_id)
+    batch_worker_counters[f"jobs_{final_status}"] += 1
+    log_event(
+        logging.INFO,
+        "Batch finished",
+        route="batch",
+        batch_id=batch_id,
+        status=final_status,
+    )
+
+
+async def batch_worker(worker_id: str):
+    while True:
+        try:
+            job = await to_thread.run_sync(claim_batch_job, worker_id)
+            if job is None:
+                batch_work_available.clear()
+                try:
+                    await asyncio.wait_for(
+                        batch_work_available.wait(), BATCH_POLL_INTERVAL_SECONDS
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await run_batch_job(job, worker_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log_event(logging.ERROR, "Batch worker error", route="batch", exc_info=True)
+            await asyncio.sleep(BATCH_POLL_INTERVAL_SECONDS)
+
+
+def start_batch_workers():
+    if BATCH_WORKERS and not MASTER_KEY:
+        log_event(logging.WARNING, "MASTER_KEY is not set; batch workers are disabled")
+        return
+    for _ in range(BATCH_WORKERS):
+        worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        batch_worker_tasks.append(asyncio.create_task(batch_worker(worker_id)))
+
+
+middleware_stats["batch_jobs"] = lambda: {
+    "workers": len(batch_worker_tasks),
+    **batch_worker_counters,
+}
+
+
+@router.post("/middleware/v1/files")
+async def create_batch_file(request: Request):
+    """
+    Uploads a batch input file. Accepts the OpenAI multipart upload
+    (file, purpose) or a raw JSONL body with ?filename= and ?purpose=.
+    """
+    api_key = get_api_key(request)
+    provided_hash = await validate_api_key(api_key)
+    await get_submitter_key_info(api_key)
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        form = await request.form()
+        upload = form.get("file")
+        if upload is None:
+            raise HTTPException(status_code=400, detail={"error": "Missing 'file'"})
+        purpose = form.get("purpose", "batch")
+        filename = upload.filename or "batch.jsonl"
+        content = await upload.read()
+    else:
+        purpose = request.query_params.get("purpose", "batch")
+        filename = request.query_params.get("filename", "batch.jsonl")
+        content = await request.body()
+    if purpose != "batch":
+        raise HTTPException(
+            status_code=400, detail={"error": "Only purpose 'batch' is supported"}
+        )
+    if len(content) > BATCH_MAX_FILE_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail={"error": f"Files are limited to {BATCH_MAX_FILE_BYTES} bytes"},
+        )
+    row = await to_thread.run_sync(
+        insert_batch_file, provided_hash, filename, purpose, content
+    )
+    return batch_file_object(row)
+
+
+@router.get("/middleware/v1/files/{file_id}")
+async def retrieve_batch_file(file_id: str, request: Request):
+    provided_hash = await validate_api_key(get_api_key(request))
+    row = await to_thread.run_sync(get_batch_file, file_id, provided_hash)
+    if row is None:
+        raise HTTPException(status_code=404, detail={"error": "File not found"})
+    return batch_file_object(row)
+
+
+@router.get("/middleware/v1/files/{file_id}/content")
+async def retrieve_batch_file_content(file_id: str, request: Request):
+    provided_hash = await validate_api_key(get_api_key(request))
+    row = await to_thread.run_sync(get_batch_file, file_id, provided_hash)
+    if row is None:
+        raise HTTPException(status_code=404, detail={"error": "File not found"})
+    return Response(content=row["content"], media_type="application/jsonl")
+
+
+@router.post("/middleware/v1/batches")
+async def create_batch_job(request: Request):
+    if not MASTER_KEY:
+        raise HTTPException(
+            status_code=503,
+            detail={"error": "Batch jobs require MASTER_KEY to be configured"},
+        )
+    api_key = get_api_key(request)
+    provided_hash = await validate_api_key(api_key)
+    key_info = await get_submitter_key_info(api_key)
+    try:
+        body = json_codec.loads(await request.body())
+    except ValueError:
+        body = None
+    if not isinstance(body, dict):
+        raise HTTPException(
+            status_code=400, detail={"error": "Body must be a JSON object"}
+        )
+    endpoint = body.get("endpoint")
+    if not isinstance(endpoint, str) or (
+        endpoint not in OPENAI_CHAT_PATHS and not BEDROCK_CONVERSE_PATH.match(endpoint)
+    ):
+        raise HTTPException(
+            status_code=400, detail={"error": f"Unsupported endpoint: {endpoint}"}
+        )
+    completion_window = body.get("completion_window", "24h")
+    if not isinstance(completion_window, str) or not re.fullmatch(
+        r"[1-9][0-9]*h", completion_window
+    ):
+        raise HTTPException(
+            status_code=400,
+            detail={"error": "completion_window must be a number of hours, e.g. '24h'"},
+        )
+    if not isinstance(body.get("input_file_id"), str):
+        raise HTTPException(
+            status_code=400, detail={"error": "input_file_id must be a string"}
+        )
+    if body.get("metadata") is not None and not isinstance(body["metadata"], dict):
+        raise HTTPException(
+            status_code=400, detail={"error": "metadata must be an object"}
+        )
+    input_file = await to_thread.run_sync(
+        get_batch_file, body.get("input_file_id"), provided_hash
+    )
+    if input_file is None or input_file["purpose"] != "batch":
+        raise HTTPException(status_code=404, detail={"error": "Input file not found"})
+
+    now = int(time.time())
+    batch_id = f"batch_{uuid.uuid4().hex}"
+    expires_at = now + int(completion_window[:-1]) * 3600
+    key = await create_batch_key(key_info, batch_id, provided_hash, expires_at)
+    row = {
+        "batch_id": batch_id,
+        "api_key_hash": provided_hash,
+        "submitted_by": (
+            key_info.get("user_id")
+            or key_info.get("key_alias")
+            or f"key-{provided_hash[:16]}"
+        ),
+        "worker_key": get_batch_key_cipher().encrypt(key.encode("utf-8")).decode(),
+        "input_file_id": input_file["file_id"],
+        "endpoint": endpoint,
+        "completion_window": completion_window,
+        "status": "validating",
+        "created_at": now,
+        "expires_at": expires_at,
+        "total": 0,
+        "completed": 0,
+        "failed": 0,
+        "batch_metadata": (
+            json_codec.dumps(body["metadata"]).decode("utf-8")
+            if body.get("metadata")
+            else None
+        ),
+    }
+    try:
+        await to_thread.run_sync(insert_batch_job, row)
+    except BaseException:
+        await delete_batch_key(key, batch_id)
+        raise
+    batch_work_available.set()
+    return batch_job_object(
+        {
+            **{column.name: None for column in batch_jobs.columns},
+            **row,
+        }
+    )
+
+
+@router.get("/middleware/v1/batches/{batch_id}")
+async def retrieve_batch_job(batch_id: str, request: Request):
+    provided_hash = await validate_api_key(get_api_key(request))
+    row = await to_thread.run_sync(get_batch_job, batch_id, provided_hash)
+    if row is None:
+        raise HTTPException(status_code=404, detail={"error": "Batch not found"})
+    return batch_job_object(row)
+
+
+@router.post("/middleware/v1/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str, request: Request):
+    provided_hash = await validate_api_key(get_api_key(request))
+    row = await to_thread.run_sync(cancel_batch_job, batch_id, provided_hash)
+    if row is None:
+        raise HTTPException(status_code=404, detail={"error": "Batch not found"})
+    return batch_job_object(row)
+
+
+@router.get("/middleware/v1/batches")
+async def list_batches(request: Request, after: Optional[str] = None, limit: int = 20):
+    provided_hash = await validate_api_key(get_api_key(request))
+    limit = max(1, min(limit, 100))
+    rows = await to_thread.run_sync(list_batch_jobs, provided_hash, after, limit)
+    data = [batch_job_object(row) for row in rows[:limit]]
+    return {
+        "object": "list",
+        "data": data,
+        "first_id": data[0]["id"] if data else None,
+        "last_id": data[-1]["id"] if data else None,
+        "has_more": len(rows) > limit,
+    }
@@ -0,0 +1,551 @@
+"""
+Micro-benchmarks for the middleware hot paths in middleware/app.py.
+
+These run in-process against the middleware module (no LiteLLM, database or AWS
+access required) and report CPU time per simulated request.
+
+Usage:
+    python scripts/middleware_benchmark.py codec
+    python scripts/middleware_benchmark.py body
+    python scripts/middleware_benchmark.py eventstream
+    python scripts/middleware_benchmark.py transcode
+    python scripts/middleware_benchmark.py imports
+    python scripts/middleware_benchmark.py logging
+    DATABASE_MIDDLEWARE_URL=... python scripts/middleware_benchmark.py coldstart
+"""
+
+import collections
+import contextlib
+import logging
+import os
+import struct
+import subprocess
+import sys
+import time
+import urllib.request
+import zlib
+
+import json
+
+import click
+from botocore.eventstream import EventStreamBuffer
+from openai._models import construct_type
+from openai.types.chat import ChatCompletionChunk
+from tabulate import tabulate
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+middleware_dir = os.path.join(os.path.dirname(__file__), "..", "middleware")
+sys.path.insert(0, middleware_dir)
+
+import app as middleware  # noqa: E402
+
+small_prompt = "Tell me a one sentence story."
+large_prompt = "Hello" * 10000  # Same payload as test_large_prompt
+
+stream_tokens = ["Hello", " there,", " how ", "can ", "I ", "assist ", "you ", "today?"]
+
+
+def build_payloads(prompt: str):
+    history = [
+        {"role": "user", "content": small_prompt},
+        {"role": "assistant", "content": "Once upon a time, there was a gateway."},
+    ]
+    client_body = {
+        "model": "fake-openai-endpoint",
+        "messages": [{"role": "user", "content": prompt}],
+        "session_id": "5b0f7c8e-4a5c-4e16-9d2f-7c3a0c6f6a10",
+    }
+    upstream_response = {
+        "id": "chatcmpl-123",
+        "object": "chat.completion",
+        "created": 1677652288,
+        "model": "gpt-3.5-turbo-0301",
+        "choices": [
+            {
+                "index": 0,
+                "message": {
+                    "role": "assistant",
+                    "content": "Hello there, how may I assist you today?",
+                },
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": {"prompt_tokens": 9, "completion_tokens": 12, "total_tokens": 21},
+    }
+    stream_chunks = [
+        {
+            "id": "chatcmpl-123",
+            "object": "chat.completion.chunk",
+            "created": 1677652288,
+            "model": "gpt-3.5-turbo-0301",
+            "choices": [
+                {"delta": {"content": token}, "index": 0, "finish_reason": None}
+            ],
+        }
+        for token in stream_tokens
+    ]
+    return history, client_body, upstream_response, stream_chunks
+
+
+def simulate_request(codec, history, client_body_bytes, upstream_bytes, chunk_lines):
+    """
+    Performs the JSON work of one chat request with history enabled:
+    body decode, history load, upstream encode, response decode and re-encode,
+    per-chunk SSE re-encoding and history persistence.
+    """
+    data = codec.loads(client_body_bytes)
+    chat_history = codec.loads(history) + data["messages"]
+    data["messages"] = chat_history
+    codec.dumps(data)
+    response_dict = codec.loads(upstream_bytes)
+    codec.dumps(response_dict)
+    for line in chunk_lines:
+        codec.dumps(codec.loads(line))
+    chat_history.append(response_dict["choices"][0]["message"])
+    codec.dumps(chat_history).decode("utf-8")
+
+
+def cpu_per_request(codec, prompt: str, iterations: int) -> float:
+    history, client_body, upstream_response, stream_chunks = build_payloads(prompt)
+    reference = middleware.JsonCodec()
+    stored_history = reference.dumps(history).decode("utf-8")
+    client_body_bytes = reference.dumps(client_body)
+    upstream_bytes = reference.dumps(upstream_response)
+    chunk_lines = [reference.dumps(chunk).decode("utf-8") for chunk in stream_chunks]
+
+    start = time.process_time()
+    for _ in range(iterations):
+        simulate_request(
+            codec, stored_history, client_body_bytes, upstream_bytes, chunk_lines
+        )
+    return (time.process_time() - start) / iterations
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--iterations", default=2000, help="Simulated requests per run.")
+def codec(iterations):
+    """CPU per request for each installed JSON codec backend."""
+    rows = []
+    for name in ("json", "msgspec", "orjson"):
+        backend = middleware.select_json_codec(name)
+        if backend.name != name:
+            continue
+        for label, prompt in (("typical", small_prompt), ("large", large_prompt)):
+            seconds = cpu_per_request(backend, prompt, iterations)
+            rows.append([name, label, f"{seconds * 1e6:.1f}"])
+
+    click.echo(
+        tabulate(rows, ["Codec", "Payload", "CPU per request (us)"], tablefmt="grid")
+    )
+
+
+@cli.command()
+@click.option("--iterations", default=2000, help="Simulated requests per run.")
+def body(iterations):
+    """CPU per request for full decode/re-encode vs lazy passthrough bodies."""
+    rows = []
+    for label, prompt in (("typical", small_prompt), ("large", large_prompt)):
+        _, client_body, _, _ = build_payloads(prompt)
+        client_body.pop("session_id")
+        client_body["promptVariables"] = {}
+        raw = middleware.json_codec.dumps(client_body)
+
+        start = time.process_time()
+        for _ in range(iterations):
+            data = middleware.json_codec.loads(raw)
+            for name in middleware.REQUEST_CONTROL_FIELDS:
+                data.pop(name, None)
+            middleware.json_codec.dumps(data)
+        full = (time.process_time() - start) / iterations
+
+        start = time.process_time()
+        for _ in range(iterations):
+            middleware.extract_passthrough_body(raw)
+        lazy = (time.process_time() - start) / iterations
+
+        rows.append([label, len(raw), f"{full * 1e6:.1f}", f"{lazy * 1e6:.1f}"])
+
+    click.echo(
+        tabulate(
+            rows,
+            ["Payload", "Bytes", "Full parse (us)", "Lazy parse (us)"],
+            tablefmt="grid",
+        )
+    )
+
+
+def legacy_create_event_message(payload, event_type_name):
+    """The per-frame encoder the middleware used before EventStreamEncoder."""
+    header_name = b":event-type"
+    header_name_length = len(header_name)
+    event_name_bytes = event_type_name.encode("utf-8")
+    event_name_length = len(event_name_bytes)
+
+    headers_bytes = (
+        struct.pack("B", header_name_length)
+        + header_name
+        + b"\x07"
+        + struct.pack(">H", event_name_length)
+        + event_name_bytes
+    )
+
+    headers_length = len(headers_bytes)
+    payload_length = len(payload)
+    total_length = payload_length + headers_length + 16
+
+    prelude = struct.pack(">I", total_length) + struct.pack(">I", headers_length)
+    prelude_crc = struct.pack(">I", zlib.crc32(prelude) & 0xFFFFFFFF)
+
+    message_parts = prelude + prelude_crc + headers_bytes + payload
+    message_crc = struct.pack(">I", zlib.crc32(message_parts) & 0xFFFFFFFF)
+
+    return message_parts + message_crc
+
+
+def build_frames(text_size: int):
+    delta = {"contentBlockIndex": 0, "delta": {"text": "x" * text_size}}
+    return [
+        (middleware.json_codec.dumps({"role": "assistant"}), "messageStart"),
+        (middleware.json_codec.dumps(delta), "contentBlockDelta"),
+        (middleware.json_codec.dumps({"contentBlockIndex": 0}), "contentBlockStop"),
+        (middleware.json_codec.dumps({"stopReason": "end_turn"}), "messageStop"),
+    ]
+
+
+def verify_event_stream(encoder) -> int:
+    """
+    Checks the encoder byte-for-byte against the legacy function and decodes
+    every frame with botocore's event-stream parser. Returns the frame count.
+    """
+    checked = 0
+    for text_size in (0, 1, 7, 64, 950, 1000, 1100, 70000):
+        for payload, event_type in build_frames(text_size):
+            frame = encoder.encode(payload, event_type)
+            if frame != legacy_create_event_message(payload, event_type):
+                raise click.ClickException(f"{event_type} frame differs")
+            decoder = EventStreamBuffer()
+            decoder.add_data(frame)
+            messages = list(decoder)
+            if (
+                len(messages) != 1
+                or messages[0].payload != payload
+                or messages[0].headers != {":event-type": event_type}
+            ):
+                raise click.ClickException(f"botocore could not decode {event_type}")
+            checked += 1
+    return checked
+
+
+@cli.command()
+@click.option("--iterations", default=200000, help="Frames encoded per run.")
+def eventstream(iterations):
+    """Per-frame cost of the event-stream encoder vs the legacy function."""
+    encoder = middleware.EventStreamEncoder()
+    checked = verify_event_stream(encoder)
+    click.echo(f"{checked} frames byte-identical and decoded by botocore")
+
+    rows = []
+    for label, text_size in (
+        ("token", 4),
+        ("sentence", 200),
+        ("paragraph", 2000),
+        ("large", 20000),
+        ("document", 200000),
+    ):
+        payload, event_type = build_frames(text_size)[1]
+        runs = max(200, iterations // max(1, text_size // 200) // 5)
+        timings = [float("inf"), float("inf")]
+        # Alternate and keep the best of 5 so neither side pays for warm-up
+        for _ in range(5):
+            for i, encode in enumerate((legacy_create_event_message, encoder.encode)):
+                start = time.perf_counter()
+                for _ in range(runs):
+                    encode(payload, event_type)
+                timings[i] = min(timings[i], (time.perf_counter() - start) / runs)
+        rows.append(
+            [
+                label,
+                len(payload),
+                f"{timings[0] * 1e9:.0f}",
+                f"{timings[1] * 1e9:.0f}",
+                f"{timings[0] / timings[1]:.2f}x",
+            ]
+        )
+
+    click.echo(
+        tabulate(
+            rows,
+            ["Delta", "Payload bytes", "Legacy (ns)", "Encoder (ns)", "Speedup"],
+            tablefmt="grid",
+        )
+    )
+
+
+def sdk_transcode(lines):
+    """Per-token work of the previous AsyncOpenAI-based converse-stream path."""
+    frames = []
+    for line in lines:
+        chunk = construct_type(type_=ChatCompletionChunk, value=json.loads(line))
+        delta = chunk.choices[0].delta
+        if delta.content:
+            payload = middleware.json_codec.dumps(
+                {"contentBlockIndex": 0, "delta": {"text": delta.content}}
+            )
+            frames.append(middleware.create_event_message(payload, "contentBlockDelta"))
+    return frames
+
+
+def raw_transcode(lines):
+    """Per-token work of the raw SSE transcoder."""
+    frames = []
+    for line in lines:
+        chunk = middleware.json_codec.loads(line)
+        content = (chunk["choices"][0].get("delta") or {}).get("content")
+        if content:
+            payload = middleware.json_codec.dumps(
+                {"contentBlockIndex": 0, "delta": {"text": content}}
+            )
+            frames.append(middleware.create_event_message(payload, "contentBlockDelta"))
+    return frames
+
+
+@cli.command()
+@click.option("--tokens", default=20000, help="Stream chunks per run.")
+def transcode(tokens):
+    """CPU per token: SDK chunk objects vs the raw SSE transcoder."""
+    _, _, _, stream_chunks = build_payloads(small_prompt)
+    lines = [
+        middleware.json_codec.dumps(stream_chunks[i % len(stream_chunks)])
+        for i in range(tokens)
+    ]
+    if sdk_transcode(lines[:50]) != raw_transcode(lines[:50]):
+        raise click.ClickException("Transcoders produced different frames")
+
+    rows = []
+    for label, transcoder in (
+        ("SDK objects", sdk_transcode),
+        ("raw SSE", raw_transcode),
+    ):
+        start = time.process_time()
+        transcoder(lines)
+        rows.append([label, f"{(time.process_time() - start) / tokens * 1e6:.2f}"])
+
+    click.echo(tabulate(rows, ["Path", "CPU per token (us)"], tablefmt="grid"))
+
+
+def logged_requests(mode: str, requests: int, payloads) -> float:
+    """Runs simulated requests that each log three events; returns seconds."""
+    history, client_body_bytes, upstream_bytes, chunk_lines = payloads
+    headers = {
+        "authorization": "Bearer sk-1234567890abcdef",
+        "content-type": "application/json",
+        "user-agent": "OpenAI/Python 1.0",
+    }
+    start = time.perf_counter()
+    for _ in range(requests):
+        simulate_request(
+            middleware.json_codec,
+            history,
+            client_body_bytes,
+            upstream_bytes,
+            chunk_lines,
+        )
+        if mode == "print":
+            print(f"final_headers: {headers}")
+            print(f"request_body: {client_body_bytes}")
+            print("Stream exceeded 600s deadline")
+        else:
+            middleware.log_event(
+                logging.INFO,
+                "Forwarding request",
+                route="openai",
+                headers=headers,
+                body=client_body_bytes,
+            )
+            middleware.log_event(logging.INFO, "Request body", route="openai")
+            middleware.log_event(
+                logging.INFO, "Stream exceeded deadline", route="openai", deadline=600
+            )
+    return time.perf_counter() - start
+
+
+@contextlib.contextmanager
+def log_sink(sink: str):
+    """
+    A devnull stream, or a pipe drained like a container log driver: by `cat`,
+    or for "slow-pipe" at about 1 MB/s, as when the log driver falls behind.
+    """
+    if sink == "devnull":
+        with open(os.devnull, "w") as stream:
+            yield stream
+        return
+    command = ["cat"]
+    if sink == "slow-pipe":
+        command = [
+            sys.executable,
+            "-c",
+            "import sys, time\n"
+            "while sys.stdin.buffer.read1(65536):\n"
+            "    time.sleep(0.06)",
+        ]
+    reader = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+    with open(reader.stdin.fileno(), "w", closefd=False) as stream:
+        yield stream
+    reader.stdin.close()
+    reader.wait()
+
+
+@cli.command("logging")
+@click.option("--requests", default=20000, help="Simulated requests per mode.")
+@click.option(
+    "--sink",
+    type=click.Choice(["pipe", "slow-pipe", "devnull"]),
+    default="pipe",
+    help="Where stdout goes.",
+)
+def logging_throughput(requests, sink):
+    """Request throughput with logging off, queued structured logging and print."""
+    history, client_body, upstream_response, stream_chunks = build_payloads(
+        small_prompt
+    )
+    codec = middleware.json_codec
+    payloads = (
+        codec.dumps(history).decode("utf-8"),
+        codec.dumps(client_body),
+        codec.dumps(upstream_response),
+        [codec.dumps(chunk).decode("utf-8") for chunk in stream_chunks],
+    )
+
+    rows = []
+    with log_sink(sink) as stream:
+        middleware.log_writer.stream = stream
+        for mode in ("off", "structured", "sampled 10%", "print"):
+            middleware.LOG_LEVEL = (
+                logging.CRITICAL + 1 if mode == "off" else logging.INFO
+            )
+            middleware.LOG_SAMPLE_RATES["openai"] = 0.1 if mode == "sampled 10%" else 1
+            dropped = middleware.log_writer.dropped
+            with contextlib.redirect_stdout(stream):
+                seconds = logged_requests(mode, requests, payloads)
+            # Let the writer drain so modes don't overlap
+            middleware.log_writer.flush()
+            rows.append(
+                [
+                    mode,
+                    f"{requests / seconds:.0f}",
+                    f"{seconds / requests * 1e6:.1f}",
+                    middleware.log_writer.dropped - dropped,
+                ]
+            )
+
+    click.echo(
+        tabulate(
+            rows,
+            ["Logging", "Requests/s", "Per request (us)", "Dropped records"],
+            tablefmt="grid",
+        )
+    )
+
+
+def import_times() -> collections.Counter:
+    """
+    Imports the middleware in a fresh interpreter with -X importtime and
+    returns self time in microseconds per top-level package.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=middleware_dir,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    totals = collections.Counter()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, module = line[len("import time:") :].split("|")
+        totals[module.strip().split(".")[0]] += int(self_us)
+    return totals
+
+
+@cli.command()
+@click.option("--runs", default=5, help="Fresh interpreters to average over.")
+@click.option("--top", default=15, help="Packages to list.")
+def imports(runs, top):
+    """Import time of the middleware module, per top-level package."""
+    totals = collections.Counter()
+    for _ in range(runs):
+        totals.update(import_times())
+    rows = [
+        [package, f"{us / runs / 1000:.1f}"] for package, us in totals.most_common(top)
+    ]
+    rows.append(["total", f"{sum(totals.values()) / runs / 1000:.1f}"])
+    click.echo(tabulate(rows, ["Package", "Import time (ms)"], tablefmt="grid"))
+
+
+def wait_for_first_request(url: str, process, timeout: float) -> float:
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        if process.poll() is not None:
+            raise click.ClickException("Middleware exited during startup")
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == 200:
+                    return time.perf_counter() - started
+        except OSError:
+            pass
+        time.sleep(0.01)
+    raise click.ClickException(f"No response from {url} within {timeout}s")
+
+
+@cli.command()
+@click.option("--runs", default=5, help="Cold starts to measure.")
+@click.option("--port", default=3900, help="Port for the middleware under test.")
+@click.option("--timeout", default=60.0, help="Seconds to wait for each start.")
+def coldstart(runs, port, timeout):
+    """
+    Time from process launch to the first served request. Starts uvicorn the
+    way the container does, so DATABASE_MIDDLEWARE_URL must point at Postgres.
+    """
+    url = f"http://127.0.0.1:{port}/bedrock/health/readiness"
+    timings = []
+    for _ in range(runs):
+        process = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "uvicorn",
+                "app:app",
+                "--host",
+                "127.0.0.1",
+                "--port",
+                str(port),
+            ],
+            cwd=middleware_dir,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            timings.append(wait_for_first_request(url, process, timeout))
+        finally:
+            process.terminate()
+            process.wait()
+
+    timings.sort()
+    rows = [
+        ["min", f"{timings[0] * 1000:.0f}"],
+        ["median", f"{timings[len(timings) // 2] * 1000:.0f}"],
+        ["max", f"{timings[-1] * 1000:.0f}"],
+    ]
+    click.echo(
+        tabulate(rows, ["Cold start", "Time to first request (ms)"], tablefmt="grid")
+    )
+
+
+if __name__ == "__main__":
+    cli()
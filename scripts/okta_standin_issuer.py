@@ -0,0 +1,95 @@
+"""
+A local stand-in for an Okta authorization server, for exercising the
+middleware's JWT path (/user/new) without an Okta org.
+
+It publishes a JWKS at /oauth2/default/v1/keys and mints RS256 access tokens.
+Start it, then run the middleware with:
+
+    OKTA_ISSUER=http://localhost:8081/oauth2/default
+    OKTA_AUDIENCE=api://default
+
+Usage:
+    python scripts/okta_standin_issuer.py serve --port 8081
+    curl -X POST "localhost:8081/token?sub=alice@example.com&expires_in=300"
+    curl -X POST "localhost:8081/rotate?retire=true"
+"""
+
+import time
+import uuid
+
+import click
+import jwt
+import uvicorn
+from cryptography.hazmat.primitives.asymmetric import rsa
+from fastapi import FastAPI
+
+app = FastAPI()
+
+issuer = None
+signing_keys = []  # (kid, private_key); the last one signs new tokens
+
+
+def add_signing_key():
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    signing_keys.append((uuid.uuid4().hex, private_key))
+
+
+@app.get("/oauth2/default/v1/keys")
+async def keys():
+    published = []
+    for kid, private_key in signing_keys:
+        jwk = jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key(), as_dict=True)
+        published.append({**jwk, "kid": kid, "alg": "RS256", "use": "sig"})
+    return {"keys": published}
+
+
+@app.post("/token")
+async def token(
+    sub: str = "user@example.com",
+    audience: str = "api://default",
+    expires_in: int = 3600,
+):
+    kid, private_key = signing_keys[-1]
+    now = int(time.time())
+    claims = {
+        "iss": issuer,
+        "aud": audience,
+        "sub": sub,
+        "iat": now,
+        "exp": now + expires_in,
+        "jti": uuid.uuid4().hex,
+    }
+    access_token = jwt.encode(
+        claims, private_key, algorithm="RS256", headers={"kid": kid}
+    )
+    return {"access_token": access_token, "expires_in": expires_in}
+
+
+@app.post("/rotate")
+async def rotate(retire: bool = False):
+    """Adds a new signing key; with retire=true, unpublishes the older ones."""
+    add_signing_key()
+    if retire:
+        del signing_keys[:-1]
+    return {"kids": [kid for kid, _ in signing_keys]}
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--host", default="127.0.0.1")
+@click.option("--port", default=8081)
+def serve(host, port):
+    """Serves the JWKS and token endpoints."""
+    global issuer
+    issuer = f"http://localhost:{port}/oauth2/default"
+    add_signing_key()
+    click.echo(f"Issuer: {issuer}")
+    uvicorn.run(app, host=host, port=port, log_level="warning")
+
+
+if __name__ == "__main__":
+    cli()
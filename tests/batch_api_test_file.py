@@ -0,0 +1,102 @@
+import pytest
+import os
+import io
+import json
+import time
+from openai import OpenAI
+from dotenv import load_dotenv
+
+load_dotenv()
+
+base_url = os.getenv("API_ENDPOINT")
+api_key = os.getenv("API_KEY")
+# Point this at a model served by the fake LLM server to keep runs cheap
+batch_model_id = os.getenv("BATCH_MODEL_ID", "fake-openai-endpoint")
+batch_timeout_seconds = int(os.getenv("BATCH_TIMEOUT_SECONDS", "600"))
+client = OpenAI(base_url=f"{base_url}/middleware/v1", api_key=api_key)
+
+
+def build_input_file(count: int) -> io.BytesIO:
+    lines = [
+        json.dumps(
+            {
+                "custom_id": f"request-{i}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": batch_model_id,
+                    "messages": [{"role": "user", "content": f"Say the number {i}"}],
+                },
+            }
+        )
+        for i in range(count)
+    ]
+    return io.BytesIO(("\n".join(lines) + "\n").encode("utf-8"))
+
+
+def wait_for_batch(batch_id: str):
+    deadline = time.time() + batch_timeout_seconds
+    while time.time() < deadline:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in ("completed", "failed", "expired", "cancelled"):
+            return batch
+        time.sleep(5)
+    pytest.fail(f"Batch {batch_id} did not finish within {batch_timeout_seconds}s")
+
+
+def test_batch_job():
+    input_file = client.files.create(
+        file=("batch.jsonl", build_input_file(5)), purpose="batch"
+    )
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+        metadata={"test": "test_batch_job"},
+    )
+    assert batch.status == "validating"
+
+    batch = wait_for_batch(batch.id)
+    assert batch.status == "completed"
+    assert batch.request_counts.total == 5
+    assert batch.request_counts.completed == 5
+
+    output = client.files.content(batch.output_file_id).text
+    results = [json.loads(line) for line in output.splitlines()]
+    assert sorted(r["custom_id"] for r in results) == [
+        f"request-{i}" for i in range(5)
+    ]
+    for result in results:
+        assert result["response"]["status_code"] == 200
+        assert result["response"]["body"]["choices"][0]["message"]["content"]
+
+
+def test_batch_invalid_input():
+    input_file = client.files.create(
+        file=("batch.jsonl", io.BytesIO(b'{"custom_id": "x", "body": {}}\n')),
+        purpose="batch",
+    )
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    batch = wait_for_batch(batch.id)
+    assert batch.status == "failed"
+    assert batch.errors.data[0].line == 1
+
+
+def test_batch_cancel():
+    input_file = client.files.create(
+        file=("batch.jsonl", build_input_file(50)), purpose="batch"
+    )
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    batch = client.batches.cancel(batch.id)
+    assert batch.status in ("cancelling", "completed")
+
+    batch = wait_for_batch(batch.id)
+    assert batch.status in ("cancelled", "completed")
@@ -0,0 +1,346 @@
+"""
+In-process tests for the batch job queue (middleware/batch_jobs.py): leasing,
+retries, cancellation and per-job keys. Items go to the fake LLM server, which
+also stands in for LiteLLM's key management routes; jobs live in SQLite.
+"""
+
+import hashlib
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+import httpx
+import pytest
+import uvicorn
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from sqlalchemy import create_engine, update
+
+repo_dir = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(repo_dir, "middleware"))
+sys.path.insert(
+    0,
+    os.path.join(repo_dir, "litellm-fake-llm-load-testing-server-terraform", "docker"),
+)
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+import app as middleware  # noqa: E402
+import batch_jobs  # noqa: E402
+import fake_llm_server  # noqa: E402
+
+MASTER_KEY = "sk-test-master"
+SUBMITTER_KEY = "sk-alice"
+submitter_info = {
+    "user_id": "alice",
+    "team_id": "team-a",
+    "models": ["fake-openai-endpoint"],
+    "max_budget": 10.0,
+    "spend": 4.0,
+    "rpm_limit": 60,
+    "expires": None,
+    "blocked": None,
+}
+
+
+class FakeLiteLLM:
+    """Key management state behind the fake server's /key routes."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.keys = {SUBMITTER_KEY: dict(submitter_info)}
+        self.generated = {}
+        self.deleted = []
+        self.chat_keys = []
+        self.rate_limited = 0
+
+    def by_hash(self, key_hash: str):
+        for key, info in self.keys.items():
+            if hashlib.sha256(key.encode("utf-8")).hexdigest() == key_hash:
+                return info
+        return None
+
+
+fake = FakeLiteLLM()
+
+
+def bearer(request) -> str:
+    return request.headers.get("authorization", "")[len("Bearer ") :]
+
+
+@fake_llm_server.app.get("/key/info")
+async def key_info(request: Request):
+    key = bearer(request)
+    if key == MASTER_KEY and "key" in request.query_params:
+        info = fake.by_hash(request.query_params["key"])
+    else:
+        info = fake.keys.get(key)
+    if info is None:
+        return JSONResponse({"error": "not found"}, status_code=404)
+    return {"info": info}
+
+
+@fake_llm_server.app.post("/key/generate")
+async def key_generate(request: Request):
+    assert bearer(request) == MASTER_KEY
+    key = f"sk-batch-{len(fake.generated)}"
+    fake.generated[key] = await request.json()
+    fake.keys[key] = {"user_id": fake.generated[key].get("user_id")}
+    return {"key": key}
+
+
+@fake_llm_server.app.post("/key/delete")
+async def key_delete(request: Request):
+    assert bearer(request) == MASTER_KEY
+    for key in (await request.json())["keys"]:
+        fake.deleted.append(key)
+        fake.keys.pop(key, None)
+    return {"deleted_keys": fake.deleted}
+
+
+class ChatRecorder:
+    """Records which key each completion used and answers 429 when asked to."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].endswith("/chat/completions"):
+            headers = dict(scope["headers"])
+            fake.chat_keys.append(headers.get(b"authorization", b"").decode())
+            if fake.rate_limited > 0:
+                fake.rate_limited -= 1
+                response = JSONResponse(
+                    {"error": {"message": "Rate limited"}}, status_code=429
+                )
+                return await response(scope, receive, send)
+        await self.app(scope, receive, send)
+
+
+fake_llm_server.app.add_middleware(ChatRecorder)
+
+
+@pytest.fixture(scope="module")
+def fake_llm_endpoint():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(
+        uvicorn.Config(
+            fake_llm_server.app, host="127.0.0.1", port=port, log_level="warning"
+        )
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    yield f"http://127.0.0.1:{port}"
+    server.should_exit = True
+    thread.join()
+
+
+@pytest.fixture(autouse=True)
+def middleware_setup(fake_llm_endpoint, tmp_path, monkeypatch):
+    fake.reset()
+    # Patched rather than set in the environment, since another test file may
+    # have imported the middleware first
+    monkeypatch.setattr(middleware, "MASTER_KEY", MASTER_KEY)
+    monkeypatch.setattr(batch_jobs, "MASTER_KEY", MASTER_KEY)
+    batch_jobs.get_batch_key_cipher.cache_clear()
+    monkeypatch.setattr(middleware, "LITELLM_ENDPOINT", fake_llm_endpoint)
+    monkeypatch.setattr(
+        middleware, "LITELLM_CHAT", f"{fake_llm_endpoint}/v1/chat/completions"
+    )
+    monkeypatch.setattr(
+        middleware, "db_engine", create_engine(f"sqlite:///{tmp_path}/batch.db")
+    )
+    batch_jobs.setup_batch_tables(middleware.db_engine)
+
+
+def client(api_key: str = SUBMITTER_KEY) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=middleware.app),
+        base_url="http://middleware",
+        headers={"Authorization": f"Bearer {api_key}"},
+    )
+
+
+def input_file(count: int) -> bytes:
+    lines = [
+        json.dumps(
+            {
+                "custom_id": f"request-{i}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": "fake-openai-endpoint",
+                    "messages": [{"role": "user", "content": f"Say {i}"}],
+                },
+            }
+        )
+        for i in range(count)
+    ]
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+async def submit(count: int) -> str:
+    async with client() as http:
+        response = await http.post(
+            "/middleware/v1/files",
+            params={"purpose": "batch"},
+            content=input_file(count),
+        )
+        assert response.status_code == 200
+        response = await http.post(
+            "/middleware/v1/batches",
+            json={
+                "input_file_id": response.json()["id"],
+                "endpoint": "/v1/chat/completions",
+                "completion_window": "24h",
+            },
+        )
+        assert response.status_code == 200
+        return response.json()["id"]
+
+
+async def retrieve(batch_id: str) -> dict:
+    async with client() as http:
+        return (await http.get(f"/middleware/v1/batches/{batch_id}")).json()
+
+
+async def file_lines(file_id: str) -> list:
+    async with client() as http:
+        response = await http.get(f"/middleware/v1/files/{file_id}/content")
+        return [json.loads(line) for line in response.text.splitlines()]
+
+
+def expire_lease(batch_id: str):
+    with middleware.db_engine.begin() as conn:
+        conn.execute(
+            update(batch_jobs.batch_jobs)
+            .where(batch_jobs.batch_jobs.c.batch_id == batch_id)
+            .values(lease_expires_at=int(time.time()) - 1)
+        )
+
+
+@pytest.mark.asyncio
+async def test_unknown_key_cannot_submit():
+    async with client("totally-bogus-not-a-key") as http:
+        response = await http.post(
+            "/middleware/v1/files", params={"purpose": "batch"}, content=input_file(1)
+        )
+        assert response.status_code == 401
+        response = await http.post(
+            "/middleware/v1/batches",
+            json={"input_file_id": "file-x", "endpoint": "/v1/chat/completions"},
+        )
+        assert response.status_code == 401
+    assert fake.generated == {}
+
+
+@pytest.mark.asyncio
+async def test_batch_runs_with_its_own_key():
+    batch_id = await submit(3)
+    [(key, payload)] = fake.generated.items()
+    assert payload["user_id"] == "alice"
+    assert payload["team_id"] == "team-a"
+    assert payload["models"] == ["fake-openai-endpoint"]
+    assert payload["max_budget"] == 6.0
+
+    job = batch_jobs.claim_batch_job("worker-a")
+    assert key not in job["worker_key"]
+    await batch_jobs.run_batch_job(job, "worker-a")
+
+    batch = await retrieve(batch_id)
+    assert batch["status"] == "completed"
+    assert batch["request_counts"] == {"total": 3, "completed": 3, "failed": 0}
+    output = await file_lines(batch["output_file_id"])
+    assert [line["custom_id"] for line in output] == [f"request-{i}" for i in range(3)]
+    assert fake.chat_keys == [f"Bearer {key}"] * 3
+    assert fake.deleted == [key]
+
+
+@pytest.mark.asyncio
+async def test_leased_job_is_resumed_from_its_checkpoint():
+    batch_id = await submit(3)
+    job = batch_jobs.claim_batch_job("worker-a")
+    assert batch_jobs.claim_batch_job("worker-b") is None
+
+    # worker-a checkpoints one request, then stops renewing its lease
+    assert batch_jobs.start_batch_items(job, "worker-a") == "in_progress"
+    batch_jobs.record_batch_item(batch_id, 0, True, b'{"custom_id": "request-0"}')
+    expire_lease(batch_id)
+
+    job = batch_jobs.claim_batch_job("worker-b")
+    assert job["batch_id"] == batch_id and job["status"] == "in_progress"
+    assert batch_jobs.renew_batch_lease(batch_id, "worker-a") is None
+    await batch_jobs.run_batch_job(job, "worker-b")
+
+    batch = await retrieve(batch_id)
+    assert batch["status"] == "completed"
+    assert batch["request_counts"] == {"total": 3, "completed": 3, "failed": 0}
+    assert len(fake.chat_keys) == 2
+
+
+@pytest.mark.asyncio
+async def test_rate_limited_request_is_retried():
+    batch_id = await submit(1)
+    fake.rate_limited = 1
+    await batch_jobs.run_batch_job(batch_jobs.claim_batch_job("worker-a"), "worker-a")
+
+    batch = await retrieve(batch_id)
+    assert batch["request_counts"] == {"total": 1, "completed": 1, "failed": 0}
+    assert len(fake.chat_keys) == 2
+
+
+@pytest.mark.asyncio
+async def test_request_fails_once_retries_run_out(monkeypatch):
+    monkeypatch.setattr(batch_jobs, "BATCH_ITEM_RETRIES", 0)
+    batch_id = await submit(1)
+    fake.rate_limited = 1
+    await batch_jobs.run_batch_job(batch_jobs.claim_batch_job("worker-a"), "worker-a")
+
+    batch = await retrieve(batch_id)
+    assert batch["status"] == "completed"
+    assert batch["request_counts"] == {"total": 1, "completed": 0, "failed": 1}
+    [error] = await file_lines(batch["error_file_id"])
+    assert error["response"]["status_code"] == 429
+
+
+@pytest.mark.asyncio
+async def test_cancelled_job_reports_unrun_requests():
+    batch_id = await submit(3)
+    job = batch_jobs.claim_batch_job("worker-a")
+    batch_jobs.start_batch_items(job, "worker-a")
+    batch_jobs.record_batch_item(batch_id, 0, True, b'{"custom_id": "request-0"}')
+    async with client() as http:
+        response = await http.post(f"/middleware/v1/batches/{batch_id}/cancel")
+    assert response.json()["status"] == "cancelling"
+
+    expire_lease(batch_id)
+    await batch_jobs.run_batch_job(batch_jobs.claim_batch_job("worker-b"), "worker-b")
+
+    batch = await retrieve(batch_id)
+    assert batch["status"] == "cancelled"
+    assert len(await file_lines(batch["output_file_id"])) == 1
+    errors = await file_lines(batch["error_file_id"])
+    assert [error["error"]["code"] for error in errors] == ["batch_cancelled"] * 2
+    assert fake.chat_keys == []
+    assert fake.deleted == list(fake.generated)
+
+
+@pytest.mark.asyncio
+async def test_job_fails_when_submitter_key_is_revoked():
+    batch_id = await submit(2)
+    del fake.keys[SUBMITTER_KEY]
+    await batch_jobs.run_batch_job(batch_jobs.claim_batch_job("worker-a"), "worker-a")
+
+    batch = await retrieve(batch_id)
+    assert batch["status"] == "failed"
+    assert batch["errors"]["data"][0]["code"] == "key_revoked"
+    assert fake.chat_keys == []
+    assert fake.deleted == list(fake.generated)
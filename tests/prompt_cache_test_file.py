@@ -0,0 +1,212 @@
+"""
+In-process tests for the managed prompt cache (ManagedPromptCache in
+middleware/app.py). bedrock-agent is a real boto3 client wrapped in botocore's
+Stubber, so every get_prompt call the cache makes has to be queued here.
+"""
+
+import datetime
+import os
+import sys
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "middleware"))
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+import app as middleware  # noqa: E402
+
+PROMPT_ID = "PROMPT12345"
+PROMPT_ARN = f"arn:aws:bedrock:us-east-1:123456789012:prompt/{PROMPT_ID}"
+
+
+def get_prompt_response(version: str, text: str) -> dict:
+    now = datetime.datetime(2026, 1, 1)
+    return {
+        "name": "greeting",
+        "id": PROMPT_ID,
+        "arn": PROMPT_ARN,
+        "version": version,
+        "createdAt": now,
+        "updatedAt": now,
+        "variants": [
+            {
+                "name": "default",
+                "modelId": "anthropic.claude-3-haiku",
+                "templateType": "TEXT",
+                "templateConfiguration": {"text": {"text": text}},
+            }
+        ],
+    }
+
+
+@pytest.fixture
+def stubbed_cache(monkeypatch):
+    client = boto3.client("bedrock-agent", region_name="us-east-1")
+    cache = middleware.ManagedPromptCache(lambda: None, draft_ttl=60)
+    cache.client = client
+    monkeypatch.setattr(middleware, "prompt_cache", cache)
+    with Stubber(client) as stubber:
+        yield cache, stubber
+        stubber.assert_no_pending_responses()
+
+
+def expire(cache, prompt_version=None):
+    cache._entries[(PROMPT_ID, prompt_version)]["fetched_at"] -= cache.draft_ttl + 1
+
+
+def rendered(managed_prompt) -> str:
+    _, template = managed_prompt.variants[0]
+    return template.render({"name": {"text": "Ada"}})
+
+
+@pytest.mark.asyncio
+async def test_versioned_prompt_is_fetched_once(stubbed_cache):
+    cache, stubber = stubbed_cache
+    stubber.add_response(
+        "get_prompt",
+        get_prompt_response("3", "Hello {{name}}"),
+        {"promptIdentifier": PROMPT_ID, "promptVersion": "3"},
+    )
+
+    for _ in range(3):
+        managed_prompt = await middleware.get_managed_prompt(f"{PROMPT_ARN}:3")
+        assert rendered(managed_prompt) == "Hello Ada"
+
+    # Numbered versions are immutable, so they never expire
+    expire(cache, "3")
+    assert rendered(await middleware.get_managed_prompt(f"{PROMPT_ARN}:3")) == (
+        "Hello Ada"
+    )
+    assert cache.stats() == {"misses": 1, "hits": 3, "entries": 1}
+
+
+@pytest.mark.asyncio
+async def test_draft_prompt_is_refetched_after_ttl(stubbed_cache):
+    cache, stubber = stubbed_cache
+    stubber.add_response(
+        "get_prompt",
+        get_prompt_response("DRAFT", "Hello {{name}}"),
+        {"promptIdentifier": PROMPT_ID},
+    )
+    stubber.add_response(
+        "get_prompt",
+        get_prompt_response("DRAFT", "Goodbye {{name}}"),
+        {"promptIdentifier": PROMPT_ID},
+    )
+
+    assert rendered(await middleware.get_managed_prompt(PROMPT_ARN)) == "Hello Ada"
+    assert rendered(await middleware.get_managed_prompt(PROMPT_ARN)) == "Hello Ada"
+    expire(cache)
+    assert rendered(await middleware.get_managed_prompt(PROMPT_ARN)) == "Goodbye Ada"
+    assert cache.stats() == {"misses": 2, "hits": 1, "entries": 1}
+
+
+@pytest.mark.asyncio
+async def test_versioned_and_draft_arns_are_cached_separately(stubbed_cache):
+    cache, stubber = stubbed_cache
+    stubber.add_response(
+        "get_prompt",
+        get_prompt_response("DRAFT", "Draft {{name}}"),
+        {"promptIdentifier": PROMPT_ID},
+    )
+    stubber.add_response(
+        "get_prompt",
+        get_prompt_response("1", "Version one {{name}}"),
+        {"promptIdentifier": PROMPT_ID, "promptVersion": "1"},
+    )
+
+    assert rendered(await middleware.get_managed_prompt(PROMPT_ARN)) == "Draft Ada"
+    assert rendered(await middleware.get_managed_prompt(f"{PROMPT_ARN}:1")) == (
+        "Version one Ada"
+    )
+    assert await middleware.get_managed_prompt("anthropic.claude-3-haiku") is None
+    assert cache.stats()["entries"] == 2
+
+
+@pytest.mark.asyncio
+async def test_failed_fetch_is_not_cached(stubbed_cache):
+    cache, stubber = stubbed_cache
+    stubber.add_client_error("get_prompt", "ThrottlingException", http_status_code=429)
+    stubber.add_response(
+        "get_prompt",
+        get_prompt_response("1", "Hello {{name}}"),
+        {"promptIdentifier": PROMPT_ID, "promptVersion": "1"},
+    )
+
+    with pytest.raises(Exception, match="ThrottlingException"):
+        await middleware.get_managed_prompt(f"{PROMPT_ARN}:1")
+    assert cache.stats() == {"misses": 1, "errors": 1, "entries": 0}
+    assert rendered(await middleware.get_managed_prompt(f"{PROMPT_ARN}:1")) == (
+        "Hello Ada"
+    )
+
+
+@pytest.mark.asyncio
+async def test_failed_draft_refresh_serves_the_cached_prompt(stubbed_cache):
+    cache, stubber = stubbed_cache
+    stubber.add_response(
+        "get_prompt",
+        get_prompt_response("DRAFT", "Hello {{name}}"),
+        {"promptIdentifier": PROMPT_ID},
+    )
+    stubber.add_client_error(
+        "get_prompt", "InternalServerException", http_status_code=500
+    )
+    stubber.add_response(
+        "get_prompt",
+        get_prompt_response("DRAFT", "Goodbye {{name}}"),
+        {"promptIdentifier": PROMPT_ID},
+    )
+
+    await middleware.get_managed_prompt(PROMPT_ARN)
+    expire(cache)
+    assert rendered(await middleware.get_managed_prompt(PROMPT_ARN)) == "Hello Ada"
+    assert cache.stats()["stale"] == 1
+    # Still expired, so the next request tries again
+    assert rendered(await middleware.get_managed_prompt(PROMPT_ARN)) == "Goodbye Ada"
+
+
+@pytest.mark.asyncio
+async def test_deleted_draft_is_not_served_stale(stubbed_cache):
+    cache, stubber = stubbed_cache
+    stubber.add_response(
+        "get_prompt",
+        get_prompt_response("DRAFT", "Hello {{name}}"),
+        {"promptIdentifier": PROMPT_ID},
+    )
+    stubber.add_client_error(
+        "get_prompt", "ResourceNotFoundException", http_status_code=404
+    )
+
+    await middleware.get_managed_prompt(PROMPT_ARN)
+    expire(cache)
+    with pytest.raises(Exception, match="ResourceNotFoundException"):
+        await middleware.get_managed_prompt(PROMPT_ARN)
+    assert cache.stats()["entries"] == 0
+
+
+@pytest.mark.asyncio
+async def test_preload_skips_bad_arns_and_failures(stubbed_cache):
+    cache, stubber = stubbed_cache
+    stubber.add_client_error(
+        "get_prompt", "AccessDeniedException", http_status_code=403
+    )
+    stubber.add_response(
+        "get_prompt",
+        get_prompt_response("2", "Hello {{name}}"),
+        {"promptIdentifier": PROMPT_ID, "promptVersion": "2"},
+    )
+
+    await cache.preload(
+        [
+            "arn:aws:bedrock:us-east-1:123456789012:model/x",
+            PROMPT_ARN,
+            f"{PROMPT_ARN}:2",
+        ]
+    )
+    assert cache.stats() == {"misses": 2, "errors": 1, "entries": 1}
+    assert rendered(await middleware.get_managed_prompt(f"{PROMPT_ARN}:2")) == (
+        "Hello Ada"
+    )
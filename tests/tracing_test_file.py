@@ -0,0 +1,207 @@
+"""
+In-process tests for OpenTelemetry tracing in middleware/app.py. Requests go
+through the app with the file exporter and upstream to the fake LLM server;
+the tests read the exported spans back and check their names and links.
+"""
+
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+import httpx
+import pytest
+import uvicorn
+
+repo_dir = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(repo_dir, "middleware"))
+sys.path.insert(
+    0,
+    os.path.join(repo_dir, "litellm-fake-llm-load-testing-server-terraform", "docker"),
+)
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+import app as middleware  # noqa: E402
+import fake_llm_server  # noqa: E402
+
+PROMPT_ARN = "arn:aws:bedrock:us-east-1:123456789012:prompt/PROMPT12345"
+CALLER_TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+CALLER_SPAN_ID = "00f067aa0ba902b7"
+
+
+class TraceparentRecorder:
+    """Wraps the fake LLM server and records the traceparent of each call."""
+
+    def __init__(self, app):
+        self.app = app
+        self.traceparents = []
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            headers = dict(scope["headers"])
+            self.traceparents.append(headers.get(b"traceparent", b"").decode())
+        await self.app(scope, receive, send)
+
+
+class FakeAgentClient:
+    """Just enough of bedrock-agent for ManagedPromptCache."""
+
+    def get_prompt(self, promptIdentifier, promptVersion=None):
+        return {
+            "variants": [
+                {
+                    "name": "default",
+                    "modelId": "fake-openai-endpoint",
+                    "templateConfiguration": {"text": {"text": "Greet {{name}}"}},
+                }
+            ]
+        }
+
+
+upstream = TraceparentRecorder(fake_llm_server.app)
+
+
+@pytest.fixture(scope="module")
+def fake_llm_endpoint():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(
+        uvicorn.Config(upstream, host="127.0.0.1", port=port, log_level="warning")
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    yield f"http://127.0.0.1:{port}"
+    server.should_exit = True
+    thread.join()
+
+
+@pytest.fixture(scope="module")
+def file_tracing(tmp_path_factory):
+    # The SDK's tracer provider is process-wide, so it is set up once
+    trace_file = tmp_path_factory.mktemp("tracing") / "traces.jsonl"
+    tracing = middleware.Tracing(True, "file", str(trace_file), 1.0, "middleware")
+    return tracing, trace_file
+
+
+@pytest.fixture(autouse=True)
+def middleware_setup(fake_llm_endpoint, file_tracing, monkeypatch):
+    tracing, trace_file = file_tracing
+    trace_file.write_text("")
+    upstream.traceparents.clear()
+    monkeypatch.setattr(middleware, "tracing", tracing)
+    monkeypatch.setattr(middleware, "LITELLM_ENDPOINT", fake_llm_endpoint)
+    monkeypatch.setattr(
+        middleware, "LITELLM_CHAT", f"{fake_llm_endpoint}/v1/chat/completions"
+    )
+    prompt_cache = middleware.ManagedPromptCache(lambda: None, draft_ttl=60)
+    prompt_cache.client = FakeAgentClient()
+    monkeypatch.setattr(middleware, "prompt_cache", prompt_cache)
+
+
+def client(**headers) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=middleware.app),
+        base_url="http://middleware",
+        headers={"Authorization": "Bearer sk-tracing-test", **headers},
+    )
+
+
+def exported_spans(file_tracing) -> list:
+    _, trace_file = file_tracing
+    return [json.loads(line) for line in trace_file.read_text().splitlines()]
+
+
+def span_id(span) -> str:
+    return span["context"]["span_id"]
+
+
+def trace_id(span) -> str:
+    return span["context"]["trace_id"]
+
+
+def server_span(spans: list, parent_id) -> dict:
+    # The in-process fake server may export its own spans, under litellm.chat
+    [server] = [
+        span
+        for span in spans
+        if span["kind"] == "SpanKind.SERVER" and span["parent_id"] == parent_id
+    ]
+    return server
+
+
+def descendant(spans: list, ancestor: dict, name: str) -> dict:
+    """The span called `name` below `ancestor`, possibly via framework spans."""
+    by_id = {span_id(span): span for span in spans}
+    [found] = [span for span in spans if span["name"] == name]
+    parent = by_id.get(found["parent_id"])
+    while parent is not None and parent is not ancestor:
+        parent = by_id.get(parent["parent_id"])
+    assert parent is ancestor, f"{name} is not under {ancestor['name']}"
+    assert trace_id(found) == trace_id(ancestor)
+    return found
+
+
+def sent_parent_id() -> str:
+    """The parent span id the middleware sent upstream in traceparent."""
+    [traceparent] = upstream.traceparents
+    return "0x" + traceparent.split("-")[2]
+
+
+@pytest.mark.asyncio
+async def test_converse_spans_continue_the_callers_trace(file_tracing):
+    traceparent = f"00-{CALLER_TRACE_ID}-{CALLER_SPAN_ID}-01"
+    async with client(traceparent=traceparent) as http:
+        response = await http.post(
+            f"/bedrock/model/{PROMPT_ARN}/converse",
+            json={"promptVariables": {"name": {"text": "Ada"}}},
+        )
+    assert response.status_code == 200
+
+    spans = exported_spans(file_tracing)
+    server = server_span(spans, f"0x{CALLER_SPAN_ID}")
+    assert server["name"] == (
+        "POST /bedrock/model/{prompt_arn_prefix}/{prompt_id}/converse"
+    )
+    assert trace_id(server) == f"0x{CALLER_TRACE_ID}"
+    assert server["attributes"]["http.response.status_code"] == 200
+    assert server["attributes"]["gen_ai.request.model"] == "fake-openai-endpoint"
+
+    get_prompt = descendant(spans, server, "bedrock.get_prompt")
+    assert get_prompt["kind"] == "SpanKind.CLIENT"
+    assert get_prompt["attributes"]["prompt_id"] == "PROMPT12345"
+    upstream_call = descendant(spans, server, "litellm.chat")
+    assert upstream_call["kind"] == "SpanKind.CLIENT"
+    assert get_prompt["end_time"] <= upstream_call["start_time"]
+
+    # LiteLLM is told to continue the trace under the upstream call's span
+    assert sent_parent_id() == span_id(upstream_call)
+    assert upstream.traceparents[0].split("-")[1] == CALLER_TRACE_ID
+
+
+@pytest.mark.asyncio
+async def test_streaming_upstream_span_covers_the_stream(file_tracing):
+    async with client() as http:
+        response = await http.post(
+            "/v1/chat/completions",
+            json={
+                "model": "fake-openai-endpoint",
+                "messages": [{"role": "user", "content": "Hi"}],
+                "stream": True,
+            },
+        )
+    assert response.status_code == 200
+    assert '"finish_reason":"stop"' in response.text
+
+    spans = exported_spans(file_tracing)
+    # A new trace, since the caller sent no traceparent
+    server = server_span(spans, None)
+    assert server["name"] == "POST /v1/chat/completions"
+    upstream_call = descendant(spans, server, "litellm.chat")
+    assert upstream_call["attributes"]["stream"] is True
+    assert upstream_call["end_time"] <= server["end_time"]
+    assert sent_parent_id() == span_id(upstream_call)